@@ -28,7 +28,7 @@ async def process_stream(stream, nworkers, async_proc, loop=None):
             await q.put(x)
         await q.join()
 
-    q = asyncio.Queue(nworkers*2, loop=loop)
+    q = asyncio.Queue(nworkers*2)
     for _ in range(nworkers):
         asyncio.ensure_future(process_q(q, async_proc), loop=loop)
 
@@ -46,7 +46,10 @@ def async_process(stream,
     loop.run_until_complete(process_stream(stream, nworkers, async_proc, loop=loop))
 
 
-def p_fetch(stream, on_data, nconnections=64, loop=None):
+def p_fetch(stream, on_data, nconnections=64, loop=None, on_error=None,
+            retries=0,
+            retry_delay=0.5,
+            throttle=None):
     """
       stream -- ((userdata, req)....)
 
@@ -59,24 +62,62 @@ def p_fetch(stream, on_data, nconnections=64, loop=None):
     t0 - request is made
     t1 - response header is received and parsed
     t2 - response data is read
+
+    on_error -- (userdata, exception) -> None, when supplied failed requests
+                and HTTP error responses are reported here instead of raising
+                or being passed on to on_data
+
+    retries -- number of times to retry connection errors and 5xx/429
+               responses, waiting retry_delay*2^attempt seconds in between
+
+    throttle -- optional coroutine function, awaited before each request is
+                made, can be used to limit how far ahead of the consumer
+                fetching runs
     """
     import aiohttp
     from timeit import default_timer as t_now
 
+    def can_retry(status):
+        return status >= 500 or status == 429
+
     async def fetch_one(req, session, userdata):
-        t0 = t_now()
-        async with session.get(req.full_url, headers=req.headers) as response:
-            t1 = t_now()
-            data = await response.read()
-            t2 = t_now()
+        if throttle is not None:
+            await throttle()
+
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(retry_delay*(2**(attempt - 1)))
+
+            t0 = t_now()
+            try:
+                async with session.get(req.full_url, headers=req.headers) as response:
+                    t1 = t_now()
+                    data = await response.read()
+                    t2 = t_now()
+                    status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                if attempt < retries:
+                    continue
+                if on_error is None:
+                    raise
+                on_error(userdata, e)
+                return
+
+            if status >= 400 and attempt < retries and can_retry(status):
+                continue
+
+            if on_error is not None and status >= 400:
+                on_error(userdata, IOError('HTTP {}: {}'.format(status, req.full_url)))
+                return
+
             on_data(data, userdata, time=(t0, t1, t2))
+            return
 
     async def fetch_all(reqs, on_data, nconnections, loop=loop):
         tcp_connector = aiohttp.TCPConnector(limit=nconnections,
-                                             loop=loop,
                                              limit_per_host=nconnections)
 
-        async with aiohttp.ClientSession(loop=loop, connector=tcp_connector) as session:
+        async with aiohttp.ClientSession(connector=tcp_connector) as session:
             return await process_stream(reqs, nconnections, lambda x: fetch_one(x[1], session, x[0]), loop=loop)
 
     is_loop_mine = loop is None
@@ -5,18 +5,30 @@ from collections import namedtuple
 UserData = namedtuple('UserData', ['url', 'idx'])
 
 
-def fetch_bunch(urls, on_data, nconnections=64, loop=None, region_name=None):
+def fetch_bunch(urls, on_data, nconnections=64, loop=None, region_name=None,
+                on_error=None,
+                endpoint_url=None,
+                retries=0,
+                retry_delay=0.5,
+                throttle=None):
     """
     on_data callback order is not guaranteed
 
     on_data(bytes, url, idx=int, time=(t0, t1, t2))
+
+    on_error(url, idx=int, error=Exception) -- optional, failed requests are
+    reported here, otherwise first failure aborts the whole bunch
+
+    endpoint_url -- talk to S3 compatible service at this address instead of AWS
+
+    retries, retry_delay, throttle -- see `p_fetch`
     """
 
     if region_name is None:
         # TODO: this should be region of the bucket not region of an instance
         region_name = auto_find_region()
 
-    signer = s3_get_object_request_maker(region_name=region_name)
+    signer = s3_get_object_request_maker(region_name=region_name, endpoint_url=endpoint_url)
 
     def mk_request(uu):
         idx, url = uu
@@ -25,7 +37,14 @@ def fetch_bunch(urls, on_data, nconnections=64, loop=None, region_name=None):
     def data_cbk(data, udata, time=None):
         on_data(data, udata.url, idx=udata.idx, time=time)
 
+    def error_cbk(udata, error):
+        on_error(udata.url, idx=udata.idx, error=error)
+
     p_fetch(map(mk_request, enumerate(urls)),
             data_cbk,
             nconnections=nconnections,
-            loop=loop)
+            loop=loop,
+            on_error=error_cbk if on_error is not None else None,
+            retries=retries,
+            retry_delay=retry_delay,
+            throttle=throttle)
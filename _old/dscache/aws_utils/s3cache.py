@@ -0,0 +1,348 @@
+"""
+On-disk cache of S3 listings, stored in LMDB.
+
+Listings are recorded per `bucket/prefix`, for every object we keep key,
+size and ETag. A listing younger than `ttl` seconds is served from disk
+without talking to S3, listings of any parent prefix are used too. Stale
+listings are fetched again from scratch, or for append-only prefixes only
+keys after the last one seen are fetched (`StartAfter`).
+
+Layout, two named databases:
+
+    prefixes -- "bucket/prefix" -> json {t, t_full, last_key, count, complete}
+    objects  -- "bucket/key"    -> json [size, etag] or [size, etag, key] for
+                                   keys too long for LMDB, these are stored
+                                   truncated with a hash suffix
+"""
+import hashlib
+import json
+import time
+import lmdb
+from .s3tools import s3_url_parse, make_s3_client
+
+DEFAULT_TTL = 24*3600
+
+# Initial memory map size, grown on demand
+DEFAULT_MAP_SIZE = 1 << 26
+MAP_GROWTH_FACTOR = 2
+
+# Number of objects per write transaction, also per read transaction when scanning
+BATCH_SIZE = 10000
+
+
+def _ancestors(prefix):
+    """ All prefixes ending on '/' that contain `prefix`, including the empty one, longest first """
+    out = [prefix[:i+1] for i, c in enumerate(prefix[:-1]) if c == '/']
+    return out[::-1] + ['']
+
+
+class S3ListingCache(object):
+    """ Persistent cache of `list_objects_v2` results.
+
+    :param path: Directory to keep LMDB files in
+    :param ttl: Seconds before a listing needs to be refreshed
+    :param full_ttl: Seconds before append-only listing is fetched from scratch,
+                     None -- only refresh incrementally
+    :param append_only: Default mode for refreshing listings, when set only
+                        keys after the last one seen are fetched, so deletions
+                        and modifications are not noticed until full refresh
+    :param s3: botocore s3 client, created on first use if not supplied
+    """
+    def __init__(self, path,
+                 ttl=DEFAULT_TTL,
+                 full_ttl=None,
+                 append_only=False,
+                 s3=None,
+                 map_size=DEFAULT_MAP_SIZE):
+        self._env = lmdb.open(str(path), max_dbs=4, map_size=map_size)
+        self._prefixes = self._env.open_db(b'prefixes')
+        self._objects = self._env.open_db(b'objects')
+        self._max_key = self._env.max_key_size()
+        self._s3 = s3
+        self.ttl = ttl
+        self.full_ttl = full_ttl
+        self.append_only = append_only
+
+    def close(self):
+        self._env.close()
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            self._s3 = make_s3_client()
+        return self._s3
+
+    def _write(self, body, db):
+        while True:
+            try:
+                with self._env.begin(db, write=True) as tr:
+                    return body(tr)
+            except lmdb.MapFullError:
+                self._env.set_mapsize(self._env.info()['map_size']*MAP_GROWTH_FACTOR)
+
+    def _obj_key(self, bucket, key):
+        k = (bucket + '/' + key).encode('utf8')
+        if len(k) <= self._max_key:
+            return k, False
+        return k[:self._max_key - 21] + b'\x00' + hashlib.sha1(k).digest(), True
+
+    @staticmethod
+    def _decode(n_skip, k, v):
+        """ -> (key, size, etag) """
+        v = json.loads(v.decode('utf8'))
+        key = v[2] if len(v) > 2 else k[n_skip:].decode('utf8')
+        return key, v[0], v[1]
+
+    def _record(self, bucket, prefix):
+        with self._env.begin(self._prefixes) as tr:
+            v = tr.get((bucket + '/' + prefix).encode('utf8'))
+        return None if v is None else json.loads(v.decode('utf8'))
+
+    def _put_record(self, bucket, prefix, rec):
+        k, v = (bucket + '/' + prefix).encode('utf8'), json.dumps(rec).encode('utf8')
+        self._write(lambda tr: tr.put(k, v), self._prefixes)
+
+    def _is_fresh(self, rec, now):
+        return rec is not None and rec['complete'] and (now - rec['t']) < self.ttl
+
+    def _fresh_source(self, bucket, prefix, now):
+        """ Prefix with a fresh listing covering `prefix`, None if there isn't one """
+        for p in [prefix] + _ancestors(prefix):
+            if self._is_fresh(self._record(bucket, p), now):
+                return p
+        return None
+
+    def _start_over(self, bucket, prefix, rec):
+        """Save `rec` for a listing about to be fetched from scratch, before
+        its objects are deleted.
+
+        Listings of sub-prefixes share the objects and are forgotten. Fresh
+        listings of parent prefixes are marked stale, as they would be
+        missing objects if fetching fails part way.
+
+        :returns: {parent_prefix: t} to restore once the listing is complete
+        """
+        start = (bucket + '/' + prefix).encode('utf8')
+
+        def body(tr):
+            cur = tr.cursor()
+            if cur.set_range(start):
+                while cur.key().startswith(start):
+                    if not cur.delete():
+                        break
+
+            parents = {}
+            for p in _ancestors(prefix):
+                k = (bucket + '/' + p).encode('utf8')
+                v = tr.get(k)
+                if v is None:
+                    continue
+                r = json.loads(v.decode('utf8'))
+                if r['complete'] and r['t'] > 0:
+                    parents[p] = r['t']
+                    tr.put(k, json.dumps(dict(r, t=0)).encode('utf8'))
+
+            tr.put(start, json.dumps(rec).encode('utf8'))
+            return parents
+
+        return self._write(body, self._prefixes)
+
+    def _restore_parents(self, bucket, parents):
+        def body(tr):
+            for p, t in parents.items():
+                k = (bucket + '/' + p).encode('utf8')
+                v = tr.get(k)
+                if v is not None:
+                    r = json.loads(v.decode('utf8'))
+                    if r['t'] == 0:
+                        tr.put(k, json.dumps(dict(r, t=t)).encode('utf8'))
+
+        self._write(body, self._prefixes)
+
+    def _delete_range(self, bucket, prefix):
+        start = (bucket + '/' + prefix).encode('utf8')
+
+        def body(tr):
+            n = 0
+            cur = tr.cursor()
+            if not cur.set_range(start):
+                return 0
+            while n < BATCH_SIZE and cur.key().startswith(start):
+                cur.delete()
+                n += 1
+            return n
+
+        while self._write(body, self._objects) == BATCH_SIZE:
+            pass
+
+    def _save(self, bucket, objects):
+        items = []
+        for o in objects:
+            k, is_long = self._obj_key(bucket, o['Key'])
+            v = [o['Size'], o['ETag']] + ([o['Key']] if is_long else [])
+            items.append((k, json.dumps(v).encode('utf8')))
+
+        def body(tr):
+            for k, v in items:
+                tr.put(k, v)
+
+        self._write(body, self._objects)
+
+    def refresh(self, url, append_only=None, force=False):
+        """Bring listing of `url` up to date with S3, unless it's still fresh.
+
+        :param append_only: Only fetch keys after the last one seen, defaults to `self.append_only`
+        :param force: Refresh even if listing is fresh, with `append_only=False` fetch from scratch
+        :returns: Prefix record: {t, t_full, last_key, count, complete}
+        """
+        bucket, prefix = s3_url_parse(url)
+        if append_only is None:
+            append_only = self.append_only
+
+        now = time.time()
+        rec = self._record(bucket, prefix)
+        if not force and self._is_fresh(rec, now):
+            return rec
+
+        incremental = (append_only
+                       and rec is not None
+                       and rec['complete']
+                       and (self.full_ttl is None or (now - rec['t_full']) < self.full_ttl))
+
+        parents = {}
+        if incremental:
+            # Progress is saved as we go, so an interrupted refresh can be
+            # resumed, but the listing is not fresh until paging completes
+            rec = dict(rec, t=0)
+        else:
+            rec = dict(t=now, t_full=now, last_key=None, count=0, complete=False)
+            parents = self._start_over(bucket, prefix, rec)
+            self._delete_range(bucket, prefix)
+
+        kw = dict(Bucket=bucket, Prefix=prefix)
+        if rec['last_key'] is not None:
+            kw['StartAfter'] = rec['last_key']
+
+        paginator = self.s3.get_paginator('list_objects_v2')
+        batch = []
+
+        def flush():
+            self._save(bucket, batch)
+            rec['count'] += len(batch)
+            rec['last_key'] = batch[-1]['Key']
+            if incremental:
+                # everything up to last_key is on disk, safe to resume from here
+                self._put_record(bucket, prefix, rec)
+
+        for page in paginator.paginate(**kw):
+            batch.extend(page.get('Contents', []))
+            if len(batch) >= BATCH_SIZE:
+                flush()
+                batch = []
+
+        if batch:
+            flush()
+
+        rec['complete'] = True
+        rec['t'] = now
+        self._put_record(bucket, prefix, rec)
+        if parents:
+            self._restore_parents(bucket, parents)
+        return rec
+
+    def invalidate(self, url):
+        """ Forget listing of `url`, next access will fetch it from scratch """
+        bucket, prefix = s3_url_parse(url)
+        start = (bucket + '/' + prefix).encode('utf8')
+
+        def body(tr):
+            # sub-prefix listings share the objects being deleted
+            cur = tr.cursor()
+            if cur.set_range(start):
+                while cur.key().startswith(start):
+                    if not cur.delete():
+                        break
+
+            # parent listings would be missing objects
+            for p in _ancestors(prefix):
+                tr.delete((bucket + '/' + p).encode('utf8'))
+
+        self._write(body, self._prefixes)
+        self._delete_range(bucket, prefix)
+
+    def _scan(self, start):
+        """ Stream (k, v) from objects db with k starting with `start`, BATCH_SIZE per transaction """
+        pos = start
+        while True:
+            with self._env.begin(self._objects) as tr:
+                cur = tr.cursor()
+                if not cur.set_range(pos):
+                    return
+                chunk = []
+                for k, v in cur:
+                    if not k.startswith(start):
+                        break
+                    chunk.append((k, v))
+                    if len(chunk) == BATCH_SIZE:
+                        break
+
+            yield from chunk
+            if len(chunk) < BATCH_SIZE:
+                return
+            pos = chunk[-1][0] + b'\x00'
+
+    def _ensure(self, url, append_only):
+        bucket, prefix = s3_url_parse(url)
+        if self._fresh_source(bucket, prefix, time.time()) is None:
+            self.refresh(url, append_only=append_only)
+        return bucket, prefix
+
+    def objects(self, url, append_only=None):
+        """ Stream (key, size, etag) for every object under `url`, refreshing the listing if needed """
+        bucket, prefix = self._ensure(url, append_only)
+        n_skip = len(bucket) + 1
+
+        for k, v in self._scan((bucket + '/' + prefix).encode('utf8')):
+            yield self._decode(n_skip, k, v)
+
+    def ls(self, url, append_only=None):
+        """ Same output as `s3_ls` """
+        _, prefix = s3_url_parse(url)
+        n_skip = len(prefix)
+        for key, _, _ in self.objects(url, append_only=append_only):
+            yield key[n_skip:]
+
+    def ls_dir(self, uri, append_only=None):
+        """Same output as `s3_ls_dir`, but in key order.
+
+        Note that the whole of `uri` is listed (recursively) on first access.
+        """
+        bucket, prefix = s3_url_parse(uri)
+        if prefix:
+            prefix = prefix.rstrip('/') + '/'
+        uri = 's3://{}/{}'.format(bucket, prefix)
+        self._ensure(uri, append_only)
+
+        n_skip = len(bucket) + 1
+        start = (bucket + '/' + prefix).encode('utf8')
+        pos = start
+
+        while True:
+            out = []
+            with self._env.begin(self._objects) as tr:
+                cur = tr.cursor()
+                while len(out) < BATCH_SIZE and cur.set_range(pos) and cur.key().startswith(start):
+                    key, _, _ = self._decode(n_skip, cur.key(), cur.value())
+                    rest = key[len(prefix):]
+                    if '/' in rest:
+                        sub_dir = prefix + rest[:rest.index('/') + 1]
+                        out.append('s3://{}/{}'.format(bucket, sub_dir))
+                        # '0' sorts right after '/', skip the rest of sub-directory
+                        pos = (bucket + '/' + sub_dir[:-1] + '0').encode('utf8')
+                    else:
+                        out.append('s3://{}/{}'.format(bucket, key))
+                        pos = cur.key() + b'\x00'
+
+            yield from out
+            if len(out) < BATCH_SIZE:
+                return
@@ -43,18 +43,22 @@ def auto_find_region():
 def make_s3_client(region_name=None,
                    max_pool_connections=32,
                    session=None,
-                   use_ssl=True):
+                   use_ssl=True,
+                   endpoint_url=None):
     if region_name is None:
         region_name = auto_find_region()
 
     protocol = 'https' if use_ssl else 'http'
 
+    if endpoint_url is None:
+        endpoint_url = '{}://s3.{}.amazonaws.com'.format(protocol, region_name)
+
     if session is None:
         session = botocore.session.get_session()
 
     s3 = session.create_client('s3',
                                region_name=region_name,
-                               endpoint_url='{}://s3.{}.amazonaws.com'.format(protocol, region_name),
+                               endpoint_url=endpoint_url,
                                config=botocore.client.Config(max_pool_connections=max_pool_connections))
     return s3
 
@@ -76,9 +80,17 @@ def s3_ls(url, s3=None):
             yield o['Key'][n_skip:]
 
 
-def s3_ls_dir(uri, s3=None):
+def s3_ls_dir(uri, s3=None, listing_cache=None):
+    """
+    listing_cache -- Optional `S3ListingCache` to serve listing from
+    """
+    if listing_cache is not None:
+        yield from listing_cache.ls_dir(uri)
+        return
+
     bucket, prefix = s3_url_parse(uri)
-    prefix = prefix.rstrip('/') + '/'
+    if prefix:  # empty prefix is the root of the bucket
+        prefix = prefix.rstrip('/') + '/'
 
     s3 = s3 or make_s3_client()
     paginator = s3.get_paginator('list_objects_v2')
@@ -100,10 +112,12 @@ def s3_fancy_ls(url, sort=True,
                 random_prefix_length=None,
                 absolute=False,
                 predicate=None,
-                s3=None):
+                s3=None,
+                listing_cache=None):
     """
     predicate -- None| str -> Bool | regex string
     random_prefix_length int -- number of characters to skip for sorting: fh4e6_0, ahfe8_1 ... 00aa3_9, if =6
+    listing_cache -- Optional `S3ListingCache` to serve listing from
     """
     def get_sorter():
         if random_prefix_length is None:
@@ -125,7 +139,10 @@ def s3_fancy_ls(url, sort=True,
     if url[-1] != '/':
         url += '/'
 
-    names = s3_ls(url, s3=s3)
+    if listing_cache is not None:
+        names = listing_cache.ls(url)
+    else:
+        names = s3_ls(url, s3=s3)
 
     if predicate:
         names = [n for n in names if predicate(n)]
@@ -139,6 +156,230 @@ def s3_fancy_ls(url, sort=True,
     return names
 
 
+def _regex_literal_prefix(pattern):
+    """ Leading part of a regex that any match has to start with, '' if not obvious """
+    special = set('.^$*+?{}[]\\|()')
+    out = []
+    for i, c in enumerate(pattern):
+        if c in special:
+            if c in '*?{' and out:
+                out.pop()  # previous character is optional
+            break
+        out.append(c)
+    if '|' in pattern:
+        return ''
+    return ''.join(out)
+
+
+def _normalise_predicates(predicate, prefix_predicate):
+    """ Returns (name -> Bool | None, relative_prefix -> Bool | None) """
+    if isinstance(predicate, str):
+        regex = re.compile(predicate)
+        literal = _regex_literal_prefix(predicate)
+
+        if prefix_predicate is None and literal:
+            def prefix_predicate(p):
+                return p.startswith(literal) or literal.startswith(p)
+
+        def predicate(s, regex=regex):
+            return regex.match(s) is not None
+
+    return predicate, prefix_predicate
+
+
+def s3_discover_prefixes(url, depth=1, s3=None, prefix_predicate=None, pool=None):
+    """Walk `depth` levels of "sub-directories" under `url` using `s3_ls_dir`.
+
+    :param prefix_predicate: Optional relative_prefix -> Bool, sub-directories it
+                             rejects are not walked into
+    :param pool: Optional ThreadPoolExecutor, to list several directories at once
+    :returns: (prefixes, files) urls of sub-directories `depth` levels down and of
+              files found on the way there
+    """
+    s3 = s3 or make_s3_client()
+    if url[-1] != '/':
+        url += '/'
+
+    n_skip = len(url)
+    dirs, files = [url], []
+    _map = map if pool is None else pool.map
+
+    for _ in range(depth):
+        next_dirs = []
+        for names in _map(lambda u: list(s3_ls_dir(u, s3=s3)), dirs):
+            for name in names:
+                if name.endswith('/'):
+                    if prefix_predicate is None or prefix_predicate(name[n_skip:]):
+                        next_dirs.append(name)
+                else:
+                    files.append(name)
+        dirs = next_dirs
+
+    return dirs, files
+
+
+def _external_sort(names, key=None, chunk_size=1000000, tmpdir=None):
+    """Sort a stream of strings, spilling sorted runs of `chunk_size` to temporary
+    files and merging them, so memory use is bounded by `chunk_size`.
+
+    Strings must not contain new lines.
+    """
+    import heapq
+    import tempfile
+
+    runs = []
+
+    def spill(chunk):
+        f = tempfile.TemporaryFile('w+t', dir=tmpdir)
+        for name in sorted(chunk, key=key):
+            f.write(name)
+            f.write('\n')
+        f.seek(0)
+        runs.append(f)
+
+    try:
+        for chunk in _chunked(names, chunk_size):
+            if not runs and len(chunk) < chunk_size:
+                yield from sorted(chunk, key=key)
+                return
+            spill(chunk)
+
+        yield from heapq.merge(*[(line[:-1] for line in f) for f in runs], key=key)
+    finally:
+        for f in runs:
+            f.close()
+
+
+def _chunked(it, n):
+    it = iter(it)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+
+def s3_ls_parallel(url,
+                   depth=1,
+                   nthreads=16,
+                   predicate=None,
+                   prefix_predicate=None,
+                   sort=False,
+                   random_prefix_length=None,
+                   absolute=False,
+                   sort_chunk_size=1000000,
+                   tmpdir=None,
+                   max_pages=None,
+                   s3=None):
+    """Stream names under `url`, listing many prefixes concurrently.
+
+    "Sub-directories" `depth` levels below `url` are found with `s3_ls_dir`,
+    then each one is paged through on one of `nthreads` threads. Names are
+    relative to `url` (same as `s3_fancy_ls`) and are yielded as pages arrive,
+    in no particular order, unless `sort=True`.
+
+    predicate -- None| str -> Bool | regex string, applied on the worker threads.
+                 For regex strings the literal leading part is also used to skip
+                 sub-directories that can not match.
+    prefix_predicate -- None| relative_prefix -> Bool, sub-directories to list
+    sort -- sort output, runs larger than `sort_chunk_size` are spilled to
+            temporary files in `tmpdir` and merged
+    random_prefix_length int -- see `s3_fancy_ls`
+    max_pages int -- limit on pages buffered between workers and the consumer,
+                     defaults to 2*nthreads
+    """
+    import queue
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    if url[-1] != '/':
+        url += '/'
+
+    if sort:
+        names = s3_ls_parallel(url, depth=depth, nthreads=nthreads,
+                               predicate=predicate,
+                               prefix_predicate=prefix_predicate,
+                               max_pages=max_pages,
+                               s3=s3)
+        key = None if random_prefix_length is None else (lambda s: s[random_prefix_length:])
+        names = _external_sort(names, key=key, chunk_size=sort_chunk_size, tmpdir=tmpdir)
+        if absolute:
+            names = (url + name for name in names)
+        yield from names
+        return
+
+    predicate, prefix_predicate = _normalise_predicates(predicate, prefix_predicate)
+    s3 = s3 or make_s3_client(max_pool_connections=nthreads)
+    bucket, url_prefix = s3_url_parse(url)
+    n_skip = len(url)
+    n_key_skip = len(url_prefix)
+
+    if max_pages is None:
+        max_pages = 2*nthreads
+
+    pages = queue.Queue(max_pages)
+    abort = threading.Event()
+    done_marker = object()
+
+    def put(item):
+        while not abort.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def list_one(prefix_url):
+        try:
+            if abort.is_set():
+                return
+            _, prefix = s3_url_parse(prefix_url)
+            paginator = s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                names = [o['Key'][n_key_skip:] for o in page.get('Contents', [])]
+                if predicate is not None:
+                    names = [n for n in names if predicate(n)]
+                if names and not put(names):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(done_marker)
+
+    futures = []
+
+    with ThreadPoolExecutor(nthreads) as pool:
+        try:
+            prefixes, files = s3_discover_prefixes(url, depth=depth, s3=s3,
+                                                   prefix_predicate=prefix_predicate,
+                                                   pool=pool)
+
+            files = [name[n_skip:] for name in files]
+            if predicate is not None:
+                files = [n for n in files if predicate(n)]
+            for name in files:
+                yield url + name if absolute else name
+
+            futures = [pool.submit(list_one, p) for p in prefixes]
+
+            n_running = len(prefixes)
+            while n_running > 0:
+                item = pages.get()
+                if item is done_marker:
+                    n_running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    for name in item:
+                        yield url + name if absolute else name
+        finally:
+            abort.set()
+            # don't make requests for prefixes nobody is waiting for
+            for f in futures:
+                f.cancel()
+
+
 def get_boto3_session(region_name=None, cache=None):
     import boto3
 
@@ -169,7 +410,7 @@ def s3_fetch(url, s3=None, **kwargs):
     return oo['Body'].read()
 
 
-def s3_get_object_request_maker(region_name=None, credentials=None, ssl=True):
+def s3_get_object_request_maker(region_name=None, credentials=None, ssl=True, endpoint_url=None):
     from botocore.session import get_session
     from botocore.auth import S3SigV4Auth
     from botocore.awsrequest import AWSRequest
@@ -186,6 +427,10 @@ def s3_get_object_request_maker(region_name=None, credentials=None, ssl=True):
     protocol = 'https' if ssl else 'http'
     auth = S3SigV4Auth(credentials, 's3', region_name)
 
+    if endpoint_url is None:
+        endpoint_url = '{}://s3.{}.amazonaws.com'.format(protocol, region_name)
+    endpoint_url = endpoint_url.rstrip('/')
+
     def build_request(bucket=None,
                       key=None,
                       url=None,
@@ -207,7 +452,7 @@ def s3_get_object_request_maker(region_name=None, credentials=None, ssl=True):
             headers['Range'] = Range
 
         req = AWSRequest(method='GET',
-                         url='{}://s3.{}.amazonaws.com/{}/{}'.format(protocol, region_name, bucket, key),
+                         url='{}/{}/{}'.format(endpoint_url, bucket, key),
                          headers=headers)
 
         auth.add_auth(req)
@@ -217,3 +462,44 @@ def s3_get_object_request_maker(region_name=None, credentials=None, ssl=True):
                        method='GET')
 
     return build_request
+
+
+def _mk_fake_s3(keys, calls):
+    """ Enough of an s3 client for the listing functions, pages hold one key each """
+    from types import SimpleNamespace
+
+    def paginate(Bucket, Prefix='', Delimiter=None, **kwargs):
+        calls.append(Prefix)
+        dirs = set()
+        for k in sorted(keys):
+            if not k.startswith(Prefix):
+                continue
+            rest = k[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                d = Prefix + rest.split(Delimiter)[0] + Delimiter
+                if d not in dirs:
+                    dirs.add(d)
+                    yield dict(CommonPrefixes=[dict(Prefix=d)])
+            else:
+                yield dict(Contents=[dict(Key=k)])
+
+    paginator = SimpleNamespace(paginate=paginate)
+    return SimpleNamespace(get_paginator=lambda name: paginator)
+
+
+def test_s3_ls_parallel():
+    keys = ['a/1', 'a/2', 'b/c/3', 'top'] + ['d{:02d}/x'.format(i) for i in range(20)]
+    calls = []
+    s3 = _mk_fake_s3(keys, calls)
+
+    assert sorted(s3_ls_dir('s3://bkt/', s3=s3))[:3] == ['s3://bkt/a/', 's3://bkt/b/', 's3://bkt/d00/']
+    assert sorted(s3_ls_parallel('s3://bkt/', s3=s3, nthreads=2)) == sorted(keys)
+    assert sorted(s3_ls_parallel('s3://bkt', depth=2, s3=s3, sort=True)) == sorted(keys)
+    assert list(s3_ls_parallel('s3://bkt/a', s3=s3)) == ['1', '2']
+
+    # closing the stream early doesn't list the remaining prefixes
+    calls.clear()
+    names = s3_ls_parallel('s3://bkt/', s3=s3, nthreads=1, max_pages=1)
+    next(names)
+    names.close()
+    assert len(calls) < 5
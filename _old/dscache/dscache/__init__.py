@@ -1,15 +1,27 @@
 from .dscache import (ds2bytes,
+                      LazyDoc,
                       DatasetCache,
                       key_to_bytes,
+                      key_ranges,
                       train_dictionary,
+                      train_product_dictionaries,
                       create_cache,
                       open_rw,
                       open_ro)
+from .sharded import (ShardedCache,
+                      create_sharded_cache,
+                      open_sharded)
 
 __all__ = ['ds2bytes',
+           'LazyDoc',
            'create_cache',
            'open_ro',
            'open_rw',
            'DatasetCache',
            'key_to_bytes',
-           'train_dictionary']
+           'key_ranges',
+           'train_dictionary',
+           'train_product_dictionaries',
+           'ShardedCache',
+           'create_sharded_cache',
+           'open_sharded']
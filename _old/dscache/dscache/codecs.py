@@ -0,0 +1,86 @@
+"""
+Document serialisation formats supported by dscache.
+
+Codec is chosen when cache is created and recorded in the `info` database,
+`json` is the default. Binary codecs need optional dependencies:
+
+- msgpack: `pip install msgpack`
+- cbor: `pip install cbor2`
+"""
+import json
+from types import SimpleNamespace
+
+DEFAULT_CODEC = 'json'
+
+
+def _json():
+    def dumps(doc):
+        return json.dumps(doc, separators=(',', ':')).encode('utf8')
+
+    def loads(data):
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return json.loads(data)
+
+    return dumps, loads
+
+
+def _msgpack():
+    import msgpack
+
+    def dumps(doc):
+        return msgpack.packb(doc, use_bin_type=True)
+
+    def loads(data):
+        return msgpack.unpackb(data, raw=False)
+
+    return dumps, loads
+
+
+def _cbor():
+    import cbor2
+
+    def loads(data):
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return cbor2.loads(data)
+
+    return cbor2.dumps, loads
+
+
+_FACTORIES = dict(json=_json,
+                  msgpack=_msgpack,
+                  cbor=_cbor)
+_CACHE = {}
+
+
+def available_codecs():
+    return list(_FACTORIES)
+
+
+def get_codec(name=None):
+    """Lookup codec by name.
+
+    :returns: SimpleNamespace(name=str, dumps=doc->bytes, loads=bytes->doc)
+    """
+    if name is None:
+        name = DEFAULT_CODEC
+    if isinstance(name, bytes):
+        name = name.decode('utf8')
+
+    codec = _CACHE.get(name)
+    if codec is not None:
+        return codec
+
+    factory = _FACTORIES.get(name)
+    if factory is None:
+        raise ValueError('Unknown codec: {}, expect one of {}'.format(name, ', '.join(_FACTORIES)))
+
+    try:
+        dumps, loads = factory()
+    except ImportError as e:
+        raise ValueError('Codec {} needs extra dependencies: {}'.format(name, str(e)))
+
+    codec = SimpleNamespace(name=name, dumps=dumps, loads=loads)
+    _CACHE[name] = codec
+    return codec
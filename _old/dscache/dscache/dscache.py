@@ -1,16 +1,46 @@
 from uuid import UUID
+from collections.abc import MutableMapping
 import json
+import re
 import lmdb
 import zstandard
 import operator
 import functools
 import itertools
 import toolz
+import numpy as np
 from types import SimpleNamespace
 from pathlib import Path
-from datacube.model import Dataset
+from .parallel import pmap_stream
+from .codecs import get_codec, available_codecs, DEFAULT_CODEC
+from .lru import LRU
 
-FORMAT_VERSION = b'0001'
+FORMAT_VERSION = b'0003'
+# 0001 -- single optional zstd dictionary
+# 0002 -- adds optional per product dictionaries
+# 0003 -- adds document codec field, json when missing
+SUPPORTED_VERSIONS = (b'0001', b'0002', FORMAT_VERSION)
+
+# Per dataset record of the extents index: lon/lat bounding box, time range
+# and index of the product, all as float64, NaN when not known.
+EXTENT_DTYPE = np.dtype([('id', 'V16'),
+                         ('lon', '<f8', (2,)),
+                         ('lat', '<f8', (2,)),
+                         ('time', '<f8', (2,)),
+                         ('product', '<f8')])
+EXTENT_CHUNK_SZ = 1 << 16
+
+# Raw 16 bytes of uuid, sorts in the same order as keys in the database
+UUID_DTYPE = np.dtype('V16')
+
+# Memory map is grown by this factor when database runs out of space
+MAP_GROWTH_FACTOR = 2
+
+# Initial memory map size for writers
+DEFAULT_MAP_SIZE = 1 << 30
+
+# Rough per document memory overhead of decoded python objects, used by LRU
+LRU_ITEM_OVERHEAD = 2048
 
 
 def key_to_bytes(k):
@@ -29,20 +59,84 @@ def key_to_bytes(k):
             return str(k).decode('utf8')
     if isinstance(k, tuple):
         return functools.reduce(operator.add, map(key_to_bytes, k))
+    if isinstance(k, np.void):
+        return k.tobytes()
 
     raise ValueError('Key must be one of str|bytes|int|UUID|tuple')
 
 
 def uuids2bytes(uu):
-    bb = bytearray(len(uu)*16)
-    for i, u in enumerate(uu):
-        bb[i*16:(i+1)*16] = u.bytes
-    return bytes(bb)
+    """ Sequence of UUID|str|bytes or numpy array of UUID_DTYPE -> bytes """
+    if isinstance(uu, np.ndarray):
+        return np.ascontiguousarray(uu, dtype=UUID_DTYPE).tobytes()
+
+    def to_bytes(u):
+        if isinstance(u, str):
+            u = UUID(u)
+        return key_to_bytes(u)
+
+    return b''.join(map(to_bytes, uu))
+
+
+def bytes2uuid_array(bb):
+    """ bytes -> numpy array of UUID_DTYPE, no copy is made """
+    if len(bb) & 0xF:
+        raise ValueError('Expect multiple of 16 bytes')
+    return np.frombuffer(bb, dtype=UUID_DTYPE)
+
+
+def uuid_array(uu):
+    """ Sequence of UUID|str|bytes -> sorted numpy array of unique UUID_DTYPE """
+    if not isinstance(uu, np.ndarray):
+        uu = bytes2uuid_array(uuids2bytes(uu))
+    return np.unique(uu)
+
+
+def key_ranges(n):
+    """Split uuid keyspace into `n` equal ranges.
+
+    :returns: [(start: bytes|None, stop: bytes|None)], see `DatasetCache.get_range`
+    """
+    edges = [None] + [(i*(1 << 128)//n).to_bytes(16, 'big') for i in range(1, n)] + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _sorted_isin(a, b):
+    """ Like `np.isin(a, b)` for sorted arrays of unique values, avoids re-sorting.
+    """
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros(len(a), dtype='bool')
+
+    idx = np.searchsorted(b, a)
+    idx[idx == len(b)] = 0
+    return b[idx] == a
+
+
+def uuids_union(a, b):
+    """ Union of two sorted uuid arrays, result is sorted """
+    extra = b[~_sorted_isin(b, a)]
+    return np.insert(a, np.searchsorted(a, extra), extra)
+
+
+def uuids_intersection(a, b):
+    """ Intersection of two sorted uuid arrays, result is sorted """
+    if len(a) > len(b):
+        a, b = b, a
+    return a[_sorted_isin(a, b)]
+
+
+def uuids_difference(a, b):
+    """ Ids from sorted uuid array `a` that are not in sorted array `b` """
+    return a[~_sorted_isin(a, b)]
 
 
 def bytes2uuids(bb):
-    n = len(bb)//16
-    return [UUID(bytes=bb[i*16:(i+1)*16]) for i in range(n)]
+    if isinstance(bb, np.ndarray):
+        bb = bb.tolist()
+    else:
+        bb = bytes2uuid_array(bb).tolist()
+
+    return [UUID(bytes=b) for b in bb]
 
 
 def prefix_visit(tr, prefix):
@@ -79,18 +173,18 @@ def jsonKV2dict(kv, decompressor=None):
     return {k: doc for k, doc in map(decode, kv)}
 
 
-def ds2bytes(ds):
+def ds2bytes(ds, codec=None):
     k = key_to_bytes(ds.id)
 
     doc = dict(uris=ds.uris,
                product=ds.type.name,
                metadata=ds.metadata_doc)
 
-    d = json.dumps(doc, separators=(',', ':')).encode('utf8')
+    d = get_codec(codec).dumps(doc)
     return (k, d)
 
 
-def doc2bytes(raw_ds):
+def doc2bytes(raw_ds, codec=None):
     ''' raw_ds is
 
         metadata:
@@ -98,19 +192,306 @@ def doc2bytes(raw_ds):
           * other fields*
         uris: [<uri:string>]
         product: <string>
+
+    :codec: Name of the serialisation format, see `dscache.codecs`, defaults to json
     '''
     k = UUID(toolz.get_in(['metadata', 'id'], raw_ds)).bytes
-    d = json.dumps(raw_ds, separators=(',', ':')).encode('utf8')
+    d = get_codec(codec).dumps(raw_ds)
     return (k, d)
 
 
+def mk_zdict(zdict):
+    return zstandard.ZstdCompressionDict(zdict) if zdict else None
+
+
+class DocDecoder(object):
+    """ Turns stored values back into json documents.
+
+    Can be pickled and sent to worker processes, zstd decompressors are
+    re-created on first use after unpickling.
+
+    When per product dictionaries are present, dictionary is chosen based on
+    the dictionary id recorded in the zstd frame header, values compressed with
+    default dictionary (or without one) use default decompressor.
+    """
+    def __init__(self, zdict=None, zdicts=None, codec=None):
+        self._zdict = zdict
+        self._zdicts = zdicts
+        self._codec = codec or DEFAULT_CODEC
+        self._decomp = None
+        self._by_dict_id = None
+        self.loads = get_codec(self._codec).loads
+
+    def __getstate__(self):
+        return dict(zdict=self._zdict, zdicts=self._zdicts, codec=self._codec)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _setup(self):
+        def mk_decomp(zdict):
+            zdict = mk_zdict(zdict)
+            return zstandard.ZstdDecompressor(dict_data=zdict) if zdict else zstandard.ZstdDecompressor()
+
+        self._decomp = mk_decomp(self._zdict)
+        self._by_dict_id = {mk_zdict(zd).dict_id(): mk_decomp(zd)
+                            for zd in (self._zdicts or [])}
+
+    def decompress(self, d):
+        if self._decomp is None:
+            self._setup()
+
+        if self._by_dict_id:
+            dict_id = zstandard.get_frame_parameters(d).dict_id
+            return self._by_dict_id.get(dict_id, self._decomp).decompress(d)
+
+        return self._decomp.decompress(d)
+
+    def __call__(self, d):
+        return self.loads(self.decompress(d))
+
+    def decode_chunk(self, chunk):
+        """ [(key, value)] -> [(key, doc)] """
+        return [(k, self(d)) for k, d in chunk]
+
+    def decompress_chunk(self, chunk):
+        """ [(key, value)] -> [(key, bytes)] """
+        return [(k, self.decompress(d)) for k, d in chunk]
+
+
+class DocEncoder(object):
+    """ Turns json documents into stored values.
+
+    Like `DocDecoder` can be pickled and sent to worker processes,
+    compressors are re-created on first use after unpickling.
+    """
+    def __init__(self, zdict=None, zdicts=None, complevel=6, codec=None):
+        self._zdict = zdict
+        self._zdicts = zdicts or {}
+        self._complevel = complevel
+        self.codec = codec or DEFAULT_CODEC
+        self._comps = None
+
+    def __getstate__(self):
+        return dict(zdict=self._zdict,
+                    zdicts=self._zdicts,
+                    complevel=self._complevel,
+                    codec=self.codec)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def compressor(self, product=None):
+        """ Get compressor to use for a given product """
+        if self._comps is None:
+            def mk_comp(zdict):
+                zdict = mk_zdict(zdict)
+                params = {'dict_data': zdict} if zdict else {}
+                return zstandard.ZstdCompressor(level=self._complevel, **params)
+
+            self._comps = toolz.valmap(mk_comp, self._zdicts)
+            self._comps[None] = mk_comp(self._zdict)
+
+        return self._comps.get(product, self._comps[None])
+
+    def __call__(self, doc):
+        """ raw_ds -> (key, compressed value) """
+        k, d = doc2bytes(doc, self.codec)
+        return k, self.compressor(doc['product']).compress(d)
+
+    def encode_text(self, text):
+        """ json text of raw_ds -> (key, compressed value, raw_ds)
+
+        Text is always re-serialised, input might not be compact (jsonb::text
+        puts spaces after ':' and ','), and dictionaries are trained on
+        compact output of `doc2bytes`.
+        """
+        if isinstance(text, bytes):
+            text = text.decode('utf8')
+
+        doc = json.loads(text)
+        k, d = doc2bytes(doc, self.codec)
+        return k, self.compressor(doc['product']).compress(d), doc
+
+    def encode_chunk(self, chunk):
+        """ [(raw_ds, extent_fields, extra)] -> [(key, value, product, extent, extra)]
+
+        `raw_ds` can also be json text (bytes or str) of the document.
+        `extra` is passed through unchanged.
+        """
+        def encode(doc, fields, extra):
+            if isinstance(doc, (bytes, str)):
+                k, v, doc = self.encode_text(doc)
+            else:
+                k, v = self(doc)
+            return (k, v, doc['product'], doc_extent(doc['metadata'], fields), extra)
+
+        return [encode(*item) for item in chunk]
+
+
+def _decode_and_apply(decoder, proc, chunk):
+    return proc([decoder(d) for _, d in chunk])
+
+
 def doc2ds(doc, products):
+    from datacube.model import Dataset
+
     p = products.get(doc['product'], None)
     if p is None:
         raise ValueError('No product named: %s' % doc['product'])
     return Dataset(p, doc['metadata'], uris=doc['uris'])
 
 
+class LazyDoc(object):
+    """ Dataset document that is only parsed when fields are accessed.
+
+    Keeps decompressed bytes of the document, json is decoded on first access
+    to any of the document fields and `datacube.model.Dataset` is only
+    constructed when `.ds` is requested.
+    """
+    __slots__ = ('_raw', '_doc', '_key', '_products', '_loads')
+
+    def __init__(self, raw, key=None, products=None, loads=None):
+        self._raw = raw
+        self._doc = None
+        self._key = key
+        self._products = products
+        self._loads = loads or json.loads
+
+    @property
+    def raw(self):
+        """ Uncompressed document bytes, as encoded by the cache codec """
+        return self._raw
+
+    @property
+    def doc(self):
+        """ Parsed document: {product: str, uris: [str], metadata: object} """
+        if self._doc is None:
+            self._doc = self._loads(self._raw)
+        return self._doc
+
+    @property
+    def id(self):
+        if self._key is not None:
+            return UUID(bytes=self._key)
+        return UUID(self.metadata['id'])
+
+    @property
+    def product(self):
+        return self.doc['product']
+
+    @property
+    def uris(self):
+        return self.doc['uris']
+
+    @property
+    def metadata(self):
+        return self.doc['metadata']
+
+    @property
+    def metadata_doc(self):
+        """ Same as `metadata`, for compatibility with `datacube.model.Dataset` """
+        return self.metadata
+
+    def to_ds(self, products=None):
+        """ Construct `datacube.model.Dataset`
+
+        :products: Product map to use instead of the one from the cache
+        """
+        return doc2ds(self.doc, products or self._products)
+
+    @property
+    def ds(self):
+        return self.to_ds()
+
+    def __repr__(self):
+        return 'LazyDoc<id={}>'.format(self.id)
+
+
+_ISO_DT = re.compile(r'(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6})\d*)?)?)?'
+                     r'\s*(Z|[+-]\d\d:?\d\d)?$')
+
+
+def _iso_to_epoch(s):
+    """ Fast path for common ISO 8601 timestamps, returns None for anything else
+    """
+    from datetime import datetime, timezone
+
+    m = _ISO_DT.match(s)
+    if m is None:
+        return None
+
+    y, mo, d, hh, mm, ss, us, tz = m.groups()
+    t = datetime(int(y), int(mo), int(d),
+                 int(hh or 0), int(mm or 0), int(ss or 0),
+                 int(us.ljust(6, '0')) if us else 0,
+                 tzinfo=timezone.utc).timestamp()
+
+    if tz and tz != 'Z':
+        sign = -1 if tz[0] == '-' else 1
+        tz = tz[1:].replace(':', '')
+        t -= sign*(int(tz[:2])*3600 + int(tz[2:])*60)
+
+    return t
+
+
+def to_epoch(t):
+    """ Convert datetime|str|number to seconds since epoch, naive times are assumed UTC.
+    """
+    from datetime import datetime, timezone
+
+    if t is None:
+        return np.nan
+    if isinstance(t, (int, float)):
+        return float(t)
+    if isinstance(t, str):
+        ts = _iso_to_epoch(t)
+        if ts is not None:
+            return ts
+
+        from dateutil.parser import parse as parse_date
+        t = parse_date(t)
+    if isinstance(t, datetime):
+        if t.tzinfo is None:
+            t = t.replace(tzinfo=timezone.utc)
+        return t.timestamp()
+
+    raise ValueError('Not a valid time: {}'.format(t))
+
+
+def extent_fields(mdt_def):
+    """ Extract (lon, lat, time) search field definitions from metadata type definition.
+    """
+    ff = toolz.get_in(['dataset', 'search_fields'], mdt_def, default={})
+    return tuple(ff.get(n) for n in ('lon', 'lat', 'time'))
+
+
+def doc_extent(metadata, fields):
+    """ Compute (lon_min, lon_max, lat_min, lat_max, t_min, t_max) from a
+    metadata document, NaN is used for missing values.
+
+    :param metadata: Dataset metadata document
+    :param fields: (lon, lat, time) range field definitions, see `extent_fields`
+    """
+    def get_range(field, convert=float):
+        if field is None:
+            return (np.nan, np.nan)
+
+        def get(offsets, agg):
+            vv = [toolz.get_in(offset, metadata) for offset in offsets]
+            vv = [convert(v) for v in vv if v is not None]
+            return agg(vv) if vv else np.nan
+
+        return (get(field.get('min_offset', []), min),
+                get(field.get('max_offset', []), max))
+
+    lon, lat, time = fields
+    try:
+        return get_range(lon) + get_range(lat) + get_range(time, to_epoch)
+    except (ValueError, TypeError, OverflowError):
+        return (np.nan,)*6
+
+
 def save_products(products, transaction, compressor, overwrite=False):
     def get_metadata_definitions(products):
         mm = {}
@@ -148,31 +529,168 @@ def build_dc_product_map(metadata_json, products_json):
     return {k: mk_product(doc, k) for k, doc in products_json.items()}
 
 
-def train_dictionary(dss, dict_sz=8*1024):
+class LazyProductMap(MutableMapping):
+    """ {name: DatasetType} mapping that only decodes and constructs products
+    when they are first accessed.
+
+    Constructed from raw (compressed json) product and metadata type
+    definitions as stored in the `info` database.
+    """
+    def __init__(self, metadata_kv, products_kv, decompressor=None):
+        self._raw_metadata = dict(metadata_kv)
+        self._raw_products = dict(products_kv)
+        self._decompressor = decompressor
+        self._metadata = {}
+        self._products = {}
+
+    def _decode(self, data):
+        if self._decompressor is not None:
+            data = self._decompressor.decompress(data)
+        return json.loads(data)
+
+    def _metadata_type(self, name):
+        from datacube.model import metadata_from_doc
+
+        m = self._metadata.get(name)
+        if m is None:
+            data = self._raw_metadata.get(name)
+            if data is None:
+                return None
+            m = self._metadata[name] = metadata_from_doc(self._decode(data))
+        return m
+
+    def _build(self, name):
+        from datacube.model import DatasetType
+
+        doc = self._decode(self._raw_products[name])
+        mt = doc.get('metadata_type')
+        if mt is None:
+            raise ValueError('Missing metadata_type key in product definition')
+
+        metadata = self._metadata_type(mt)
+        if metadata is None:
+            raise ValueError('No such metadata %s for product %s' % (mt, name))
+
+        return DatasetType(metadata, doc)
+
+    def __getitem__(self, name):
+        p = self._products.get(name)
+        if p is None:
+            if name not in self._raw_products:
+                raise KeyError(name)
+            p = self._products[name] = self._build(name)
+        return p
+
+    def __setitem__(self, name, product):
+        self._products[name] = product
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self._products.pop(name, None)
+        self._raw_products.pop(name, None)
+
+    def __contains__(self, name):
+        return name in self._products or name in self._raw_products
+
+    def __iter__(self):
+        yield from self._products
+        for name in self._raw_products:
+            if name not in self._products:
+                yield name
+
+    def __len__(self):
+        return len(set(self._products) | set(self._raw_products))
+
+    def materialised(self):
+        """ Products that were constructed or added so far """
+        return dict(self._products)
+
+    def raw_docs(self):
+        """ Product and metadata type definitions as json text, without
+        constructing any products.
+
+        :returns: ({metadata_name: bytes}, {product_name: bytes})
+        """
+        def encode(doc):
+            return json.dumps(doc, separators=(',', ':')).encode('utf8')
+
+        def decompress(data):
+            if self._decompressor is not None:
+                data = self._decompressor.decompress(data)
+            return bytes(data)
+
+        metadata = toolz.valmap(decompress, self._raw_metadata)
+        products = toolz.valmap(decompress, self._raw_products)
+
+        for name, p in self._products.items():
+            products[name] = encode(p.definition)
+            metadata.setdefault(p.metadata_type.name, encode(p.metadata_type.definition))
+
+        return metadata, products
+
+
+def train_dictionary(dss, dict_sz=8*1024, codec=None):
     def to_bytes(o):
         if isinstance(o, dict):
-            _, d = doc2bytes(o)
+            _, d = doc2bytes(o, codec)
         else:
-            _, d = ds2bytes(o)
+            _, d = ds2bytes(o, codec)
         return d
 
     sample = list(map(to_bytes, dss))
     return zstandard.train_dictionary(dict_sz, sample).as_bytes()
 
 
+def train_product_dictionaries(dss, dict_sz=8*1024, codec=None):
+    """Train one compression dictionary per product.
+
+    :dss: Sample of datasets or raw documents covering all products of interest
+    :returns: {product_name: zdict}
+    """
+    def product_name(o):
+        return o['product'] if isinstance(o, dict) else o.type.name
+
+    return {p: train_dictionary(sample, dict_sz, codec)
+            for p, sample in toolz.groupby(product_name, dss).items()}
+
+
 class DatasetCache(object):
     """
     info:
        version: 4-bytes
        zdict: pre-trained compression dictionary, optional
+       zdict/{product}: per product compression dictionary, optional (0002+)
+       codec: document serialisation format, json when missing (0003+)
+       groups/codec: `zstd` when group data is compressed, missing otherwise
+       groups/format: `sorted` when all groups are sorted and free of duplicates,
+                      older files may have unsorted groups
        product/{name}: json
        metadata/{name}: json
 
+       extents/products: json list of product names, position is product id
+       extents/complete: present when every dataset has a record in `extents`,
+                         missing for files written before extents were recorded
+       extents/ids: present once `extent_ids` covers all of `extents`
+       groups/members: present once `group_members` covers all of `groups`
+
+    groups:
+       name: sorted uuids as concatenated 16 bytes, optionally compressed
+
     udata:
-       arbitrary user data (TODO)
+       arbitrary user data, see `put_udata`/`get_udata`
+
+    extents:
+       chunk_idx(4-bytes): packed array of EXTENT_DTYPE records
+
+    extent_ids:
+       uuid: chunk_idx(4-bytes) of the extents record for this dataset
+
+    group_members (dupsort):
+       uuid: names of groups dataset belongs to
 
     ds:
-       uuid: compressed(json({product: str,
+       uuid: compressed(codec({product: str,
                               uris: [str],
                               metadata: object}))
     """
@@ -181,13 +699,27 @@ class DatasetCache(object):
         """
 
         self._dbs = state.dbs
-        self._comp = state.comp
-        self._decomp = state.decomp
+        self._encoder = state.encoder
+        self._group_comp = state.group_comp
+        self._groups_sorted = state.groups_sorted
+        self._decoder = state.decoder
         self._products = state.products
+        self._product_ids = {n: i for i, n in enumerate(state.product_ids)}
+        self._extents_complete = state.extents_complete
+        self._extent_fields = {}
+        self._extents_pending = []
+        self._groupers = []
+        self._groups_pending = {}
+        self._lru = None
 
     def _store_products(self):
-        with self._dbs.main.begin(self._dbs.info, write=True) as tr:
-            save_products(self._products, tr, self._comp)
+        products = self._products
+        if isinstance(products, LazyProductMap):
+            # products that were never accessed are already on disk
+            products = products.materialised()
+
+        self._write(lambda tr: save_products(products, tr, self._encoder.compressor()),
+                    db=self._dbs.info)
 
     def sync(self):
         if not self.readonly:
@@ -196,74 +728,584 @@ class DatasetCache(object):
     def __del__(self):
         self.sync()
 
+    def close(self):
+        """ Flush products and close the underlying LMDB environment,
+        object can not be used after this.
+        """
+        if self._dbs.main is None:
+            return
+        self.sync()
+        self._encoder = None
+        self._dbs.main.close()
+        self._dbs.main = None
+
+    def _grow_map(self):
+        map_size = self._dbs.main.info()['map_size']*MAP_GROWTH_FACTOR
+        self._dbs.main.set_mapsize(map_size)
+        return map_size
+
+    def _begin(self, db, **kwargs):
+        """Start read transaction.
+
+        Memory map might have been grown by a writer in another process since
+        the environment was opened, adopt the new size and try again.
+        """
+        try:
+            return self._dbs.main.begin(db, **kwargs)
+        except lmdb.MapResizedError:
+            self._dbs.main.set_mapsize(0)
+            return self._dbs.main.begin(db, **kwargs)
+
+    def _write(self, body, db=None):
+        """Run `body(transaction)` in a write transaction and commit.
+
+        When database runs out of space transaction is aborted, memory map
+        is grown by `MAP_GROWTH_FACTOR` and `body` is run again, so it must
+        not consume its inputs.
+        """
+        while True:
+            try:
+                with self._dbs.main.begin(db or self._dbs.ds, write=True) as tr:
+                    return body(tr)
+            except lmdb.MapFullError:
+                self._extents_pending = []
+                self._groups_pending = {}
+                self._grow_map()
+            except lmdb.MapResizedError:
+                self._dbs.main.set_mapsize(0)
+
+    def copy(self, path, compact=True):
+        """Write a copy of the cache to a new location.
+
+        :path str: Destination, directory is created when the cache itself is stored in a directory
+        :compact bool: Omit free pages, producing the smallest file
+        """
+        env_path = Path(self._dbs.main.path())
+        if env_path.is_dir():
+            Path(path).mkdir(parents=True, exist_ok=False)
+        self._dbs.main.copy(str(path), compact=compact)
+
     @property
     def readonly(self):
-        return self._comp is None
+        return self._encoder is None
 
     @property
     def products(self):
         return self._products
 
+    def add_products(self, products):
+        """ Register product definitions, needed when saving raw documents.
+
+        :param products: Sequence of DatasetType objects
+        """
+        for p in products:
+            self._products[p.name] = p
+            self._extent_fields.pop(p.name, None)
+
     def _ds2kv(self, ds):
-        k, d = ds2bytes(ds)
-        d = self._comp.compress(d)
+        k, d = ds2bytes(ds, self._encoder.codec)
+        d = self._encoder.compressor(ds.type.name).compress(d)
         return (k, d)
 
     def _doc2kv(self, ds_raw):
-        k, d = doc2bytes(ds_raw)
-        d = self._comp.compress(d)
-        return (k, d)
+        return self._encoder(ds_raw)
+
+    def _product_id(self, name):
+        idx = self._product_ids.get(name)
+        if idx is None:
+            idx = len(self._product_ids)
+            self._product_ids[name] = idx
+        return idx
+
+    def _fields_for(self, product):
+        fields = self._extent_fields.get(product)
+        if fields is None:
+            p = self._products.get(product)
+            if p is None:
+                fields = (None, None, None)
+            else:
+                fields = extent_fields(p.metadata_type.definition)
+            self._extent_fields[product] = fields
+        return fields
+
+    def _add_extent(self, k, product, metadata):
+        extent = doc_extent(metadata, self._fields_for(product))
+        self._extents_pending.append((k, self._product_id(product), extent))
+
+    def _ensure_extent_ids(self, tr):
+        """ Index extents records by dataset id, only does work for caches
+        created before the index was introduced.
+        """
+        if tr.get(b'extents/ids', db=self._dbs.info) is not None:
+            return
+
+        for ck, data in tr.cursor(db=self._dbs.extents):
+            ck = bytes(ck)
+            for k in np.frombuffer(data, dtype=EXTENT_DTYPE)['id'].tolist():
+                tr.put(k, ck, db=self._dbs.extent_ids)
+
+        tr.put(b'extents/ids', b'1', db=self._dbs.info)
+
+    def _extents_drop(self, tr, keys):
+        """ Remove records for given dataset ids from the extents index,
+        only chunks holding these ids are touched.
+        """
+        self._ensure_extent_ids(tr)
+
+        by_chunk = {}
+        for k in keys:
+            ck = tr.pop(k, db=self._dbs.extent_ids)
+            if ck is not None:
+                by_chunk.setdefault(ck, []).append(k)
+
+        for ck, kk in by_chunk.items():
+            xx = np.frombuffer(tr.get(ck, db=self._dbs.extents), dtype=EXTENT_DTYPE)
+            xx = xx[~np.isin(xx['id'], bytes2uuid_array(b''.join(kk)))]
+            if xx.shape[0] > 0:
+                tr.put(ck, xx.tobytes(), db=self._dbs.extents)
+            else:
+                tr.delete(ck, db=self._dbs.extents)
+
+    def _flush_extents(self, tr, replaced=None):
+        """ Append pending extents records as new chunks, needs to happen in the
+        same write transaction as the datasets themselves.
+        """
+        pending, self._extents_pending = self._extents_pending, []
+        if not pending:
+            return
+
+        if replaced:
+            self._extents_drop(tr, replaced)
+
+        # same dataset saved more than once in a batch, last one wins
+        last = {k: i for i, (k, _, _) in enumerate(pending)}
+        if len(last) != len(pending):
+            pending = [pending[i] for i in sorted(last.values())]
+
+        names = [n for n, _ in sorted(self._product_ids.items(), key=lambda x: x[1])]
+        tr.put(b'extents/products', json.dumps(names).encode('utf8'), db=self._dbs.info)
+
+        cursor = tr.cursor(db=self._dbs.extents)
+        idx = int.from_bytes(cursor.key(), 'big') + 1 if cursor.last() else 0
+
+        for chunk in toolz.partition_all(EXTENT_CHUNK_SZ, pending):
+            xx = np.empty(len(chunk), dtype=EXTENT_DTYPE)
+            xx['id'] = [k for k, _, _ in chunk]
+            xx['product'] = [p for _, p, _ in chunk]
+            ee = np.asarray([e for _, _, e in chunk], dtype='float64')
+            xx['lon'], xx['lat'], xx['time'] = ee[:, 0:2], ee[:, 2:4], ee[:, 4:6]
+
+            ck = idx.to_bytes(4, 'big')
+            tr.put(ck, xx.tobytes(), db=self._dbs.extents)
+            for k, _, _ in chunk:
+                tr.put(k, ck, db=self._dbs.extent_ids)
+            idx += 1
+
+    def add_grouper(self, grouper):
+        """Maintain groups incrementally as datasets are added.
+
+        :grouper: Dataset -> [group_name], called for every dataset saved with
+        `bulk_save`, `bulk_save_raw`, `bulk_save_parallel` or `tee`. Dataset is
+        then added to each of the returned groups as part of the same write
+        transaction. See `dscache.tools.tiling.mk_grid_grouper` for example.
+        """
+        self._groupers.append(grouper)
+
+    def _group_names(self, ds):
+        if isinstance(ds, dict):
+            ds = doc2ds(ds, self._products)
+        return [key_to_bytes(n) for grouper in self._groupers for n in grouper(ds)]
+
+    def _add_to_groups(self, k, names):
+        for name in names:
+            self._groups_pending.setdefault(name, []).append(k)
+
+    def _group_load(self, tr, name):
+        """ Current members of a group as uuid array, None if group doesn't exist """
+        data = self._group_decode(tr.get(name, db=self._dbs.groups))
+        return None if data is None else bytes2uuid_array(data)
+
+    def _group_store(self, tr, name, uu, old=None):
+        """Write group and update `group_members` index for ids that were
+        added or removed compared to `old`.
+
+        :uu: Sorted array of unique ids
+        :old: Members before the change, None for a new group
+        """
+        tr.put(name, self._group_pack(uuids2bytes(uu)), db=self._dbs.groups)
+
+        added = uu if old is None else uuids_difference(uu, old)
+        removed = [] if old is None else uuids_difference(old, uu).tolist()
+
+        for k in added.tolist():
+            tr.put(k, name, dupdata=True, db=self._dbs.group_members)
+        for k in removed:
+            tr.delete(k, name, db=self._dbs.group_members)
+
+    def _ensure_group_members(self, tr):
+        """ Index group membership by dataset id, only does work for caches
+        created before the index was introduced. Groups are re-written sorted
+        if they were stored by an older version.
+        """
+        if tr.get(b'groups/members', db=self._dbs.info) is not None:
+            return
+
+        groups = [(bytes(name), bytes(data)) for name, data in tr.cursor(db=self._dbs.groups)]
+        for name, data in groups:
+            uu = bytes2uuid_array(self._group_decode(data))
+            if not self._groups_sorted:
+                tr.put(name, self._group_pack(uuids2bytes(uu)), db=self._dbs.groups)
+            for k in uu.tolist():
+                tr.put(k, name, dupdata=True, db=self._dbs.group_members)
+
+        tr.put(b'groups/format', b'sorted', db=self._dbs.info)
+        tr.put(b'groups/members', b'1', db=self._dbs.info)
 
-    def _ds_save(self, ds, transaction):
+    def _flush_groups(self, tr):
+        """ Merge pending group membership into the groups database """
+        pending, self._groups_pending = self._groups_pending, {}
+
+        for name, keys in pending.items():
+            uu = uuid_array(keys)
+            existing = self._group_load(tr, name)
+            if existing is not None:
+                uu = uuids_union(existing, uu)
+
+            self._group_store(tr, name, uu, existing)
+
+    def merge_groups(self, groups, replace=()):
+        """Add ids to several groups in one write transaction.
+
+        :groups: {group_name: uuids}, uuids as accepted by `put_group` or raw bytes
+        :replace: Names of groups that should be overwritten rather than merged into
+        """
+        replace = set(map(key_to_bytes, replace))
+        groups = [(key_to_bytes(name), uuid_array(bytes2uuid_array(uu) if isinstance(uu, bytes) else uu))
+                  for name, uu in groups.items()]
+
+        def merge(tr):
+            for name, uu in groups:
+                existing = self._group_load(tr, name)
+                if existing is not None and name not in replace:
+                    uu = uuids_union(existing, uu)
+
+                self._group_store(tr, name, uu, existing)
+
+        self._write(merge, db=self._dbs.groups)
+
+    def _groups_drop(self, tr, keys):
+        """ Remove given dataset ids from all groups they belong to """
+        self._ensure_group_members(tr)
+
+        by_name = {}
+        cursor = tr.cursor(db=self._dbs.group_members)
+        for k in keys:
+            if cursor.set_key(k):
+                for name in cursor.iternext_dup():
+                    by_name.setdefault(bytes(name), []).append(k)
+
+        for name, kk in by_name.items():
+            existing = self._group_load(tr, name)
+            if existing is not None:
+                self._group_store(tr, name, uuids_difference(existing, uuid_array(kk)), existing)
+
+    def bulk_delete(self, uuids, max_transaction_size=10000):
+        """Remove datasets from the cache, together with their extents records
+        and group membership.
+
+        :uuids: Stream of UUID|str|bytes, missing ids are ignored
+        :max_transaction_size int: How often to commit results to disk
+        :returns: Number of datasets removed
+        """
+        def to_key(u):
+            return key_to_bytes(UUID(u) if isinstance(u, str) else u)
+
+        def delete(tr, batch):
+            keys = [k for k in batch if tr.delete(k)]
+            for k in keys:
+                self._lru_discard(k)
+            if keys:
+                self._extents_drop(tr, keys)
+                self._groups_drop(tr, keys)
+            return len(keys)
+
+        return sum(self._write(functools.partial(delete, batch=batch))
+                   for batch in toolz.partition_all(max_transaction_size, map(to_key, uuids)))
+
+    def _flush_pending(self, tr, replaced=None):
+        self._flush_extents(tr, replaced)
+        self._flush_groups(tr)
+
+    def _put(self, tr, k, v, replaced):
+        self._lru_discard(k)
+        old = tr.replace(k, v)
+        if old is not None:
+            replaced.append(k)
+
+    def _ds_save(self, ds, transaction, replaced=None):
         if ds.type.name not in self._products:
             self._products[ds.type.name] = ds.type
 
         k, v = self._ds2kv(ds)
-        transaction.put(k, v)
-
-    def bulk_save(self, dss):
-        with self._dbs.main.begin(self._dbs.ds, write=True) as tr:
-            for ds in dss:
-                self._ds_save(ds, tr)
-
-    def tee(self, dss, max_transaction_size=10000):
+        self._put(transaction, k, v, replaced if replaced is not None else [])
+        self._add_extent(k, ds.type.name, ds.metadata_doc)
+        if self._groupers:
+            self._add_to_groups(k, self._group_names(ds))
+
+    def _save_batch(self, tr, dss, checkpoint=None):
+        replaced = []
+        for ds in dss:
+            self._ds_save(ds, tr, replaced)
+        self._flush_pending(tr, replaced)
+
+        if checkpoint is not None and len(dss) > 0:
+            k, v = checkpoint(dss[-1])
+            tr.put(key_to_bytes(k), v, db=self._dbs.udata)
+
+    def bulk_save(self, dss, max_transaction_size=10000):
+        """ Save a stream of datasets, committing every `max_transaction_size` datasets """
+        for batch in toolz.partition_all(max_transaction_size, dss):
+            self._write(lambda tr: self._save_batch(tr, batch))
+
+    def tee(self, dss, max_transaction_size=10000, checkpoint=None):
         """Given a lazy stream of datasets persist them to disk and then pass through
         for further processing.
         :dss: stream of datasets
         :max_transaction_size int: How often to commit results to disk
+        :checkpoint: Dataset -> (key, value), called with the last dataset of
+                     every transaction, result is saved to `udata` as part of
+                     the same transaction, see `get_udata`
         """
-        have_some = True
+        dss = iter(dss)
 
-        while have_some:
-            with self._dbs.main.begin(self._dbs.ds, write=True) as tr:
-                have_some = False
-                for ds in itertools.islice(dss, max_transaction_size):
-                    have_some = True
-                    self._ds_save(ds, tr)
-                    yield ds
+        while True:
+            batch = list(itertools.islice(dss, max_transaction_size))
+            if not batch:
+                break
+
+            self._write(lambda tr: self._save_batch(tr, batch, checkpoint))
+            yield from batch
 
         self.sync()
 
-    def bulk_save_raw(self, raw_dss):
-        with self._dbs.main.begin(self._dbs.ds, write=True) as tr:
+    def bulk_save_raw(self, raw_dss, max_transaction_size=10000):
+        """Save raw documents, see `doc2bytes` for the expected format.
+
+        Extents of datasets are only indexed for products known to the cache,
+        when groupers are registered products must be known.
+
+        :max_transaction_size int: How often to commit results to disk
+        """
+        def save(tr, raw_dss):
+            replaced = []
             for raw_ds in raw_dss:
                 k, v = self._doc2kv(raw_ds)
-                tr.put(k, v)
+                self._put(tr, k, v, replaced)
+                self._add_extent(k, raw_ds['product'], raw_ds['metadata'])
+                if self._groupers:
+                    self._add_to_groups(k, self._group_names(raw_ds))
+            self._flush_pending(tr, replaced)
+
+        for batch in toolz.partition_all(max_transaction_size, raw_dss):
+            self._write(functools.partial(save, raw_dss=batch))
+
+    def _work_item(self, ds):
+        """ Input for `DocEncoder.encode_chunk` from dataset, raw document or (product, text) """
+        if isinstance(ds, tuple):
+            product, text = ds
+            groups = self._group_names(json.loads(text)) if self._groupers else None
+            return (text, self._fields_for(product), groups)
+
+        groups = self._group_names(ds) if self._groupers else None
+
+        if isinstance(ds, dict):
+            doc = ds
+        else:
+            if ds.type.name not in self._products:
+                self._products[ds.type.name] = ds.type
+
+            doc = dict(uris=ds.uris,
+                       product=ds.type.name,
+                       metadata=ds.metadata_doc)
+
+        return (doc, self._fields_for(doc['product']), groups)
+
+    def _save_encoded(self, tr, batch):
+        """ Write output of `DocEncoder.encode_chunk` """
+        replaced = []
+        for k, v, product, extent, groups in batch:
+            self._put(tr, k, v, replaced)
+            self._extents_pending.append((k, self._product_id(product), extent))
+            if groups:
+                self._add_to_groups(k, groups)
+        self._flush_pending(tr, replaced)
+
+    def bulk_save_parallel(self, dss,
+                           nprocs=None,
+                           pool=None,
+                           chunk_size=1000,
+                           prefetch=None,
+                           max_transaction_size=10000):
+        """Save a stream of datasets or raw documents using a pool of workers.
+
+        Serialisation and compression happen on worker processes, while
+        calling thread writes results to disk, committing every
+        `max_transaction_size` datasets.
+
+        :dss: Stream of Dataset objects or raw documents (see `doc2bytes`), can be mixed.
+              Raw documents can also be supplied as json text in a
+              `(product_name, text)` tuple, text is then parsed on worker processes.
+        :nprocs int: Number of worker processes, defaults to number of cores
+        :pool: `concurrent.futures` executor to use instead of creating one
+        :chunk_size int: Number of datasets per unit of work
+        :prefetch int: Maximum number of chunks being processed, defaults to 2 per worker
+        :max_transaction_size int: How often to commit results to disk
+        """
+        chunks = toolz.partition_all(chunk_size, map(self._work_item, dss))
+        kvs = itertools.chain.from_iterable(pmap_stream(self._encoder.encode_chunk, chunks,
+                                                        nprocs=nprocs,
+                                                        pool=pool,
+                                                        prefetch=prefetch))
+
+        for batch in toolz.partition_all(max_transaction_size, kvs):
+            self._write(functools.partial(self._save_encoded, batch=batch))
+
+        self.sync()
+
+    def rebuild_extents(self, chunk_size=10000):
+        """Re-create extents index from the stored documents.
+
+        Needed for caches created before extents were recorded, or when product
+        definitions were added after datasets were saved raw.
+        """
+        def rebuild(tr):
+            tr.drop(self._dbs.extents, delete=False)
+            tr.drop(self._dbs.extent_ids, delete=False)
+            tr.put(b'extents/ids', b'1', db=self._dbs.info)
+            tr.put(b'extents/complete', b'1', db=self._dbs.info)
+            self._extent_fields = {}
+
+            for k, d in tr.cursor():
+                doc = self._decoder(d)
+                self._add_extent(bytes(k), doc['product'], doc['metadata'])
+                if len(self._extents_pending) >= chunk_size:
+                    self._flush_extents(tr)
+
+            self._flush_extents(tr)
+
+        self._write(rebuild)
+        self._extents_complete = True
+
+    def _query_keys(self, bbox=None, time=None, product=None):
+        if self._dbs.extents is None or not self._extents_complete:
+            raise ValueError('This cache has no extents index, run `rebuild_extents` first')
+
+        def norm_range(r):
+            if isinstance(r, (tuple, list)):
+                t0, t1 = r
+            else:
+                t0 = t1 = r
+            t0, t1 = to_epoch(t0), to_epoch(t1)
+            return (-np.inf if np.isnan(t0) else t0,
+                    np.inf if np.isnan(t1) else t1)
+
+        if isinstance(product, str):
+            product = [product]
+        if product is not None:
+            product = [self._product_ids[p] for p in product if p in self._product_ids]
+        if time is not None:
+            time = norm_range(time)
+
+        keys = []
+        with self._begin(self._dbs.extents, buffers=True) as tr:
+            for _, data in tr.cursor():
+                xx = np.frombuffer(data, dtype=EXTENT_DTYPE)
+                m = np.ones(xx.shape, dtype='bool')
+
+                if bbox is not None:
+                    left, bottom, right, top = bbox
+                    lon, lat = xx['lon'], xx['lat']
+                    m &= (lon[:, 0] <= right) & (lon[:, 1] >= left)
+                    m &= (lat[:, 0] <= top) & (lat[:, 1] >= bottom)
+
+                if time is not None:
+                    tt = xx['time']
+                    m &= (tt[:, 0] <= time[1]) & (tt[:, 1] >= time[0])
+
+                if product is not None:
+                    m &= np.isin(xx['product'], product)
+
+                keys.extend(k.tobytes() for k in xx['id'][m])
+
+        return keys
+
+    def query(self, bbox=None, time=None, product=None, raw=False, batch_size=1000):
+        """Find datasets using extents index, only matching documents are decompressed.
+
+        :bbox: (left, bottom, right, top) in lon/lat, datasets overlapping it are returned
+        :time: (start, end) as datetime or string, or a single time value
+        :product: product name or list of names
+        :raw bool: Return LazyDoc instead of Dataset
+        :batch_size int: How many datasets to fetch per read transaction
+        """
+        keys = self._query_keys(bbox=bbox, time=time, product=product)
+
+        for batch in toolz.partition_all(batch_size, keys):
+            for ds in self.get_many(batch, raw=raw):
+                if ds is not None:
+                    yield ds
 
     def put_group(self, name, uuids):
-        """ Group is a named list of uuids
+        """ Group is a named set of uuids
+
+        Stored as a sorted array of unique ids, optionally compressed.
+
+        :uuids: Sequence of UUID|str|bytes or numpy array of UUID_DTYPE
         """
-        data = uuids2bytes(uuids)
+        uu = uuid_array(uuids)
         k = key_to_bytes(name)
 
-        with self._dbs.main.begin(self._dbs.groups, write=True) as tr:
-            tr.put(k, data)
+        self._write(lambda tr: self._group_store(tr, k, uu, self._group_load(tr, k)))
+
+    def _group_pack(self, data):
+        if self._group_comp is None:
+            return data
+        return self._group_comp.compress(data)
+
+    def _group_unpack(self, data):
+        if data is None or self._group_comp is None:
+            return data
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    def _group_decode(self, data):
+        """ Stored group -> sorted uuids as concatenated 16 bytes, groups
+        written by older versions are sorted and de-duplicated on the fly.
+        """
+        data = self._group_unpack(data)
+        if data is None or self._groups_sorted:
+            return data
+        return uuid_array(bytes2uuid_array(data)).tobytes()
+
+    def put_udata(self, key, value):
+        """ Store arbitrary user data under a given key.
+
+        :param key: str|bytes
+        :param value: bytes
+        """
+        self._write(lambda tr: tr.put(key_to_bytes(key), value), db=self._dbs.udata)
+
+    def get_udata(self, key, default=None):
+        """ Lookup user data, see `put_udata`.
+        """
+        with self._begin(self._dbs.udata, buffers=True) as tr:
+            d = tr.get(key_to_bytes(key))
+            return default if d is None else bytes(d)
 
     def _get_group_raw(self, name):
         k = key_to_bytes(name)
 
-        with self._dbs.main.begin(self._dbs.groups, write=False) as tr:
-            return tr.get(k)
+        with self._begin(self._dbs.groups, write=False) as tr:
+            return self._group_decode(tr.get(k))
 
     def get_group(self, name):
         """ Group is a named list of uuids
@@ -271,6 +1313,50 @@ class DatasetCache(object):
         data = self._get_group_raw(key_to_bytes(name))
         return bytes2uuids(data) if data is not None else None
 
+    def get_group_array(self, name):
+        """ Like `get_group` but returns numpy array of UUID_DTYPE, avoiding
+        construction of UUID objects.
+        """
+        data = self._get_group_raw(key_to_bytes(name))
+        return bytes2uuid_array(data) if data is not None else None
+
+    def _group_operands(self, groups):
+        # Set operations rely on groups being sorted, see `_group_decode`
+        def get(g):
+            if isinstance(g, np.ndarray):
+                return g
+            uu = self.get_group_array(g)
+            if uu is None:
+                raise ValueError('No such group: %s' % g)
+            return uu
+
+        return [get(g) for g in groups]
+
+    def group_union(self, *groups):
+        """ Ids present in any of the groups.
+
+        :groups: group names or numpy arrays as returned by `get_group_array`
+        :returns: sorted numpy array of UUID_DTYPE
+        """
+        uu = self._group_operands(groups)
+        return functools.reduce(uuids_union, uu) if uu else np.empty(0, dtype=UUID_DTYPE)
+
+    def group_intersection(self, *groups):
+        """ Ids present in all of the groups, see `group_union`.
+        """
+        uu = self._group_operands(groups)
+        if not uu:
+            return np.empty(0, dtype=UUID_DTYPE)
+        return functools.reduce(uuids_intersection, uu)
+
+    def group_difference(self, group, *others):
+        """ Ids present in the first group but not in any of the others, see `group_union`.
+        """
+        uu, *others = self._group_operands((group,) + others)
+        for o in others:
+            uu = uuids_difference(uu, o)
+        return uu
+
     def groups(self, raw=False):
         """Get list of tuples (group_name, group_size).
 
@@ -280,37 +1366,187 @@ class DatasetCache(object):
         """
 
         def _raw():
-            with self._dbs.main.begin(self._dbs.groups, write=False, buffers=True) as tr:
-                return [(bytes(k), len(d)//16) for k, d in tr.cursor()]
+            def group_sz(d):
+                if self._group_comp is None:
+                    return len(d)//16
+                return zstandard.frame_content_size(d)//16
+
+            with self._begin(self._dbs.groups, write=False, buffers=True) as tr:
+                return [(bytes(k), group_sz(d)) for k, d in tr.cursor()]
 
         nn = _raw()
         return nn if raw else [(n.decode('utf8'), c) for n, c in nn]
 
     def _extract_ds(self, d):
-        d = self._decomp.decompress(d)
-        doc = json.loads(d)
-        return doc2ds(doc, self._products)
+        return doc2ds(self._decoder(d), self._products)
+
+    def _extract_doc(self, k, d):
+        return LazyDoc(self._decoder.decompress(d),
+                       key=bytes(k),
+                       products=self._products,
+                       loads=self._decoder.loads)
+
+    def _extract(self, k, d, raw=False):
+        """ Decode one document going through the LRU, only used for point lookups,
+        streaming methods call `_extract_doc`/`_extract_ds` so that large scans
+        don't evict frequently accessed entries.
+        """
+        if self._lru is None:
+            return self._extract_doc(k, d) if raw else self._extract_ds(d)
+
+        lru_key = (bytes(k), raw)
+        ds = self._lru.get(lru_key)
+        if ds is None:
+            ds = self._extract_doc(k, d) if raw else self._extract_ds(d)
+            sz = zstandard.frame_content_size(d)
+            self._lru.put(lru_key, ds, LRU_ITEM_OVERHEAD + (sz if sz > 0 else 4*len(d)))
+        return ds
+
+    def enable_lru(self, max_bytes=256*(1 << 20)):
+        """Keep recently accessed documents decoded in memory.
+
+        Applies to `get`, `get_many` and `query`, bulk streaming methods
+        bypass it. Entries are invalidated when datasets are written or deleted
+        through this object, but not when the file is modified by another
+        process. Cached objects are shared between callers and should not be
+        modified.
+
+        :max_bytes int: Memory budget, estimated from decompressed document sizes,
+                        supply None to disable the cache
+        """
+        self._lru = None if max_bytes is None else LRU(max_bytes)
+
+    def lru_stats(self):
+        """ Get SimpleNamespace(hits, misses, evictions, entries, nbytes, max_bytes),
+        None if LRU is not enabled.
+        """
+        return None if self._lru is None else self._lru.stats()
+
+    def _lru_discard(self, k):
+        if self._lru is not None:
+            self._lru.discard((k, True))
+            self._lru.discard((k, False))
 
-    def get(self, uuid):
-        """Extract single dataset with a given uuid, or return None if not found"""
+    def _extract_parallel(self, raw_chunks, raw=False, nprocs=None, pool=None, prefetch=None, ordered=True):
+        """ Decompress (and parse unless raw=True) chunks of (key, value) pairs on a
+        pool of workers, datasets are then constructed on the calling thread.
+        """
+        proc = self._decoder.decompress_chunk if raw else self._decoder.decode_chunk
+        chunks = pmap_stream(proc, raw_chunks,
+                             nprocs=nprocs,
+                             pool=pool,
+                             prefetch=prefetch,
+                             ordered=ordered)
+        for chunk in chunks:
+            for k, doc in chunk:
+                if raw:
+                    yield LazyDoc(doc, key=k, products=self._products, loads=self._decoder.loads)
+                else:
+                    yield doc2ds(doc, self._products)
+
+    def get(self, uuid, raw=False):
+        """Extract single dataset with a given uuid, or return None if not found
+
+        :raw bool: Return LazyDoc instead of Dataset
+        """
         if isinstance(uuid, str):
             uuid = UUID(uuid)
 
         key = key_to_bytes(uuid)
 
-        with self._dbs.main.begin(self._dbs.ds, buffers=True) as tr:
+        with self._begin(self._dbs.ds, buffers=True) as tr:
             d = tr.get(key, None)
             if d is None:
                 return None
 
-            return self._extract_ds(d)
+            return self._extract(key, d, raw)
+
+    def get_many(self, uuids, raw=False):
+        """Extract datasets for a list of uuids using one read transaction.
+
+        Keys are visited in sorted order with a single cursor, but results are
+        returned in the same order as input. Datasets that are not found are
+        reported as ``None`` rather than raising an error.
+
+        :raw bool: Return LazyDoc instead of Dataset
+        """
+        keys = [key_to_bytes(UUID(u) if isinstance(u, str) else u) for u in uuids]
+        out = [None]*len(keys)
+
+        with self._begin(self._dbs.ds, buffers=True) as tr:
+            cursor = tr.cursor()
+            for idx in sorted(range(len(keys)), key=keys.__getitem__):
+                if cursor.set_key(keys[idx]):
+                    out[idx] = self._extract(keys[idx], cursor.value(), raw)
+
+        return out
+
+    def get_all(self, raw=False, nprocs=None, pool=None, chunk_size=1000, prefetch=None, ordered=True):
+        """Stream all datasets in the cache.
+
+        By default everything happens on the calling thread. Supply `nprocs` or
+        `pool` to decompress and parse documents on a pool of workers instead,
+        raw values are read from disk in chunks of `chunk_size` and at most
+        `prefetch` chunks are in flight at once.
+
+        :raw bool: Return LazyDoc instead of Dataset, this skips json parsing
+                   and Dataset construction until fields are accessed
+        :nprocs int: Number of worker processes to use
+        :pool: `concurrent.futures` executor to use instead of creating one
+        :chunk_size int: Number of datasets per unit of work
+        :prefetch int: Maximum number of chunks being processed, defaults to 2 per worker
+        :ordered bool: Set to False to get datasets as soon as they are ready
+        """
+        if nprocs is None and pool is None:
+            with self._begin(self._dbs.ds, buffers=True) as tr:
+                for k, d in tr.cursor():
+                    yield self._extract_doc(k, d) if raw else self._extract_ds(d)
+            return
+
+        def raw_chunks(tr):
+            kvs = ((bytes(k), bytes(d)) for k, d in tr.cursor())
+            return toolz.partition_all(chunk_size, kvs)
+
+        with self._begin(self._dbs.ds, buffers=True) as tr:
+            yield from self._extract_parallel(raw_chunks(tr),
+                                              raw=raw,
+                                              nprocs=nprocs,
+                                              pool=pool,
+                                              prefetch=prefetch,
+                                              ordered=ordered)
+
+    def map_docs(self, proc, nprocs=None, pool=None, chunk_size=1000, prefetch=None, ordered=True):
+        """Apply `proc` to chunks of documents on a pool of workers.
+
+        Decompression and parsing happen on workers too, only the results of
+        `proc` are sent back.
+
+        :proc: [raw_ds] -> result, has to be picklable, see `doc2bytes` for document format
+        :returns: Stream of results, one per chunk
+
+        Runs on the calling thread unless `nprocs` or `pool` is supplied, see
+        `get_all` for the meaning of the other parameters.
+        """
+        proc = functools.partial(_decode_and_apply, self._decoder, proc)
+
+        with self._begin(self._dbs.ds, buffers=True) as tr:
+            kvs = ((bytes(k), bytes(d)) for k, d in tr.cursor())
+            chunks = toolz.partition_all(chunk_size, kvs)
+
+            if nprocs is None and pool is None:
+                yield from map(proc, chunks)
+            else:
+                yield from pmap_stream(proc, chunks,
+                                       nprocs=nprocs,
+                                       pool=pool,
+                                       prefetch=prefetch,
+                                       ordered=ordered)
 
-    def get_all(self):
-        with self._dbs.main.begin(self._dbs.ds, buffers=True) as tr:
-            for _, d in tr.cursor():
-                yield self._extract_ds(d)
+    def stream_group(self, group_name, raw=False, nprocs=None, pool=None, chunk_size=1000, prefetch=None, ordered=True):
+        """Stream all datasets in a named group.
 
-    def stream_group(self, group_name):
+        See `get_all` for the meaning of the other parameters.
+        """
         uu = self._get_group_raw(group_name)
         if uu is None:
             raise ValueError('No such group: %s' % group_name)
@@ -318,18 +1554,54 @@ class DatasetCache(object):
         if len(uu) & 0xF:
             raise ValueError('Wrong data size for group %s' % group_name)
 
-        with self._dbs.main.begin(self._dbs.ds, buffers=True) as tr:
+        def raw_kvs(tr):
             for i in range(0, len(uu), 16):
                 key = uu[i:i+16]
                 d = tr.get(key, None)
                 if d is None:
                     raise ValueError('Missing dataset for %s' % (str(UUID(bytes=key))))
 
-                yield self._extract_ds(d)
+                yield key, d
+
+        with self._begin(self._dbs.ds, buffers=True) as tr:
+            if nprocs is None and pool is None:
+                for k, d in raw_kvs(tr):
+                    yield self._extract_doc(k, d) if raw else self._extract_ds(d)
+            else:
+                raw_chunks = toolz.partition_all(chunk_size, ((k, bytes(d)) for k, d in raw_kvs(tr)))
+                yield from self._extract_parallel(raw_chunks,
+                                                  raw=raw,
+                                                  nprocs=nprocs,
+                                                  pool=pool,
+                                                  prefetch=prefetch,
+                                                  ordered=ordered)
+
+    def get_range(self, start=None, stop=None, raw=False):
+        """Stream datasets with ids in the range `start <= id < stop`.
+
+        Useful for splitting work across processes by id, see `key_ranges`.
+
+        :start: UUID|bytes, None means from the first dataset
+        :stop: UUID|bytes, None means until the last dataset
+        :raw bool: Return LazyDoc instead of Dataset
+        """
+        start = key_to_bytes(start) if start is not None else None
+        stop = key_to_bytes(stop) if stop is not None else None
+
+        with self._begin(self._dbs.ds, buffers=True) as tr:
+            cursor = tr.cursor()
+            have_some = cursor.set_range(start) if start is not None else cursor.first()
+            if not have_some:
+                return
+
+            for k, d in cursor:
+                if stop is not None and bytes(k) >= stop:
+                    break
+                yield self._extract_doc(k, d) if raw else self._extract_ds(d)
 
     @property
     def count(self):
-        with self._dbs.main.begin(self._dbs.ds) as tr:
+        with self._begin(self._dbs.ds) as tr:
             return tr.stat()['entries']
 
 
@@ -366,65 +1638,125 @@ def _from_existing_db(db, products=None, complevel=6):
         version = tr.get(b'version', None)
         if version is None:
             raise ValueError('Missing format version field')
-        if version != FORMAT_VERSION:
+        if version not in SUPPORTED_VERSIONS:
             raise ValueError("Unsupported on disk version: " + version.decode('utf8'))
 
         zdict = tr.get(b'zdict', None)
+        zdicts = {k.decode('utf8'): v for k, v in prefix_visit(tr, 'zdict/')}
+        codec = tr.get(b'codec', DEFAULT_CODEC.encode('utf8')).decode('utf8')
+        group_comp = _mk_group_comp(tr.get(b'groups/codec', None), complevel)
+        groups_sorted = tr.get(b'groups/format', None) == b'sorted'
+        product_ids = json.loads(tr.get(b'extents/products', b'[]').decode('utf8'))
+        extents_complete = tr.get(b'extents/complete', None) is not None
+
+    def open_optional(name, **kwargs):
+        try:
+            return db.open_db(name, create=not readonly, **kwargs)
+        except lmdb.NotFoundError:
+            return None  # Older file opened in read-only mode
 
     dbs = SimpleNamespace(main=db,
                           info=db_info,
                           groups=db.open_db(b'groups', create=False),
                           ds=db.open_db(b'ds', create=False),
-                          udata=db.open_db(b'udata', create=False))
+                          udata=db.open_db(b'udata', create=False),
+                          extents=open_optional(b'extents'),
+                          extent_ids=open_optional(b'extent_ids'),
+                          group_members=open_optional(b'group_members', dupsort=True))
 
-    comp_params = {'dict_data': zstandard.ZstdCompressionDict(zdict)} if zdict else {}
-
-    comp = None if readonly else zstandard.ZstdCompressor(level=complevel, **comp_params)
-    decomp = zstandard.ZstdDecompressor(**comp_params)
+    encoder, decoder = _mk_codecs(zdict, zdicts, complevel, codec, readonly)
 
     if products is None:
-        with db.begin(db_info, write=False) as tr:
-            metadata = jsonKV2dict(prefix_visit(tr, 'metadata/'), decomp)
-            products = jsonKV2dict(prefix_visit(tr, 'product/'), decomp)
+        def raw_kv(tr, prefix):
+            return ((k.decode('utf8'), bytes(v)) for k, v in prefix_visit(tr, prefix))
 
-        products = build_dc_product_map(metadata, products)
+        with db.begin(db_info, write=False) as tr:
+            products = LazyProductMap(raw_kv(tr, 'metadata/'),
+                                      raw_kv(tr, 'product/'),
+                                      decoder)
 
     state = SimpleNamespace(dbs=dbs,
-                            comp=comp,
-                            decomp=decomp,
-                            products=products)
+                            encoder=encoder,
+                            decoder=decoder,
+                            group_comp=group_comp,
+                            groups_sorted=groups_sorted,
+                            products=products,
+                            product_ids=product_ids,
+                            extents_complete=extents_complete)
 
     return DatasetCache(state)
 
 
+def _mk_group_comp(group_codec, complevel):
+    if group_codec is None:
+        return None
+    if group_codec != b'zstd':
+        raise ValueError('Unsupported group codec: ' + group_codec.decode('utf8'))
+    return zstandard.ZstdCompressor(level=complevel, write_content_size=True)
+
+
+def _mk_codecs(zdict, zdicts, complevel, codec=None, readonly=False):
+    """ -> (DocEncoder|None, DocDecoder)
+    """
+    encoder = None if readonly else DocEncoder(zdict, zdicts, complevel, codec)
+    return encoder, DocDecoder(zdict, list(zdicts.values()), codec)
+
+
 def _from_empty_db(db,
                    complevel=6,
-                   zdict=None):
+                   zdict=None,
+                   zdicts=None,
+                   codec=None,
+                   compress_groups=False):
     assert isinstance(zdict, (bytes, type(None)))
+    zdicts = zdicts or {}
+    codec = get_codec(codec).name
+
+    for p, zd in zdicts.items():
+        if mk_zdict(zd).dict_id() == 0:
+            raise ValueError('Dictionary for product %s lacks dictionary id, use trained dictionaries' % p)
 
     db_info = db.open_db(b'info', create=True)
 
     with db.begin(db_info, write=True) as tr:
         tr.put(b'version', FORMAT_VERSION)
+        tr.put(b'codec', codec.encode('utf8'))
+
+        if compress_groups:
+            tr.put(b'groups/codec', b'zstd')
+
+        tr.put(b'groups/format', b'sorted')
+
+        # membership indexes are maintained from the start
+        tr.put(b'extents/complete', b'1')
+        tr.put(b'extents/ids', b'1')
+        tr.put(b'groups/members', b'1')
 
         if zdict is not None:
             tr.put(b'zdict', zdict)
 
+        for p, zd in zdicts.items():
+            tr.put(key_to_bytes('zdict/' + p), zd)
+
     dbs = SimpleNamespace(main=db,
                           info=db_info,
                           groups=db.open_db(b'groups', create=True),
                           ds=db.open_db(b'ds', create=True),
-                          udata=db.open_db(b'udata', create=True))
-
-    comp_params = {'dict_data': zstandard.ZstdCompressionDict(zdict)} if zdict else {}
+                          udata=db.open_db(b'udata', create=True),
+                          extents=db.open_db(b'extents', create=True),
+                          extent_ids=db.open_db(b'extent_ids', create=True),
+                          group_members=db.open_db(b'group_members', dupsort=True, create=True))
 
-    comp = zstandard.ZstdCompressor(level=complevel, **comp_params)
-    decomp = zstandard.ZstdDecompressor(**comp_params)
+    encoder, decoder = _mk_codecs(zdict, zdicts, complevel, codec)
 
     state = SimpleNamespace(dbs=dbs,
-                            comp=comp,
-                            decomp=decomp,
-                            products={})
+                            encoder=encoder,
+                            decoder=decoder,
+                            group_comp=_mk_group_comp(b'zstd' if compress_groups else None, complevel),
+                            groups_sorted=True,
+                            products={},
+                            product_ids=[],
+                            extents_complete=True)
 
     return DatasetCache(state)
 
@@ -473,7 +1805,8 @@ def open_rw(path,
     datasets to the datacube index directly (i.e. without product matching
     metadata documents).
 
-    :max_db_sz int: Maximum size in bytes database file is allowed to grow to, defaults to 10Gb
+    :max_db_sz int: Initial size in bytes of the memory map, it is grown
+    automatically when database runs out of space, defaults to 1Gb
 
     :complevel: Compression level (Zstandard) to use when storing datasets, 1
     fastest, 6 good and still fast, 20+ best but slower.
@@ -482,7 +1815,7 @@ def open_rw(path,
     subdir = Path(path).is_dir()
 
     if max_db_sz is None:
-        max_db_sz = 10*(1 << 30)
+        max_db_sz = DEFAULT_MAP_SIZE
 
     db = lmdb.open(path,
                    subdir=subdir,
@@ -498,16 +1831,38 @@ def open_rw(path,
 def create_cache(path,
                  complevel=6,
                  zdict=None,
+                 zdicts=None,
+                 codec=None,
+                 compress_groups=False,
                  max_db_sz=None,
                  truncate=False):
-    """
+    """Create new cache, or open existing one in append mode.
+
+    :path str: Path to the db
+
+    :complevel: Compression level (Zstandard) to use when storing datasets
+
+    :zdict bytes: Pre-trained compression dictionary, see `train_dictionary`
+
+    :zdicts: Per product compression dictionaries `{product_name: zdict}`, see
+    `train_product_dictionaries`. Datasets of products not listed here use `zdict`.
+
+    :codec str: Document serialisation format: json (default), msgpack or cbor,
+    dictionaries should be trained with the same codec.
+
+    :compress_groups bool: Store group membership compressed
+
+    :max_db_sz int: Initial size in bytes of the memory map, it is grown
+    automatically when database runs out of space, defaults to 1Gb
+
+    :truncate bool: Delete existing database first
     """
 
     if truncate:
         maybe_delete_db(path)
 
     if max_db_sz is None:
-        max_db_sz = 10*(1 << 30)
+        max_db_sz = DEFAULT_MAP_SIZE
 
     db = lmdb.open(path,
                    max_dbs=8,
@@ -519,7 +1874,8 @@ def create_cache(path,
     if db.stat()['entries'] > 0:
         return _from_existing_db(db, complevel=complevel)
     else:
-        return _from_empty_db(db, complevel=complevel, zdict=zdict)
+        return _from_empty_db(db, complevel=complevel, zdict=zdict, zdicts=zdicts, codec=codec,
+                              compress_groups=compress_groups)
 
 
 def test_key_to_value():
@@ -532,9 +1888,260 @@ def test_key_to_value():
     assert key_to_bytes(b"88") == b"88"
 
 
-def test_create_cache():
-    ss = create_cache('tmp.lmdb', truncate=True)
+def test_uuid_set_ops():
+    uu = [UUID(int=i) for i in range(10)]
+    a, b = uuid_array(uu[:6]), uuid_array(uu[4:][::-1])
+
+    assert bytes2uuids(a) == uu[:6]
+    assert bytes2uuids(uuids_union(a, b)) == uu
+    assert bytes2uuids(uuids_intersection(a, b)) == uu[4:6]
+    assert bytes2uuids(uuids_difference(a, b)) == uu[:4]
+    assert uuids2bytes(a) == b''.join(u.bytes for u in uu[:6])
+
+
+def test_create_cache(tmp_path):
+    path = str(tmp_path/'tmp.lmdb')
+    ss = create_cache(path, truncate=True)
     print(ss)
     del ss
-    ss = open_ro('tmp.lmdb')
+    ss = open_ro(path)
     print(ss)
+
+
+def test_map_grows(tmp_path):
+    max_db_sz = 64*1024
+    cache = create_cache(str(tmp_path/'grow.lmdb'), max_db_sz=max_db_sz)
+    docs = [dict(product='test',
+                 uris=['file:///{}.yaml'.format(i)],
+                 metadata=dict(id=str(UUID(int=i)), payload=list(range(i, i + 300))))
+            for i in range(1, 201)]
+
+    cache.bulk_save_raw(docs, max_transaction_size=50)
+
+    assert cache.count == len(docs)
+    assert cache._dbs.main.info()['map_size'] > max_db_sz
+    assert cache.get(UUID(int=7), raw=True).doc['metadata'] == docs[6]['metadata']
+    cache.close()
+
+
+def test_extents_query(tmp_path):
+    mdt = {'name': 'test', 'dataset': {'search_fields': {
+        'lon': {'min_offset': [['lon', 0]], 'max_offset': [['lon', 1]]},
+        'lat': {'min_offset': [['lat', 0]], 'max_offset': [['lat', 1]]},
+        'time': {'min_offset': [['time']], 'max_offset': [['time']]}}}}
+
+    def mk_doc(i, product='test', lon=0):
+        return dict(product=product,
+                    uris=['file:///{}.yaml'.format(i)],
+                    metadata=dict(id=str(UUID(int=i)),
+                                  lon=[lon + i, lon + i + 1], lat=[-i, -i + 1],
+                                  time='2019-01-{:02d}T00:00:00'.format(i)))
+
+    path = str(tmp_path/'extents.lmdb')
+    cache = create_cache(path)
+    metadata_type = SimpleNamespace(name='test', definition=mdt)
+    cache.add_products([SimpleNamespace(name=n, metadata_type=metadata_type,
+                                        definition=dict(name=n, metadata_type='test'))
+                        for n in ('test', 'other')])
+
+    d = mk_doc(3)
+    cache.bulk_save_raw([mk_doc(i) for i in range(1, 11)] + [mk_doc(11, 'other'), d, d])
+    assert cache.count == 11
+
+    def ids(**kw):
+        return sorted(ds.id for ds in cache.query(raw=True, **kw))
+
+    assert ids() == [UUID(int=i) for i in range(1, 12)]
+    assert ids(product='other') == [UUID(int=11)]
+    assert ids(bbox=(2.5, -10, 3.5, 0)) == [UUID(int=2), UUID(int=3)]
+    assert ids(time=('2019-01-04', '2019-01-05T12:00:00'), product='test') == [UUID(int=4), UUID(int=5)]
+
+    # re-saved dataset moves, deleted ones disappear
+    cache.bulk_save_raw([mk_doc(3, lon=100)])
+    cache.bulk_delete([UUID(int=4)])
+    assert ids(bbox=(2.5, -10, 3.5, 0)) == [UUID(int=2)]
+    assert ids(bbox=(100, -10, 110, 0)) == [UUID(int=3)]
+    assert ids(time='2019-01-04') == []
+    assert cache.count == 10
+
+    # files written before extents were recorded need a rebuild before query
+    cache._write(lambda tr: tr.delete(b'extents/complete', db=cache._dbs.info))
+    cache.close()
+
+    cache = open_rw(path)
+    try:
+        ids()
+        assert False, 'Expect ValueError'
+    except ValueError:
+        pass
+
+    cache.rebuild_extents()
+    assert ids(product='other') == [UUID(int=11)]
+    cache.close()
+
+    cache = open_ro(path)
+    assert len(ids()) == 10
+
+
+def test_legacy_groups(tmp_path):
+    path = str(tmp_path/'groups.lmdb')
+    uu = [UUID(int=i) for i in range(10)]
+
+    cache = create_cache(path)
+    cache.bulk_save_raw([dict(product='test', uris=[], metadata=dict(id=str(u))) for u in uu])
+    cache.put_group('b', uu[4:])
+
+    # older versions stored whatever order/duplicates put_group was given
+    def legacy(tr):
+        tr.put(b'a', uuids2bytes(uu[5::-1] + uu[:2]), db=cache._dbs.groups)
+        for k in (b'groups/format', b'groups/members'):
+            tr.delete(k, db=cache._dbs.info)
+
+    cache._write(legacy)
+    cache.close()
+
+    cache = open_rw(path)
+    assert cache.get_group('a') == uu[:6]
+    assert bytes2uuids(cache.group_intersection('a', 'b')) == uu[4:6]
+    assert bytes2uuids(cache.group_difference('a', 'b')) == uu[:4]
+
+    cache.bulk_delete([uu[0]])
+    cache.close()
+
+    cache = open_rw(path)
+    assert cache._groups_sorted
+    assert cache.get_group('a') == uu[1:6]
+    cache.merge_groups({'a': uu[8:]})
+    assert bytes2uuids(cache.group_intersection('a', 'b')) == uu[4:6] + uu[8:]
+    cache.close()
+
+
+def test_get_many(tmp_path):
+    cache = create_cache(str(tmp_path/'many.lmdb'))
+    cache.bulk_save_raw([dict(product='test', uris=[], metadata=dict(id=str(UUID(int=i))))
+                         for i in range(1, 6)])
+
+    # results follow input order, missing ids are None, duplicates are allowed
+    uu = [UUID(int=4), UUID(int=9), str(UUID(int=1)), UUID(int=3), UUID(int=0), UUID(int=4)]
+    docs = cache.get_many(uu, raw=True)
+    assert [None if d is None else d.id for d in docs] == [UUID(int=4), None, UUID(int=1),
+                                                           UUID(int=3), None, UUID(int=4)]
+    assert cache.get_many([]) == []
+    cache.close()
+
+
+def test_format_versions(tmp_path):
+    def mk_doc(i, product):
+        return dict(product=product,
+                    uris=['file:///{}/{}.yaml'.format(product, i)],
+                    metadata=dict(id=str(UUID(int=i)),
+                                  product=product,
+                                  tile=[i % 7, i % 11],
+                                  bands={b: dict(path='{}_{}_{}.tif'.format(product, b, i))
+                                         for b in ('red', 'green', 'blue', product + '_extra')}))
+
+    docs = [mk_doc(i, p) for i, p in enumerate(['aa', 'bb', 'cc']*100, start=1)]
+    zdicts = train_product_dictionaries(docs[:200], dict_sz=4*1024)
+    zdict = train_dictionary(docs, dict_sz=4*1024)
+
+    # per product dictionaries for aa, bb; cc falls back to the default one
+    path = str(tmp_path/'v2.lmdb')
+    cache = create_cache(path, zdict=zdict, zdicts=toolz.keyfilter(lambda p: p != 'cc', zdicts))
+    cache.bulk_save_raw(docs)
+
+    def dict_id(i):
+        with cache._dbs.main.begin(cache._dbs.ds) as tr:
+            return zstandard.get_frame_parameters(tr.get(key_to_bytes(UUID(int=i)))).dict_id
+
+    assert [dict_id(i) for i in (1, 2, 3)] == [mk_zdict(zd).dict_id()
+                                               for zd in (zdicts['aa'], zdicts['bb'], zdict)]
+    assert [d.doc for d in cache.get_many([UUID(int=i) for i in range(1, 7)], raw=True)] == docs[:6]
+    cache.close()
+
+    # 0001 -- single dictionary, no codec field, no extents or membership indexes
+    path = str(tmp_path/'v1.lmdb')
+    cache = create_cache(path, zdict=zdict)
+    cache.bulk_save_raw(docs)
+    cache.put_group('g', [UUID(int=i) for i in (5, 1)])
+
+    def downgrade(tr):
+        for name in (b'extents', b'extent_ids', b'group_members'):
+            tr.drop(cache._dbs.main.open_db(name, txn=tr), delete=True)
+        with tr.cursor(db=cache._dbs.info) as c:
+            keys = [k for k in c.iternext(values=False) if k.startswith((b'extents/', b'groups/'))]
+        for k in keys + [b'codec']:
+            tr.delete(k, db=cache._dbs.info)
+        tr.put(b'version', b'0001', db=cache._dbs.info)
+
+    cache._write(downgrade)
+    cache.close()
+
+    cache = open_ro(path)
+    assert cache.count == len(docs)
+    assert cache.get(UUID(int=4), raw=True).doc == docs[3]
+    assert [d.doc for d in cache.stream_group('g', raw=True)] == [docs[0], docs[4]]
+    assert sorted(d.id for d in cache.get_all(raw=True)) == [UUID(int=i) for i in range(1, 301)]
+    cache.close()
+
+
+def test_codecs(tmp_path):
+    docs = [dict(product='test',
+                 uris=['file:///{}.yaml'.format(i)],
+                 metadata=dict(id=str(UUID(int=i)), n=i, x=i/3, flag=i % 2 == 0,
+                               label='тест-{}'.format(i), missing=None, lon=[i, i + 1.5]))
+            for i in range(1, 51)]
+
+    for name in available_codecs():
+        try:
+            get_codec(name)
+        except ValueError:
+            continue  # optional dependency is not installed
+
+        path = str(tmp_path/'{}.lmdb'.format(name))
+        cache = create_cache(path, codec=name, zdict=train_dictionary(docs, dict_sz=2*1024, codec=name))
+        cache.bulk_save_raw(docs)
+        cache.close()
+
+        cache = open_ro(path)
+        assert cache._decoder._codec == name
+        assert [d.doc for d in cache.get_many([UUID(int=i) for i in range(1, 51)], raw=True)] == docs
+        cache.close()
+
+
+def test_lru(tmp_path):
+    product = SimpleNamespace(name='test',
+                              metadata_type=SimpleNamespace(name='test', definition={}),
+                              definition=dict(name='test', metadata_type='test'))
+
+    def mk_doc(i, v=0):
+        return dict(product='test', uris=[], metadata=dict(id=str(UUID(int=i)), v=v))
+
+    def mk_ds(i, v=0):
+        doc = mk_doc(i, v)
+        return SimpleNamespace(id=UUID(int=i), type=product, uris=doc['uris'], metadata_doc=doc['metadata'])
+
+    cache = create_cache(str(tmp_path/'lru.lmdb'))
+    cache.bulk_save_raw([mk_doc(i) for i in range(1, 4)])
+    assert cache.lru_stats() is None
+
+    cache.enable_lru()
+    uu = [UUID(int=i) for i in range(1, 4)]
+
+    def versions():
+        return [None if d is None else d.doc['metadata']['v'] for d in cache.get_many(uu, raw=True)]
+
+    assert versions() == [0, 0, 0]
+    assert versions() == [0, 0, 0]
+    st = cache.lru_stats()
+    assert (st.hits, st.misses, st.entries) == (3, 3, 3)
+
+    # writes and deletes through this object are visible straight away
+    cache.bulk_save_raw([mk_doc(1, 1)])
+    cache.bulk_save([mk_ds(2, 2)])
+    cache.bulk_delete([uu[2]])
+    assert versions() == [1, 2, None]
+    assert cache.lru_stats().entries == 2
+
+    cache.enable_lru(None)
+    assert cache.lru_stats() is None
+    cache.close()
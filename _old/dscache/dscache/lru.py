@@ -0,0 +1,76 @@
+"""
+Least recently used cache with a memory budget, used for decoded documents.
+"""
+import collections
+import threading
+from types import SimpleNamespace
+
+
+class LRU(object):
+    """ Maps key -> value, evicting least recently used entries once total
+    size of stored values goes over `max_bytes`.
+
+    Sizes are supplied by the caller on insert, they don't need to be exact.
+    Safe to use from several threads.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self._misses += 1
+                return default
+
+            self._hits += 1
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[1]
+
+            self._items[key] = (value, nbytes)
+            self._nbytes += nbytes
+
+            while self._nbytes > self.max_bytes:
+                _, (_, sz) = self._items.popitem(last=False)
+                self._nbytes -= sz
+                self._evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None:
+                self._nbytes -= item[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        """ Get SimpleNamespace(hits, misses, evictions, entries, nbytes, max_bytes)
+        """
+        with self._lock:
+            return SimpleNamespace(hits=self._hits,
+                                   misses=self._misses,
+                                   evictions=self._evictions,
+                                   entries=len(self._items),
+                                   nbytes=self._nbytes,
+                                   max_bytes=self.max_bytes)
@@ -0,0 +1,141 @@
+"""
+Helpers for running chunked work on a pool of workers.
+"""
+import collections
+import concurrent.futures as fut
+import multiprocessing
+import queue
+import threading
+
+
+def default_nprocs():
+    return multiprocessing.cpu_count()
+
+
+def pmap(proc, chunks, pool, prefetch=None, ordered=True):
+    """Like `map(proc, chunks)` but runs on a `concurrent.futures` executor.
+
+    At most `prefetch` chunks are submitted to the pool at any given time, so
+    a lazy input stream is only consumed as fast as workers can process it.
+
+    :param proc: Function to apply, has to be picklable when using process pool
+    :param chunks: Stream of inputs to `proc` (can be lazy)
+    :param pool: Executor to submit work to
+    :param prefetch: Maximum number of chunks in flight, defaults to 2 per worker
+    :param ordered: When False results are returned as soon as they are ready
+    """
+    if prefetch is None:
+        prefetch = 2*getattr(pool, '_max_workers', default_nprocs())
+
+    chunks = iter(chunks)
+    pending = collections.deque()
+
+    def fill():
+        while len(pending) < prefetch:
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            pending.append(pool.submit(proc, chunk))
+
+    try:
+        fill()
+        while pending:
+            if ordered:
+                f = pending.popleft()
+            else:
+                done, _ = fut.wait(pending, return_when=fut.FIRST_COMPLETED)
+                f = done.pop()
+                pending.remove(f)
+
+            yield f.result()
+            fill()
+    finally:
+        for f in pending:
+            f.cancel()
+
+
+def pmap_stream(proc, chunks, nprocs=None, pool=None, prefetch=None, ordered=True, mp_context=None):
+    """Same as `pmap` but creates and shuts down a process pool when `pool` is
+    not supplied.
+
+    :param nprocs: Number of worker processes, defaults to number of cores
+    :param mp_context: Multiprocessing start method, workers that open LMDB
+                       environments should use 'spawn' as these can not be
+                       shared across `fork`
+    """
+    if pool is not None:
+        yield from pmap(proc, chunks, pool, prefetch=prefetch, ordered=ordered)
+        return
+
+    if isinstance(mp_context, str):
+        mp_context = multiprocessing.get_context(mp_context)
+
+    with fut.ProcessPoolExecutor(max_workers=nprocs or default_nprocs(),
+                                 mp_context=mp_context) as pool:
+        yield from pmap(proc, chunks, pool, prefetch=prefetch, ordered=ordered)
+
+
+def merge_streams(streams, max_buffer=1000, ordered=False):
+    """Consume several streams concurrently, each on its own thread, and
+    return items as they arrive.
+
+    Useful for IO bound producers like database cursors. Producers block once
+    `max_buffer` items are waiting to be consumed. Exceptions raised by any of
+    the producers are re-raised in the calling thread.
+
+    :param streams: List of iterables (or functions returning iterables, called on the worker thread)
+    :param max_buffer: Maximum number of items waiting to be consumed (per stream when `ordered`)
+    :param ordered: Return all items of the first stream, then all items of the
+                    second one and so on, streams are still consumed
+                    concurrently, each one buffering up to `max_buffer` items
+    """
+    stop = threading.Event()
+    EOS = object()
+
+    if ordered:
+        queues = [queue.Queue(max_buffer) for _ in streams]
+    else:
+        queues = [queue.Queue(max_buffer)]*len(streams)
+
+    def run(stream, q):
+        try:
+            if callable(stream):
+                stream = stream()
+            for item in stream:
+                if stop.is_set():
+                    break
+                q.put((item, None))
+        except Exception as e:
+            q.put((EOS, e))
+        else:
+            q.put((EOS, None))
+
+    threads = [threading.Thread(target=run, args=(s, q), daemon=True) for s, q in zip(streams, queues)]
+    for t in threads:
+        t.start()
+
+    def drain(q, n_running):
+        while n_running > 0:
+            item, err = q.get()
+            if item is EOS:
+                n_running -= 1
+                if err is not None:
+                    raise err
+            else:
+                yield item
+
+    try:
+        if ordered:
+            for q in queues:
+                yield from drain(q, 1)
+        else:
+            yield from drain(queues[0] if queues else None, len(threads))
+    finally:
+        stop.set()
+        # unblock producers waiting on a full queue
+        while any(t.is_alive() for t in threads):
+            for q in set(queues):
+                try:
+                    q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
@@ -0,0 +1,236 @@
+"""
+Serve one cache file to many local processes over a Unix socket.
+
+Server keeps a single read-only environment open and decompresses documents
+on behalf of clients, so client processes don't need to open the cache or
+set up decompressors themselves. Documents are sent as decompressed bytes
+and parsed by the client, only when fields are accessed (see `LazyDoc`), so
+parsing cost is spread across clients rather than paid on the server.
+
+Requests are `(op, kwargs)` tuples, responses are `('ok', result)` or
+`('error', message)`, both sent with `multiprocessing.connection`. Streaming
+operations (`get_group_docs`, `query`) send any number of `('batch', [bytes])`
+messages before the final `('ok', None)`.
+
+Messages are pickled, so only trusted processes should be able to connect:
+the socket is only accessible by the owner, and an `authkey` shared by server
+and clients can be supplied on top of that.
+"""
+import os
+import threading
+import toolz
+from uuid import UUID
+from multiprocessing.connection import Listener, Client
+from .dscache import open_ro, bytes2uuids, uuids2bytes, LazyProductMap, LazyDoc
+from .codecs import get_codec
+
+
+class CacheServer(object):
+    """ Answers batched lookups against a read-only cache.
+
+    :param authkey: Optional bytes, clients have to supply the same key
+    :param batch_size: Number of documents per message for streaming operations
+    """
+    def __init__(self, path, address, lock=False, authkey=None, batch_size=1000):
+        self._cache = open_ro(path, lock=lock)
+        self._address = address
+        self._authkey = authkey
+        self._batch_size = batch_size
+        self._listener = None
+        self._ops = dict(get_many=self._get_many,
+                         get_group=self._get_group,
+                         groups=self._groups,
+                         products=self._products,
+                         codec=self._codec,
+                         count=self._count)
+        self._streams = dict(get_group_docs=self._get_group_docs,
+                             query=self._query)
+
+    def _get_many(self, uuids):
+        return [None if doc is None else doc.raw
+                for doc in self._cache.get_many(uuids, raw=True)]
+
+    def _get_group(self, name):
+        uu = self._cache.get_group_array(name)
+        return None if uu is None else uuids2bytes(uu)
+
+    def _get_group_docs(self, name):
+        return (doc.raw for doc in self._cache.stream_group(name, raw=True))
+
+    def _query(self, bbox=None, time=None, product=None):
+        return (doc.raw for doc in self._cache.query(bbox=bbox, time=time, product=product, raw=True))
+
+    def _groups(self):
+        return self._cache.groups()
+
+    def _products(self):
+        metadata, products = self._cache.products.raw_docs()
+        return dict(metadata=metadata, products=products)
+
+    def _codec(self):
+        return self._cache._decoder._codec
+
+    def _count(self):
+        return self._cache.count
+
+    def handle(self, op, kwargs):
+        proc = self._ops.get(op)
+        if proc is None:
+            return ('error', 'Unknown operation: {}'.format(op))
+        try:
+            return ('ok', proc(**kwargs))
+        except Exception as e:
+            return ('error', '{}: {}'.format(e.__class__.__name__, str(e)))
+
+    def handle_stream(self, op, kwargs):
+        """ Generate response messages for a streaming operation """
+        try:
+            for batch in toolz.partition_all(self._batch_size, self._streams[op](**kwargs)):
+                yield ('batch', list(batch))
+        except Exception as e:
+            yield ('error', '{}: {}'.format(e.__class__.__name__, str(e)))
+            return
+        yield ('ok', None)
+
+    def _serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    op, kwargs = conn.recv()
+                except EOFError:
+                    break
+
+                if op in self._streams:
+                    for msg in self.handle_stream(op, kwargs):
+                        conn.send(msg)
+                else:
+                    conn.send(self.handle(op, kwargs))
+
+    def serve_forever(self):
+        """ Accept connections until `close` is called, one thread per client.
+        """
+        if os.path.exists(self._address):
+            os.unlink(self._address)
+
+        # socket is created with owner only permissions, no window where others can connect
+        umask = os.umask(0o177)
+        try:
+            self._listener = Listener(self._address, family='AF_UNIX', authkey=self._authkey)
+        finally:
+            os.umask(umask)
+        os.chmod(self._address, 0o600)
+
+        try:
+            while True:
+                try:
+                    conn = self._listener.accept()
+                except OSError:
+                    break  # listener was closed
+                threading.Thread(target=self._serve_connection,
+                                 args=(conn,),
+                                 daemon=True).start()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+
+class CacheClient(object):
+    """ Client side of `CacheServer`, mirrors read methods of `DatasetCache`.
+
+    Documents are returned as `LazyDoc` when `raw=True`, otherwise `Dataset`
+    objects are constructed. Product definitions are fetched from the server
+    on first use, but only products that are seen in documents are
+    constructed.
+
+    Streaming methods (`get_group_docs`, `query`) return generators, these
+    should be consumed (or closed) before making other calls.
+    """
+    def __init__(self, address, authkey=None):
+        self._conn = Client(address, family='AF_UNIX', authkey=authkey)
+        self._products = None
+        self._loads = None
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _call(self, op, **kwargs):
+        self._conn.send((op, kwargs))
+        status, result = self._conn.recv()
+        if status != 'ok':
+            raise RuntimeError(result)
+        return result
+
+    def _stream(self, op, **kwargs):
+        self._conn.send((op, kwargs))
+        status = 'batch'
+        try:
+            while True:
+                status, result = self._conn.recv()
+                if status != 'batch':
+                    break
+                yield from result
+        finally:
+            # rest of the response has to be read before connection can be used again
+            while status == 'batch':
+                status, result = self._conn.recv()
+
+        if status != 'ok':
+            raise RuntimeError(result)
+
+    @property
+    def products(self):
+        if self._products is None:
+            pp = self._call('products')
+            self._products = LazyProductMap(pp['metadata'].items(), pp['products'].items())
+        return self._products
+
+    def _setup(self):
+        """ Fetch what's needed to decode documents, has to happen before starting a stream """
+        if self._loads is None:
+            self._loads = get_codec(self._call('codec')).loads
+        return self.products
+
+    def _to_ds(self, data, raw):
+        if data is None:
+            return None
+        doc = LazyDoc(data, products=self._products, loads=self._loads)
+        return doc if raw else doc.ds
+
+    @property
+    def count(self):
+        return self._call('count')
+
+    def get(self, uuid, raw=False):
+        return self.get_many([uuid], raw=raw)[0]
+
+    def get_many(self, uuids, raw=False):
+        uuids = [UUID(u) if isinstance(u, str) else u for u in uuids]
+        self._setup()
+        return [self._to_ds(data, raw) for data in self._call('get_many', uuids=uuids)]
+
+    def get_group(self, name):
+        data = self._call('get_group', name=name)
+        return None if data is None else bytes2uuids(data)
+
+    def get_group_docs(self, name, raw=False):
+        self._setup()
+        for data in self._stream('get_group_docs', name=name):
+            yield self._to_ds(data, raw)
+
+    def query(self, bbox=None, time=None, product=None, raw=False):
+        self._setup()
+        for data in self._stream('query', bbox=bbox, time=time, product=product):
+            yield self._to_ds(data, raw)
+
+    def groups(self):
+        return self._call('groups')
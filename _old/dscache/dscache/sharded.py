@@ -0,0 +1,491 @@
+"""
+Dataset cache split across several LMDB files.
+
+Keyspace is partitioned by uuid prefix into `nshards` contiguous ranges, one
+LMDB environment per range, so iterating shards in order visits datasets in
+the same order as a single cache would. Groups are stored partitioned the
+same way, each shard only records members that live in it.
+
+Shards are independent, so writes to different shards run concurrently on a
+thread per shard, and streaming reads consume all shards at once.
+
+Layout on disk:
+
+    <path>/shards.json      -- {"nshards": N, "partition": "uuid"}
+    <path>/shard-000.db ... -- regular caches, see `DatasetCache`
+"""
+import collections
+import functools
+import itertools
+import json
+import multiprocessing
+import queue
+import toolz
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from uuid import UUID
+from .dscache import (create_cache, open_ro, open_rw, maybe_delete_db,
+                      key_to_bytes, uuid_array, bytes2uuids, bytes2uuid_array,
+                      UUID_DTYPE)
+from .parallel import pmap_stream, merge_streams
+
+MANIFEST = 'shards.json'
+SHARD_FMT = 'shard-{:03d}.db'
+MAX_SHARDS = 1 << 16
+
+
+def shard_index(k, nshards):
+    """ Shard a given 16 byte key belongs to """
+    return (int.from_bytes(k[:2], 'big')*nshards) >> 16
+
+
+def _to_key(u):
+    return key_to_bytes(UUID(u) if isinstance(u, str) else u)
+
+
+def _doc_key(ds):
+    if isinstance(ds, dict):
+        return UUID(toolz.get_in(['metadata', 'id'], ds)).bytes
+    return key_to_bytes(ds.id)
+
+
+def _shard_writer(path, queue, max_transaction_size):
+    """ Runs on a worker process, saves chunks of encoded documents to one shard """
+    cache = open_rw(path)
+    batch = []
+
+    def flush():
+        cache._write(functools.partial(cache._save_encoded, batch=batch))
+
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+
+        kvs, products = item
+        if products:
+            cache.add_products(products)
+
+        batch.extend(kvs)
+        if len(batch) >= max_transaction_size:
+            flush()
+            batch = []
+
+    if batch:
+        flush()
+
+    cache.close()
+
+
+class ShardedCache(object):
+    """ Same API as `DatasetCache`, but data is spread across several files.
+
+    Use `create_sharded_cache` or `open_sharded` to construct.
+    """
+    def __init__(self, path, shards):
+        self._path = Path(path)
+        self._shards = shards
+        self._groupers = []
+
+    @property
+    def nshards(self):
+        return len(self._shards)
+
+    @property
+    def shards(self):
+        return list(self._shards)
+
+    def _shard_paths(self):
+        return [str(self._path/SHARD_FMT.format(i)) for i in range(self.nshards)]
+
+    def _shard(self, k):
+        return self._shards[shard_index(k, self.nshards)]
+
+    def _partition(self, items, key):
+        """ Split items into per shard lists, returns [(shard, items)] for non-empty shards """
+        parts = collections.defaultdict(list)
+        for item in items:
+            parts[shard_index(key(item), self.nshards)].append(item)
+        return [(self._shards[idx], parts[idx]) for idx in sorted(parts)]
+
+    def _fan_out(self, pool, proc, parts):
+        """ Run `proc(shard, part)` for every `(shard, part)` concurrently, returns list of results """
+        if len(parts) == 1:
+            return [proc(*parts[0])]
+        return list(pool.map(lambda sp: proc(*sp), parts))
+
+    def _write_pool(self):
+        return ThreadPoolExecutor(self.nshards)
+
+    def _scan(self, shards, mk_stream, ordered=True, max_buffer=1000):
+        """Stream from several shards at once, each shard is read on its own thread.
+
+        :mk_stream: shard -> iterable
+        :ordered: Keep key order, items of the first shard first, otherwise
+                  items are returned as they arrive
+        """
+        if len(shards) == 1:
+            return mk_stream(shards[0])
+        return merge_streams([functools.partial(mk_stream, shard) for shard in shards],
+                             max_buffer=max_buffer,
+                             ordered=ordered)
+
+    @property
+    def readonly(self):
+        return self._shards[0].readonly
+
+    @property
+    def products(self):
+        return collections.ChainMap(*[shard.products for shard in self._shards])
+
+    def add_products(self, products):
+        products = list(products)
+        for shard in self._shards:
+            shard.add_products(products)
+
+    def add_grouper(self, grouper):
+        """ See `DatasetCache.add_grouper` """
+        self._groupers.append(grouper)
+        for shard in self._shards:
+            shard.add_grouper(grouper)
+
+    def sync(self):
+        for shard in self._shards:
+            shard.sync()
+
+    def close(self):
+        for shard in self._shards:
+            shard.close()
+
+    @property
+    def count(self):
+        return sum(shard.count for shard in self._shards)
+
+    def bulk_save(self, dss, max_transaction_size=10000):
+        """ See `DatasetCache.bulk_save`, shards are written concurrently """
+        with self._write_pool() as pool:
+            for chunk in toolz.partition_all(max_transaction_size, dss):
+                self._fan_out(pool, lambda shard, part: shard.bulk_save(part),
+                              self._partition(chunk, _doc_key))
+
+    def bulk_save_raw(self, raw_dss, max_transaction_size=10000):
+        """ See `DatasetCache.bulk_save_raw`, shards are written concurrently """
+        with self._write_pool() as pool:
+            for chunk in toolz.partition_all(max_transaction_size, raw_dss):
+                self._fan_out(pool, lambda shard, part: shard.bulk_save_raw(part),
+                              self._partition(chunk, _doc_key))
+
+    def tee(self, dss, max_transaction_size=10000):
+        """ See `DatasetCache.tee`, shards are written concurrently """
+        with self._write_pool() as pool:
+            for chunk in toolz.partition_all(max_transaction_size, dss):
+                self._fan_out(pool, lambda shard, part: shard.bulk_save(part),
+                              self._partition(chunk, _doc_key))
+                yield from chunk
+
+    def bulk_save_parallel(self, dss,
+                           nprocs=None,
+                           pool=None,
+                           chunk_size=1000,
+                           prefetch=None,
+                           max_transaction_size=10000,
+                           timeout=1.0):
+        """Save a stream of datasets or raw documents, see `DatasetCache.bulk_save_parallel`.
+
+        Serialisation and compression happen on a pool of workers, encoded
+        documents are then routed to one writer process per shard, so shards
+        are written concurrently.
+
+        :dss: Stream of Dataset objects, raw documents or (product, text) tuples
+        :nprocs int: Number of encoding worker processes, defaults to number of cores
+        :pool: `concurrent.futures` executor to use for encoding instead of creating one
+        :chunk_size int: Number of documents per unit of work, and per message to a writer
+        :prefetch int: Maximum number of chunks being encoded
+        :max_transaction_size int: How often shard writers commit results to disk
+        :timeout float: How often to check that shard writers are still alive while waiting on them
+        """
+        paths = self._shard_paths()
+        shard0 = self._shards[0]
+        known_products = set(self.products)
+        new_products = []
+
+        def work_item(ds):
+            if not isinstance(ds, (dict, tuple)) and ds.type.name not in known_products:
+                known_products.add(ds.type.name)
+                new_products.append(ds.type)
+            return shard0._work_item(ds)
+
+        ctx = multiprocessing.get_context('spawn')
+        queues = [ctx.Queue(2) for _ in paths]
+        workers = [ctx.Process(target=_shard_writer, args=(path, q, max_transaction_size))
+                   for path, q in zip(paths, queues)]
+        for w in workers:
+            w.start()
+
+        def put(idx, item):
+            w = workers[idx]
+            while True:
+                if not w.is_alive():
+                    raise RuntimeError('Shard writer {} died, exit code: {}'.format(idx, w.exitcode))
+                try:
+                    queues[idx].put(item, timeout=timeout)
+                    return
+                except queue.Full:
+                    pass
+
+        pending = [[] for _ in paths]
+        pending_products = [[] for _ in paths]
+
+        def flush(idx):
+            put(idx, (pending[idx], pending_products[idx]))
+            pending[idx], pending_products[idx] = [], []
+
+        chunks = toolz.partition_all(chunk_size, map(work_item, dss))
+        kvs = itertools.chain.from_iterable(pmap_stream(shard0._encoder.encode_chunk, chunks,
+                                                        nprocs=nprocs,
+                                                        pool=pool,
+                                                        prefetch=prefetch))
+        try:
+            for kv in kvs:
+                if new_products:
+                    for pp in pending_products:
+                        pp.extend(new_products)
+                    new_products.clear()
+
+                idx = shard_index(kv[0], len(paths))
+                pending[idx].append(kv)
+                if len(pending[idx]) >= chunk_size:
+                    flush(idx)
+
+            for idx in range(len(paths)):
+                if pending[idx] or pending_products[idx]:
+                    flush(idx)
+        finally:
+            for idx in range(len(paths)):
+                try:
+                    put(idx, None)
+                except RuntimeError:
+                    pass
+            for w in workers:
+                w.join()
+            for q in queues:
+                # data sent to a dead writer is never consumed, don't wait on it at exit
+                q.cancel_join_thread()
+
+            # Shards are re-opened, products and extents bookkeeping kept in
+            # memory is stale once writers are done
+            self.close()
+            self._shards = [open_rw(path) for path in paths]
+            for grouper in self._groupers:
+                for shard in self._shards:
+                    shard.add_grouper(grouper)
+
+        failed = [i for i, w in enumerate(workers) if w.exitcode != 0]
+        if failed:
+            raise RuntimeError('Shard writers failed: {}'.format(failed))
+
+    def bulk_delete(self, uuids, max_transaction_size=10000):
+        """ See `DatasetCache.bulk_delete`, shards are written concurrently """
+        n = 0
+        with self._write_pool() as pool:
+            for chunk in toolz.partition_all(max_transaction_size, map(_to_key, uuids)):
+                n += sum(self._fan_out(pool, lambda shard, part: shard.bulk_delete(part, max_transaction_size),
+                                       self._partition(chunk, lambda k: k)))
+        return n
+
+    def get(self, uuid, raw=False):
+        k = _to_key(uuid)
+        return self._shard(k).get(k, raw=raw)
+
+    def get_many(self, uuids, raw=False):
+        """ See `DatasetCache.get_many`, results are in the same order as input """
+        keys = [_to_key(u) for u in uuids]
+        out = [None]*len(keys)
+
+        for shard, part in self._partition(range(len(keys)), keys.__getitem__):
+            for idx, ds in zip(part, shard.get_many([keys[i] for i in part], raw=raw)):
+                out[idx] = ds
+
+        return out
+
+    def get_all(self, raw=False, ordered=True, **kwargs):
+        """See `DatasetCache.get_all`, all shards are read concurrently.
+
+        :ordered bool: Return datasets in key order, otherwise as they are decoded
+        """
+        return self._scan(self._shards,
+                          lambda shard: shard.get_all(raw=raw, ordered=ordered, **kwargs),
+                          ordered=ordered)
+
+    def get_range(self, start=None, stop=None, raw=False, ordered=True):
+        """ See `DatasetCache.get_range` and `get_all` """
+        return self._scan(self._shards,
+                          lambda shard: shard.get_range(start, stop, raw=raw),
+                          ordered=ordered)
+
+    def query(self, bbox=None, time=None, product=None, raw=False, batch_size=1000, ordered=True):
+        """ See `DatasetCache.query` and `get_all` """
+        return self._scan(self._shards,
+                          lambda shard: shard.query(bbox=bbox, time=time, product=product,
+                                                    raw=raw, batch_size=batch_size),
+                          ordered=ordered)
+
+    def put_group(self, name, uuids):
+        uu = uuid_array(uuids)
+        edges = self._group_edges(uu)
+        for shard, (i0, i1) in zip(self._shards, zip(edges[:-1], edges[1:])):
+            shard.put_group(name, uu[i0:i1])
+
+    def _group_edges(self, uu):
+        """ Split points of a sorted uuid array between shards """
+        bounds = [i.to_bytes(2, 'big') + bytes(14)
+                  for i in ((s*(1 << 16) + self.nshards - 1)//self.nshards for s in range(1, self.nshards))]
+        bounds = np.frombuffer(b''.join(bounds), dtype=UUID_DTYPE)
+        return [0] + np.searchsorted(uu, bounds).tolist() + [uu.shape[0]]
+
+    def merge_groups(self, groups, replace=()):
+        """ See `DatasetCache.merge_groups` """
+        parts = [{} for _ in self._shards]
+        for name, uu in groups.items():
+            uu = uuid_array(bytes2uuid_array(uu) if isinstance(uu, bytes) else uu)
+            edges = self._group_edges(uu)
+            for part, (i0, i1) in zip(parts, zip(edges[:-1], edges[1:])):
+                part[name] = uu[i0:i1]
+
+        for shard, part in zip(self._shards, parts):
+            shard.merge_groups(part, replace=replace)
+
+    def get_group_array(self, name):
+        parts = [shard.get_group_array(name) for shard in self._shards]
+        parts = [p for p in parts if p is not None]
+        if not parts:
+            return None
+        return np.concatenate(parts)
+
+    def get_group(self, name):
+        uu = self.get_group_array(name)
+        return None if uu is None else bytes2uuids(uu)
+
+    def groups(self, raw=False):
+        sizes = collections.OrderedDict()
+        for shard in self._shards:
+            for name, n in shard.groups(raw=raw):
+                sizes[name] = sizes.get(name, 0) + n
+        return sorted(sizes.items())
+
+    def stream_group(self, group_name, raw=False, ordered=True, **kwargs):
+        """ See `DatasetCache.stream_group` and `get_all` """
+        shards = [shard for shard in self._shards if shard.get_group_array(group_name) is not None]
+        if not shards:
+            raise ValueError('No such group: %s' % group_name)
+
+        return self._scan(shards,
+                          lambda shard: shard.stream_group(group_name, raw=raw, ordered=ordered, **kwargs),
+                          ordered=ordered)
+
+    def put_udata(self, key, value):
+        self._shards[0].put_udata(key, value)
+
+    def get_udata(self, key, default=None):
+        return self._shards[0].get_udata(key, default)
+
+
+def _read_manifest(path):
+    fname = Path(path)/MANIFEST
+    if not fname.exists():
+        raise ValueError('Not a sharded cache: {}'.format(path))
+    with open(str(fname), 'rt') as f:
+        return json.load(f)
+
+
+def create_sharded_cache(path, nshards=4, truncate=False, **kwargs):
+    """Create new sharded cache, or open existing one in append mode.
+
+    :path str: Directory to store shards in
+    :nshards int: Number of LMDB files to split datasets across
+    :truncate bool: Delete existing shards first
+
+    Other parameters are passed on to `create_cache` for every shard,
+    `max_db_sz` applies per shard.
+    """
+    path = Path(path)
+
+    if truncate and (path/MANIFEST).exists():
+        for i in range(_read_manifest(path)['nshards']):
+            maybe_delete_db(str(path/SHARD_FMT.format(i)))
+        (path/MANIFEST).unlink()
+
+    if (path/MANIFEST).exists():
+        return open_sharded(path, readonly=False)
+
+    if not (0 < nshards <= MAX_SHARDS):
+        raise ValueError('Number of shards should be in [1, {}]'.format(MAX_SHARDS))
+
+    path.mkdir(parents=True, exist_ok=True)
+    shards = [create_cache(str(path/SHARD_FMT.format(i)), **kwargs) for i in range(nshards)]
+
+    with open(str(path/MANIFEST), 'wt') as f:
+        json.dump(dict(nshards=nshards, partition='uuid'), f)
+
+    return ShardedCache(path, shards)
+
+
+def open_sharded(path, readonly=True, **kwargs):
+    """Open existing sharded cache.
+
+    :readonly bool: Open in read-only mode (default), otherwise append mode
+    Other parameters are passed on to `open_ro` or `open_rw` for every shard.
+    """
+    manifest = _read_manifest(path)
+    if manifest.get('partition', 'uuid') != 'uuid':
+        raise ValueError('Unsupported partition scheme: {}'.format(manifest['partition']))
+
+    opener = open_ro if readonly else open_rw
+    shards = [opener(str(Path(path)/SHARD_FMT.format(i)), **kwargs)
+              for i in range(manifest['nshards'])]
+
+    return ShardedCache(path, shards)
+
+
+def test_sharded_cache(tmp_path):
+    nshards = 3
+    uu = [UUID(int=(i*37 % 256) << 120 | i) for i in range(100)]
+    docs = [dict(product='test', uris=[], metadata=dict(id=str(u))) for u in uu]
+
+    cache = create_sharded_cache(str(tmp_path/'sharded'), nshards=nshards)
+    cache.bulk_save_raw(docs, max_transaction_size=30)
+    assert cache.count == len(uu)
+
+    # routing: every shard holds its part of the keyspace, in key order overall
+    for idx, shard in enumerate(cache.shards):
+        ids = [d.id for d in shard.get_all(raw=True)]
+        assert ids and all(shard_index(u.bytes, nshards) == idx for u in ids)
+    assert [d.id for d in cache.get_all(raw=True)] == sorted(uu)
+    assert sorted(d.id for d in cache.get_all(raw=True, ordered=False)) == sorted(uu)
+
+    missing = UUID(int=1)
+    assert [None if d is None else d.id for d in cache.get_many([uu[7], missing, uu[3]], raw=True)] == [uu[7], None, uu[3]]
+
+    # groups are split at shard boundaries
+    g = uuid_array(uu[::3])
+    edges = cache._group_edges(g)
+    assert edges[0] == 0 and edges[-1] == g.shape[0] and edges == sorted(edges)
+    for idx, (i0, i1) in enumerate(zip(edges[:-1], edges[1:])):
+        assert all(shard_index(k, nshards) == idx for k in g[i0:i1].tolist())
+
+    cache.put_group('g', uu[::3])
+    assert cache.get_group('g') == sorted(uu[::3])
+    assert [d.id for d in cache.stream_group('g', raw=True)] == sorted(uu[::3])
+    assert cache.groups() == [('g', g.shape[0])]
+
+    # deletes go to the right shards and update groups
+    assert cache.bulk_delete(uu[:10] + [missing]) == 10
+    assert cache.count == len(uu) - 10
+    assert cache.get(uu[0]) is None
+    assert cache.get_group('g') == sorted(uu[12::3])
+    cache.close()
+
+    cache = open_sharded(str(tmp_path/'sharded'))
+    assert [d.id for d in cache.get_all(raw=True)] == sorted(uu[10:])
+    cache.close()
@@ -1,13 +1,20 @@
 """
 """
 import random
-from .. import train_dictionary
+from uuid import UUID
+from .. import train_dictionary, train_product_dictionaries
 
 
 def dictionary_from_product_list(dc,
                                  products,
                                  samples_per_product=10,
-                                 dict_sz=8*1024):
+                                 dict_sz=8*1024,
+                                 per_product=False):
+    """Train compression dictionary from a random sample of datasets.
+
+    :per_product bool: Train one dictionary per product instead, returns
+                       {product_name: zdict} in that case
+    """
 
     if isinstance(products, str):
         products = [products]
@@ -20,6 +27,9 @@ def dictionary_from_product_list(dc,
         random.shuffle(dss)
         samples.extend(dss[:samples_per_product])
 
+    if per_product:
+        return train_product_dictionaries(samples, dict_sz)
+
     return train_dictionary(samples, dict_sz)
 
 
@@ -86,3 +96,154 @@ and dataset_type_ref = (select id from agdc.dataset_type where name = %(product)
             yield ds
 
     cur.close()
+
+
+def raw_dataset_keyset_stream(product, db, after=None, read_chunk=1000):
+    """Like `raw_dataset_stream` but returns datasets ordered by id.
+
+    Export can be restarted from any point by supplying the id of the last
+    dataset processed. A single server side cursor is used, so the product
+    is only sorted once.
+
+    :param after: Only return datasets with id greater than this (UUID|str)
+    :param read_chunk: Number of rows to fetch from the server side cursor at a time
+    """
+    if isinstance(db, str) or db is None:
+        db = db_connect(db)
+
+    query = '''
+select
+jsonb_build_object(
+  'product', %(product)s,
+  'uris', array((select _loc_.uri_scheme ||':'||_loc_.uri_body
+                 from agdc.dataset_location as _loc_
+                 where _loc_.dataset_ref = agdc.dataset.id and _loc_.archived is null
+                 order by _loc_.added desc, _loc_.id desc)),
+  'metadata', metadata) as dataset
+from agdc.dataset
+where archived is null
+and dataset_type_ref = (select id from agdc.dataset_type where name = %(product)s)
+and (%(after)s::uuid is null or id > %(after)s::uuid)
+order by id;
+'''
+
+    after = None if after is None else str(after)
+
+    cur = db.cursor(name='c{:04X}'.format(random.randint(0, 0xFFFF)))
+    cur.execute(query, dict(product=product, after=after))
+
+    while True:
+        chunk = cur.fetchmany(read_chunk)
+        if not chunk:
+            break
+
+        for (ds,) in chunk:
+            yield ds
+
+    cur.close()
+
+
+def count_datasets(product, db, after=None):
+    """ Number of active datasets of a product, only counting ids greater than `after` if supplied """
+    if isinstance(db, str) or db is None:
+        db = db_connect(db)
+
+    query = '''
+select count(*)
+from agdc.dataset
+where archived is null
+and dataset_type_ref = (select id from agdc.dataset_type where name = %(product)s)
+and (%(after)s::uuid is null or id > %(after)s::uuid);
+'''
+
+    with db.cursor() as cur:
+        cur.execute(query, dict(product=product, after=None if after is None else str(after)))
+        (n,) = cur.fetchone()
+    return n
+
+
+def raw_dataset_text_stream(product, db, read_chunk=1000, limit=None, key_range=None):
+    """Like `raw_dataset_stream` but documents are returned as json text.
+
+    Documents are serialised by the database server, avoiding json parsing on
+    the client, they are parsed and re-serialised compactly by the
+    compression workers. Each item is a `(product, text)` tuple as understood
+    by `DatasetCache.bulk_save_parallel`.
+
+    :param read_chunk: Number of rows to fetch from the server side cursor at a time
+    :param key_range: (start, stop) bytes, only export datasets with
+                      `start <= id < stop`, see `dscache.key_ranges`
+    """
+    assert isinstance(limit, (int, type(None)))
+
+    if isinstance(db, str) or db is None:
+        db = db_connect(db)
+
+    start, stop = key_range or (None, None)
+    where_range = ''
+    if start is not None:
+        where_range += 'and id >= %(start)s\n'
+    if stop is not None:
+        where_range += 'and id < %(stop)s\n'
+
+    query = '''
+select
+jsonb_build_object(
+  'product', %(product)s,
+  'uris', array((select _loc_.uri_scheme ||':'||_loc_.uri_body
+                 from agdc.dataset_location as _loc_
+                 where _loc_.dataset_ref = agdc.dataset.id and _loc_.archived is null
+                 order by _loc_.added desc, _loc_.id desc)),
+  'metadata', metadata)::text as dataset
+from agdc.dataset
+where archived is null
+and dataset_type_ref = (select id from agdc.dataset_type where name = %(product)s)
+{where_range}{limit};
+'''.format(where_range=where_range,
+           limit='LIMIT {:d}'.format(limit) if limit else '')
+
+    def as_uuid(k):
+        return None if k is None else str(UUID(bytes=k))
+
+    cur = db.cursor(name='c{:04X}'.format(random.randint(0, 0xFFFF)))
+    cur.execute(query, dict(product=product, start=as_uuid(start), stop=as_uuid(stop)))
+
+    while True:
+        chunk = cur.fetchmany(read_chunk)
+        if not chunk:
+            break
+
+        for (ds,) in chunk:
+            yield (product, ds)
+
+    cur.close()
+
+
+def parallel_text_stream(products, cfg=None, split=1, read_chunk=1000, max_buffer=10000):
+    """Export several products concurrently, one server side cursor (and
+    connection) per product and key range.
+
+    :param products: List of product names
+    :param cfg: Datacube environment name or config, see `db_connect`
+    :param split: Number of key ranges to split each product into
+    :param read_chunk: Number of rows to fetch from the server at a time
+    :param max_buffer: Maximum number of documents fetched but not yet consumed
+    """
+    from .. import key_ranges
+    from ..parallel import merge_streams
+
+    def mk_stream(product, key_range):
+        def stream():
+            db = db_connect(cfg)
+            try:
+                yield from raw_dataset_text_stream(product, db,
+                                                   read_chunk=read_chunk,
+                                                   key_range=key_range)
+            finally:
+                db.close()
+        return stream
+
+    return merge_streams([mk_stream(p, r)
+                          for p in products
+                          for r in key_ranges(split)],
+                         max_buffer=max_buffer)
@@ -0,0 +1,127 @@
+import click
+import dscache
+
+
+@click.group('dscache')
+def cli():
+    pass
+
+
+@cli.command('sync')
+@click.option('--env', type=str, help='Datacube environment name')
+@click.option('--since', type=str, default=None,
+              help='Sync changes after this time instead of the one recorded in the cache')
+@click.option('--product', type=str, multiple=True,
+              help='Only sync these products (default is all products in the cache)')
+@click.option('--batch-size', type=int, default=10000,
+              help='Number of datasets per write transaction')
+@click.option('--group', type=click.Choice(['albers', 'native']), multiple=True,
+              help='Add new datasets to spatial groups, use the same values as were given to slurpy')
+@click.argument('dbfile', type=str, nargs=1)
+def sync(env, since, product, batch_size, group, dbfile):
+    """Update cache with datasets added or archived in the datacube since the last sync.
+    """
+    from .sync import sync_cache
+    from .tiling import mk_grid_grouper, mk_native_grouper
+
+    cache = dscache.open_rw(dbfile)
+
+    if 'albers' in group:
+        from .dstiler import GS_ALBERS, ALBERS_KEY_FMT
+        cache.add_grouper(mk_grid_grouper(GS_ALBERS, ALBERS_KEY_FMT))
+    if 'native' in group:
+        from .dstiler import NATIVE_KEY_FMT
+        cache.add_grouper(mk_native_grouper(NATIVE_KEY_FMT))
+
+    try:
+        rr = sync_cache(cache, env,
+                        products=list(product) or None,
+                        since=since,
+                        batch_size=batch_size)
+    except ValueError as e:
+        click.echo(str(e))
+        raise click.Abort()
+
+    click.echo('Changes since {}: {:,d} updated, {:,d} removed'.format(rr.since, rr.updated, rr.removed))
+    click.echo('Watermark is now {}'.format(rr.watermark))
+
+
+@cli.command('serve')
+@click.option('--socket', 'address', type=str, default=None,
+              help='Path of the Unix socket to listen on, defaults to <dbfile>.sock')
+@click.option('--lock/--no-lock', default=False,
+              help='Use LMDB locking, needed when cache is modified while being served')
+@click.argument('dbfile', type=str, nargs=1)
+def serve(address, lock, dbfile):
+    """Serve read-only lookups against a cache file to local processes, see `dscache.server.CacheClient`.
+    """
+    from ..server import CacheServer
+
+    address = address or dbfile.rstrip('/') + '.sock'
+    server = CacheServer(dbfile, address, lock=lock)
+
+    click.echo('Serving {} on {}'.format(dbfile, address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+@cli.command('compact')
+@click.argument('src', type=str, nargs=1)
+@click.argument('dst', type=str, nargs=1)
+def compact(src, dst):
+    """Write a compacted copy of a cache, dropping free pages and unused address space.
+    """
+    cache = dscache.open_ro(src)
+    cache.copy(dst, compact=True)
+    click.echo('Copied {:,d} datasets to {}'.format(cache.count, dst))
+
+
+@cli.command('export-parquet')
+@click.option('--jobs', '-j', type=int, default=None,
+              help='Number of worker processes for decoding, default is to decode on the main process')
+@click.option('--chunk-size', type=int, default=10000,
+              help='Number of datasets per row group')
+@click.argument('dbfile', type=str, nargs=1)
+@click.argument('output', type=str, nargs=1)
+def export_parquet(jobs, chunk_size, dbfile, output):
+    """Write flattened dataset fields (id, product, uris, time, bbox, region
+    code, cloud cover) to a Parquet file.
+    """
+    from .export import export_parquet
+
+    cache = dscache.open_ro(dbfile)
+    n = export_parquet(cache, output, nprocs=jobs, chunk_size=chunk_size)
+    click.echo('Wrote {:,d} datasets to {}'.format(n, output))
+
+
+@cli.command('from-json')
+@click.option('--products', '-p', 'product_files', type=str, multiple=True, required=True,
+              help='Yaml file with product and metadata type definitions, can be repeated')
+@click.option('--jobs', '-j', type=int, default=None,
+              help='Number of worker processes, defaults to number of cores')
+@click.option('--sample-size', type=int, default=2000,
+              help='Number of lines to train compression dictionaries on')
+@click.option('--per-product-dict/--shared-dict', default=True,
+              help='Train compression dictionary per product (default) or one for all products')
+@click.argument('output', type=str, nargs=1)
+@click.argument('inputs', type=str, nargs=-1)
+def from_json(product_files, jobs, sample_size, per_product_dict, output, inputs):
+    """Create cache from json lines files (.gz and .zst are supported), no database needed.
+    """
+    from .jsonl import jsonl_to_cache
+
+    if len(inputs) == 0:
+        click.echo('Have to supply at least one input file')
+        raise click.Abort()
+
+    cache = jsonl_to_cache(output, inputs, product_files,
+                           nprocs=jobs,
+                           sample_size=sample_size,
+                           per_product=per_product_dict)
+    click.echo('Saved {:,d} datasets to {}'.format(cache.count, output))
+
+
+if __name__ == '__main__':
+    cli()
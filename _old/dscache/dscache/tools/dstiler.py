@@ -1,6 +1,6 @@
 import click
 import dscache
-from .tiling import bin_dataset_stream, bin_by_native_tile
+from .tiling import bin_dataset_stream_vectorised, bin_by_native_tile, bin_cache_parallel, save_bins
 from datacube.model import GridSpec
 import datacube.utils.geometry as geom
 
@@ -9,11 +9,18 @@ GS_ALBERS = GridSpec(crs=geom.CRS('EPSG:3577'),
                      tile_size=(100000.0, 100000.0),
                      resolution=(-25, 25))
 
+ALBERS_KEY_FMT = 'albers/{:+03d}{:+03d}'
+NATIVE_KEY_FMT = 'native/{:03d}{:03d}'
+
 
 @click.command('dstiler')
 @click.option('--native', is_flag=True, help='Use Landsat Path/Row as grouping')
+@click.option('--jobs', '-j', type=int, default=None,
+              help='Split work across this many processes, keeps memory bounded')
+@click.option('--shards', type=int, default=None,
+              help='Number of key ranges to split work into (default: 16 per process)')
 @click.argument('dbfile', type=str, nargs=1)
-def cli(native, dbfile):
+def cli(native, jobs, shards, dbfile):
     """Add spatial grouping to file db.
 
     Default grid is Australian Albers (EPSG:3577) with 100k by 100k tiles. But
@@ -25,16 +32,26 @@ def cli(native, dbfile):
 
     if native:
         gs = None
-        group_key_fmt = 'native/{:03d}{:03d}'
+        group_key_fmt = NATIVE_KEY_FMT
     else:
         gs = GS_ALBERS  # TODO: make configurable
-        group_key_fmt = 'albers/{:+03d}{:+03d}'
+        group_key_fmt = ALBERS_KEY_FMT
+
+    if jobs is not None:
+        nshards = shards or jobs*16
+        partial_bins = bin_cache_parallel(dbfile, gridspec=gs, nprocs=jobs, nshards=nshards)
+
+        with click.progressbar(partial_bins, length=nshards, label=label) as partial_bins:
+            tiles = save_bins(cache, partial_bins, group_key_fmt)
+
+        click.echo('Total bins: {:d}'.format(len(tiles)))
+        return
 
     with click.progressbar(cache.get_all(), length=cache.count, label=label) as dss:
         if native:
             bins = bin_by_native_tile(dss)
         else:
-            bins = bin_dataset_stream(gs, dss)
+            bins = bin_dataset_stream_vectorised(gs, dss)
 
     click.echo('Total bins: {:d}'.format(len(bins)))
 
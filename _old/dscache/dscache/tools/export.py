@@ -0,0 +1,133 @@
+"""
+Export cache contents as a flat table, Arrow record batches or Parquet files.
+
+Needs `pyarrow`.
+"""
+import functools
+import toolz
+from ..dscache import extent_fields, doc_extent
+
+# (column name, metadata search field) for simple fields
+SEARCH_FIELD_COLUMNS = (('region_code', 'region_code'),
+                        ('cloud_cover', 'cloud_cover'))
+
+
+def _schema():
+    import pyarrow as pa
+
+    return pa.schema([('id', pa.string()),
+                      ('product', pa.string()),
+                      ('uris', pa.list_(pa.string())),
+                      ('time_start', pa.timestamp('us', tz='UTC')),
+                      ('time_end', pa.timestamp('us', tz='UTC')),
+                      ('lon_min', pa.float64()),
+                      ('lon_max', pa.float64()),
+                      ('lat_min', pa.float64()),
+                      ('lat_max', pa.float64()),
+                      ('region_code', pa.string()),
+                      ('cloud_cover', pa.float64())])
+
+
+def product_fields(products):
+    """Extract field offsets needed for export from product definitions.
+
+    :param products: {name: DatasetType}
+    :returns: {name: (extent_fields, {column: offset})}, plain python, safe to pickle
+    """
+    def fields(p):
+        mdt = p.metadata_type.definition
+        search_fields = toolz.get_in(['dataset', 'search_fields'], mdt, default={})
+        simple = {col: search_fields[name].get('offset', [])
+                  for col, name in SEARCH_FIELD_COLUMNS
+                  if name in search_fields}
+        return (extent_fields(mdt), simple)
+
+    return {name: fields(p) for name, p in products.items()}
+
+
+def docs_to_batch(fields, docs):
+    """ Flatten a list of raw documents into an Arrow record batch.
+
+    :param fields: Output of `product_fields`
+    :param docs: [raw_ds], see `dscache.doc2bytes`
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    no_fields = ((None, None, None), {})
+    cols = {name: [] for name in _schema().names}
+    extents = []
+
+    def get_field(metadata, offset):
+        # search field offset is a single key path, e.g. [properties, eo:cloud_cover]
+        if not offset:
+            return None
+        return toolz.get_in(offset, metadata)
+
+    for doc in docs:
+        metadata = doc['metadata']
+        ext_fields, simple = fields.get(doc['product'], no_fields)
+
+        cols['id'].append(str(metadata.get('id')))
+        cols['product'].append(doc['product'])
+        cols['uris'].append(doc.get('uris') or [])
+        extents.append(doc_extent(metadata, ext_fields))
+
+        region = get_field(metadata, simple.get('region_code'))
+        cloud = get_field(metadata, simple.get('cloud_cover'))
+        cols['region_code'].append(None if region is None else str(region))
+        cols['cloud_cover'].append(None if cloud is None else float(cloud))
+
+    ee = np.asarray(extents, dtype='float64').reshape(-1, 6)
+
+    def as_float(x):
+        return pa.array(x, type=pa.float64(), from_pandas=True)
+
+    def as_time(x):
+        missing = np.isnan(x)
+        us = np.round(np.where(missing, 0, x)*1e6)
+        return pa.array(us.astype('int64'), type=pa.int64(), mask=missing).cast(pa.timestamp('us', tz='UTC'))
+
+    schema = _schema()
+    arrays = [pa.array(cols['id'], type=pa.string()),
+              pa.array(cols['product'], type=pa.string()),
+              pa.array(cols['uris'], type=pa.list_(pa.string())),
+              as_time(ee[:, 4]),
+              as_time(ee[:, 5]),
+              as_float(ee[:, 0]),
+              as_float(ee[:, 1]),
+              as_float(ee[:, 2]),
+              as_float(ee[:, 3]),
+              pa.array(cols['region_code'], type=pa.string()),
+              pa.array(cols['cloud_cover'], type=pa.float64())]
+
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def record_batches(cache, nprocs=None, chunk_size=10000, prefetch=None):
+    """Stream cache contents as Arrow record batches of up to `chunk_size` rows.
+
+    Documents are decoded and flattened on worker processes when `nprocs` is
+    supplied, at most `prefetch` batches are in flight at any time.
+    """
+    proc = functools.partial(docs_to_batch, product_fields(cache.products))
+    return cache.map_docs(proc,
+                          nprocs=nprocs,
+                          chunk_size=chunk_size,
+                          prefetch=prefetch)
+
+
+def export_parquet(cache, path, nprocs=None, chunk_size=10000, compression='zstd'):
+    """Write cache contents to a Parquet file, one row group per `chunk_size` datasets.
+
+    :returns: Number of datasets written
+    """
+    import pyarrow.parquet as pq
+
+    n = 0
+    with pq.ParquetWriter(str(path), _schema(), compression=compression) as writer:
+        for batch in record_batches(cache, nprocs=nprocs, chunk_size=chunk_size):
+            writer.write_batch(batch)
+            n += batch.num_rows
+
+    return n
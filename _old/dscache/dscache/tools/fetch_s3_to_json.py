@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 from aws_utils import slurp_lines
 from aws_utils.s3tools import s3_fetch, make_s3_client
+from aws_utils.s3async import fetch_bunch
+import asyncio
 import yaml
 import json
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from types import SimpleNamespace
 
 
@@ -12,16 +16,192 @@ PRODUCT_MAP = dict(
     L8ARD='ls8_ard',
 )
 
+# Slot states in `harvest_yamls`
+_PENDING = None
+_TAKEN = object()
+
 
 def parse_yaml(data):
     return yaml.load(data, Loader=yaml.CSafeLoader)
 
 
-def grab_s3_yamls(input_fname, output_fname, region_name=None):
+def yaml_to_json_line(data, url):
+    """ Convert raw yaml bytes to a `{metadata, uris, product}` json line (without new line) """
+    metadata = parse_yaml(data)
+    p_type = metadata.get('product_type', '--')
+    product = PRODUCT_MAP.get(p_type, p_type)
+
+    out = dict(metadata=metadata,
+               uris=[url],
+               product=product)
+    return json.dumps(out, separators=(',', ':'), check_circular=False)
+
+
+def harvest_yamls(urls,
+                  nconnections=64,
+                  nprocs=None,
+                  retries=3,
+                  retry_delay=0.5,
+                  max_ahead=None,
+                  region_name=None,
+                  endpoint_url=None):
+    """Fetch and convert many yaml documents concurrently.
+
+    Downloads run on a background thread with up to `nconnections` requests
+    in flight, yaml parsing happens on a pool of `nprocs` worker processes.
+    Failed downloads are re-tried straight away, up to `retries` times,
+    waiting `retry_delay*2^attempt` seconds in between. At most `max_ahead`
+    documents (default: 4*nconnections) are downloaded or parsed ahead of the
+    consumer, so memory use does not depend on the number of urls.
+
+    :returns: Generator of (url, json_line, error) in the same order as `urls`,
+              one of `json_line` or `error` is None
+    """
+    urls = list(urls)
+    if max_ahead is None:
+        max_ahead = 4*nconnections
+
+    slots = [_PENDING]*len(urls)
+    cond = threading.Condition()
+    state = SimpleNamespace(abort=False, loop=None, window=None)
+    pool = ProcessPoolExecutor(nprocs)
+
+    def put(idx, value):
+        with cond:
+            slots[idx] = value
+            cond.notify_all()
+
+    def release(n=1):
+        """ Let the fetcher run `n` more documents ahead, called from the consumer thread """
+        def run():
+            for _ in range(n):
+                state.window.release()
+
+        with cond:
+            if state.loop is not None:
+                state.loop.call_soon_threadsafe(run)
+
+    def fetch_all():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        with cond:
+            state.window = asyncio.Semaphore(max_ahead)
+            state.loop = loop
+
+        async def throttle():
+            if not state.abort:
+                await state.window.acquire()
+
+        def live_urls():
+            for url in urls:
+                if state.abort:
+                    return
+                yield url
+
+        def on_data(data, url, idx=None, time=None):
+            if not state.abort:
+                put(idx, pool.submit(yaml_to_json_line, data, url))
+
+        def on_error(url, idx=None, error=None):
+            put(idx, error)
+
+        try:
+            fetch_bunch(live_urls(), on_data,
+                        nconnections=nconnections,
+                        loop=loop,
+                        region_name=region_name,
+                        on_error=on_error,
+                        endpoint_url=endpoint_url,
+                        retries=retries,
+                        retry_delay=retry_delay,
+                        throttle=throttle)
+        except Exception as e:
+            with cond:
+                for idx, v in enumerate(slots):
+                    if v is _PENDING:
+                        slots[idx] = e
+                cond.notify_all()
+        finally:
+            with cond:
+                state.loop = None
+            loop.close()
+
+    fetcher = threading.Thread(target=fetch_all, daemon=True)
+    fetcher.start()
+
+    try:
+        for idx, url in enumerate(urls):
+            with cond:
+                cond.wait_for(lambda: slots[idx] is not _PENDING)
+                v, slots[idx] = slots[idx], _TAKEN
+
+            if isinstance(v, Exception):
+                release()
+                yield (url, None, v)
+                continue
+
+            try:
+                line, err = v.result(), None
+            except Exception as e:
+                line, err = None, e
+
+            release()
+            yield (url, line, err)
+    finally:
+        # unblock fetcher when consumer stops early
+        state.abort = True
+        release(nconnections)
+        fetcher.join()
+        pool.shutdown()
+
+
+def grab_s3_yamls(input_fname, output_fname,
+                  region_name=None,
+                  nconnections=64,
+                  nprocs=None,
+                  retries=3,
+                  endpoint_url=None):
+    """ Fetch yaml documents listed in `input_fname` and write them out as json lines.
+
+    Output order matches input, documents that could not be fetched or parsed are skipped.
+
+    :returns: SimpleNamespace(total, written, failed=[(url, error)])
+    """
+    urls = slurp_lines(input_fname)
+    n_total = len(urls)
+    stats = SimpleNamespace(total=n_total, written=0, failed=[])
+
+    with open(output_fname, 'wt') as f:
+        for idx, (url, line, err) in enumerate(harvest_yamls(urls,
+                                                             nconnections=nconnections,
+                                                             nprocs=nprocs,
+                                                             retries=retries,
+                                                             region_name=region_name,
+                                                             endpoint_url=endpoint_url)):
+            if err is not None:
+                print('Failed to fetch %s: %s' % (url, str(err)))
+                stats.failed.append((url, err))
+                continue
+
+            f.write(line)
+            f.write('\n')
+            stats.written += 1
+
+            if (idx % 100) == 0:
+                print('.', end='', flush=True)
+
+            if (idx % 1000) == 0:
+                print('{:5.1f}%'.format(100*idx/n_total))
+
+    return stats
+
+
+def grab_s3_yamls_sequential(input_fname, output_fname, region_name=None, endpoint_url=None):
+    """ One request at a time version of `grab_s3_yamls`, kept for benchmarking """
     urls = slurp_lines(input_fname)
 
     n_total = len(urls)
-    s3 = make_s3_client(region_name=region_name)
+    s3 = make_s3_client(region_name=region_name, endpoint_url=endpoint_url)
 
     with open(output_fname, 'wt') as f:
         for idx, url in enumerate(urls):
@@ -31,16 +211,7 @@ def grab_s3_yamls(input_fname, output_fname, region_name=None):
                 print('Failed to fetch %s' % url)
                 continue
 
-            metadata = parse_yaml(data)
-            p_type = metadata.get('product_type', '--')
-            product = PRODUCT_MAP.get(p_type, p_type)
-
-            out = dict(metadata=metadata,
-                       uris=[url],
-                       product=product)
-            out = json.dumps(out, separators=(',', ':'), check_circular=False)
-
-            f.write(out)
+            f.write(yaml_to_json_line(data, url))
             f.write('\n')
 
             if (idx % 100) == 0:
@@ -54,4 +225,5 @@ if __name__ == '__main__':
     import sys
 
     in_file, out_file = sys.argv[1:]
-    grab_s3_yamls(in_file, out_file)
+    stats = grab_s3_yamls(in_file, out_file)
+    print('\nWrote {:,d} of {:,d}, failed: {:,d}'.format(stats.written, stats.total, len(stats.failed)))
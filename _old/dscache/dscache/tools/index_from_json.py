@@ -1,7 +1,9 @@
 import click
 import toolz
 import json
+import timeit
 import datacube
+from types import SimpleNamespace
 from datacube.index.hl import Doc2Dataset
 
 
@@ -31,10 +33,189 @@ def from_json_lines(lines, index, **kwargs):
             print('Error[%d]: %s' % (lineno, err))
 
 
+# Per worker process state for bulk mode: {env: Doc2Dataset}
+_RESOLVERS = {}
+
+
+def _get_resolver(env):
+    doc2ds = _RESOLVERS.get(env)
+    if doc2ds is None:
+        dc = datacube.Datacube(env=env)
+        doc2ds = _RESOLVERS[env] = Doc2Dataset(dc.index, skip_lineage=True, verify_lineage=False)
+    return doc2ds
+
+
+def resolve_chunk(env, chunk):
+    """ Runs on worker processes, parse lines and match them to products.
+
+    :param chunk: [(lineno, line)]
+    :returns: [(lineno, (id, product, metadata, uris), None) | (lineno, None, error)]
+    """
+    doc2ds = _get_resolver(env)
+
+    def resolve(lineno, line):
+        try:
+            doc = json.loads(line)
+        except ValueError as e:
+            return (lineno, None, 'json: {}'.format(str(e)))
+
+        uris = doc.get('uris') or []
+        if len(uris) == 0:
+            return (lineno, None, 'missing uri')
+
+        metadata = doc.get('metadata')
+        if metadata is None:
+            return (lineno, None, 'missing metadata')
+
+        ds, err = doc2ds(metadata, uris[0])
+        if ds is None:
+            return (lineno, None, str(err))
+
+        return (lineno, (str(ds.id), ds.type.name, ds.metadata_doc, uris), None)
+
+    return [resolve(lineno, line) for lineno, line in chunk]
+
+
+def bulk_insert(conn, product_refs, dss):
+    """ Insert datasets and their locations in one transaction.
+
+    :param product_refs: {product_name: (dataset_type_ref, metadata_type_ref)}
+    :param dss: [(id, product, metadata, uris)]
+    :returns: Number of new datasets, datasets already indexed are skipped
+    """
+    from psycopg2.extras import execute_values, Json
+
+    def split_uri(uri):
+        scheme, body = uri.split(':', 1)
+        return scheme, body
+
+    rows = [(ds_id, product_refs[product][1], product_refs[product][0], Json(metadata))
+            for ds_id, product, metadata, _ in dss]
+    locations = [(ds_id,) + split_uri(uri)
+                 for ds_id, _, _, uris in dss
+                 for uri in uris]
+
+    with conn:
+        with conn.cursor() as cur:
+            inserted = execute_values(cur, '''
+insert into agdc.dataset (id, metadata_type_ref, dataset_type_ref, metadata)
+values %s
+on conflict (id) do nothing
+returning id
+''', rows, fetch=True)
+
+            execute_values(cur, '''
+insert into agdc.dataset_location (dataset_ref, uri_scheme, uri_body)
+values %s
+on conflict do nothing
+''', locations)
+
+    return len(inserted)
+
+
+def bulk_index(lines, env=None, nprocs=None, chunk_size=1000, batch_size=10000, max_errors=20, progress=None):
+    """Index json lines using a pool of workers for parsing and product
+    matching, datasets are inserted `batch_size` at a time, one transaction
+    per batch. Lineage is not recorded.
+
+    :param lines: Stream of json lines with {metadata, uris} documents
+    :param env: Datacube environment name
+    :param nprocs: Number of worker processes
+    :param chunk_size: Number of lines per unit of work
+    :param batch_size: Number of datasets per transaction
+    :param max_errors: Number of error messages to keep in the summary
+    :param progress: Optional callback called with the summary after every batch
+    :returns: SimpleNamespace summary: total, indexed, existing, failed, errors, elapsed, rate
+    """
+    import functools
+    from . import db_connect
+    from ..parallel import pmap_stream
+
+    dc = datacube.Datacube(env=env)
+    conn = db_connect(cfg=env)
+    product_refs = {}
+
+    def product_ref(name):
+        ref = product_refs.get(name)
+        if ref is None:
+            p = dc.index.products.get_by_name(name)
+            ref = product_refs[name] = (p.id, p.metadata_type.id)
+        return ref
+
+    t0 = timeit.default_timer()
+    summary = SimpleNamespace(total=0, indexed=0, existing=0, failed=0,
+                              errors=[], elapsed=0.0, rate=0.0)
+
+    def add_error(lineno, msg):
+        summary.failed += 1
+        if len(summary.errors) < max_errors:
+            summary.errors.append(dict(line=lineno, error=msg))
+
+    def update():
+        summary.elapsed = timeit.default_timer() - t0
+        summary.rate = summary.total/summary.elapsed if summary.elapsed > 0 else 0.0
+        if progress is not None:
+            progress(summary)
+
+    def flush(batch):
+        try:
+            n = bulk_insert(conn, product_refs, batch)
+        except Exception as e:
+            for ds_id, *_ in batch:
+                add_error(None, 'insert {}: {}'.format(ds_id, str(e)))
+            return
+        summary.indexed += n
+        summary.existing += len(batch) - n
+
+    chunks = toolz.partition_all(chunk_size, enumerate(lines))
+    # workers open their own database connections, don't share ours across fork
+    results = pmap_stream(functools.partial(resolve_chunk, env), chunks,
+                          nprocs=nprocs,
+                          mp_context='spawn')
+
+    batch = []
+    for chunk in results:
+        for lineno, ds, err in chunk:
+            summary.total += 1
+            if ds is None:
+                add_error(lineno, err)
+                continue
+
+            product_ref(ds[1])
+            batch.append(ds)
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+                update()
+
+    if batch:
+        flush(batch)
+    update()
+
+    conn.close()
+    return summary
+
+
 @click.command('index_from_json')
 @click.option('--env', type=str, help='Datacube environment name')
+@click.option('--bulk', is_flag=True,
+              help='Parse on a pool of workers and insert in large transactions (no lineage)')
+@click.option('--jobs', '-j', type=int, default=None,
+              help='Number of worker processes in bulk mode, defaults to number of cores')
+@click.option('--batch-size', type=int, default=10000,
+              help='Number of datasets per transaction in bulk mode')
 @click.argument('input_fname', type=str, nargs=1)
-def cli(input_fname, env=None):
+def cli(input_fname, env=None, bulk=False, jobs=None, batch_size=10000):
+    if bulk:
+        def progress(s):
+            click.echo('T:{s.total:,d} I:{s.indexed:,d} F:{s.failed:,d} {s.rate:.1f}/s'.format(s=s), err=True)
+
+        with open(input_fname, 'rt') as f:
+            summary = bulk_index(f, env=env, nprocs=jobs, batch_size=batch_size, progress=progress)
+
+        click.echo(json.dumps(vars(summary), indent=2))
+        return
+
     dc = datacube.Datacube(env=env)
 
     n_total = 0
@@ -0,0 +1,150 @@
+"""
+Build a cache from json lines files without a datacube database.
+
+Input is the output of `fetch_s3_to_json`, one `{metadata, uris, product}`
+document per line, optionally gzip (.gz) or zstd (.zst, .zstd) compressed.
+Product definitions come from yaml files, same ones used with
+`datacube product add`.
+"""
+import io
+import json
+import re
+import itertools
+import toolz
+from pathlib import Path
+from .. import create_cache, train_dictionary, train_product_dictionaries
+from ..dscache import build_dc_product_map
+
+# fetch_s3_to_json writes product last, this avoids parsing on the main thread
+_PRODUCT_TAIL = re.compile(r'"product"\s*:\s*"([^"\\]*)"\s*}\s*$')
+
+# Minimum number of sample documents needed to train a dictionary
+MIN_DICT_SAMPLES = 10
+
+
+def open_lines(fname):
+    """ Open text file for reading, decompressing based on file extension """
+    fname = str(fname)
+
+    if fname.endswith('.gz'):
+        import gzip
+        return gzip.open(fname, 'rt')
+
+    if fname.endswith(('.zst', '.zstd')):
+        import zstandard
+        fh = open(fname, 'rb')
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(fh), encoding='utf8')
+
+    return open(fname, 'rt')
+
+
+def lines_from_files(fnames):
+    for fname in fnames:
+        with open_lines(fname) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+
+
+def product_from_line(line):
+    m = _PRODUCT_TAIL.search(line)
+    if m is not None:
+        return m.group(1)
+    return json.loads(line)['product']
+
+
+def default_metadata_types():
+    """ Metadata type definitions shipped with datacube """
+    import datacube
+    import yaml
+
+    fname = Path(datacube.__file__).parent/'index'/'default-metadata-types.yaml'
+    if not fname.exists():
+        return {}
+
+    with open(str(fname), 'rt') as f:
+        return {doc['name']: doc for doc in yaml.safe_load_all(f) if doc}
+
+
+def load_products(fnames):
+    """ Load product and metadata type definitions from yaml files.
+
+    Metadata types not defined in the files are looked up in datacube defaults.
+
+    :returns: {name: DatasetType}
+    """
+    import yaml
+
+    metadata, products = {}, {}
+
+    for fname in fnames:
+        with open(str(fname), 'rt') as f:
+            for doc in yaml.safe_load_all(f):
+                if not doc:
+                    continue
+                if 'metadata_type' in doc:
+                    products[doc['name']] = doc
+                elif 'dataset' in doc:
+                    metadata[doc['name']] = doc
+
+    missing = set(p['metadata_type'] for p in products.values()) - set(metadata)
+    if missing:
+        defaults = default_metadata_types()
+        metadata.update({name: defaults[name] for name in missing if name in defaults})
+
+    return build_dc_product_map(metadata, products)
+
+
+def train_dictionaries(docs, per_product=True, dict_sz=8*1024, codec=None):
+    """Train compression dictionaries from a sample of raw documents.
+
+    :returns: (zdict, zdicts), zdicts only covers products with enough samples
+    """
+    docs = list(docs)
+    if len(docs) < MIN_DICT_SAMPLES:
+        return None, None
+
+    if not per_product:
+        return train_dictionary(docs, dict_sz, codec), None
+
+    by_product = toolz.groupby(lambda doc: doc['product'], docs)
+    zdicts = train_product_dictionaries([doc
+                                         for sample in by_product.values()
+                                         if len(sample) >= MIN_DICT_SAMPLES
+                                         for doc in sample], dict_sz, codec)
+    zdict = train_dictionary(docs, dict_sz, codec)
+    return zdict, zdicts
+
+
+def jsonl_to_cache(output, inputs, product_files,
+                   nprocs=None,
+                   sample_size=2000,
+                   per_product=True,
+                   dict_sz=8*1024,
+                   chunk_size=1000,
+                   truncate=True,
+                   **kwargs):
+    """Load json lines files into a new cache.
+
+    Compression dictionaries are trained on the first `sample_size` lines,
+    json parsing and compression then run on `nprocs` worker processes.
+
+    :param output: Path to the cache
+    :param inputs: List of json lines files
+    :param product_files: List of yaml files with product (and metadata type) definitions
+    :returns: DatasetCache
+    """
+    products = load_products(product_files)
+
+    sample = [json.loads(line) for line in itertools.islice(lines_from_files(inputs), sample_size)]
+    zdict, zdicts = train_dictionaries(sample, per_product=per_product, dict_sz=dict_sz,
+                                       codec=kwargs.get('codec'))
+
+    cache = create_cache(output, zdict=zdict, zdicts=zdicts, truncate=truncate, **kwargs)
+    cache.add_products(products.values())
+
+    docs = ((product_from_line(line), line) for line in lines_from_files(inputs))
+    cache.bulk_save_parallel(docs, nprocs=nprocs, chunk_size=chunk_size)
+
+    return cache
@@ -39,3 +39,368 @@ def ds_stream_test_func(dss, get_uuid=None):
                          text='')
     rr.text = _rr2s(rr)
     return rr
+
+
+def bench_get_many(cache, uuids, repeat=3):
+    """Compare `cache.get_many(uuids)` against a loop over `cache.get`.
+
+    :param cache: DatasetCache
+    :param uuids: List of dataset ids to fetch
+    :param repeat: Number of runs to perform, best time is reported
+    """
+    uuids = list(uuids)
+
+    def run_loop():
+        return [cache.get(u) for u in uuids]
+
+    def run_many():
+        return cache.get_many(uuids)
+
+    t_loop = min(timeit.repeat(run_loop, number=1, repeat=repeat))
+    t_many = min(timeit.repeat(run_many, number=1, repeat=repeat))
+
+    rr = SimpleNamespace(count=len(uuids),
+                         t_loop=t_loop,
+                         t_many=t_many,
+                         text='')
+    rr.text = '''
+Count   : {r.count:,d}
+get     : {r.t_loop:6.3f} sec ({loop_fps:.1f} per second)
+get_many: {r.t_many:6.3f} sec ({many_fps:.1f} per second)
+Speedup : {speedup:.2f}x
+'''.format(r=rr,
+           loop_fps=rr.count/t_loop,
+           many_fps=rr.count/t_many,
+           speedup=t_loop/t_many).strip()
+
+    return rr
+
+
+def bench_ingest(path, docs, nprocs=(1, 2, 4, 8), products=None, zdict=None, **kwargs):
+    """Compare ingest throughput of `bulk_save_raw` against `bulk_save_parallel`
+    with different number of worker processes.
+
+    :param path: Where to create temporary cache, it is overwritten for every run
+    :param docs: List of raw documents to save, see `dscache.doc2bytes`
+    :param nprocs: Worker counts to try
+    :param products: Product map, needed to index extents of raw documents
+    :param zdict: Compression dictionary to use
+    :param kwargs: Passed on to `bulk_save_parallel`
+    """
+    import dscache
+
+    timer = timeit.default_timer
+    docs = list(docs)
+
+    def run(save):
+        cache = dscache.create_cache(path, zdict=zdict, truncate=True)
+        if products is not None:
+            cache.products.update(products)
+        t0 = timer()
+        save(cache)
+        cache.sync()
+        return timer() - t0
+
+    t_raw = run(lambda cache: cache.bulk_save_raw(docs))
+    t_par = [(n, run(lambda cache: cache.bulk_save_parallel(docs, nprocs=n, **kwargs)))
+             for n in nprocs]
+
+    rr = SimpleNamespace(count=len(docs),
+                         t_raw=t_raw,
+                         t_parallel=t_par,
+                         text='')
+
+    lines = ['Count            : {:,d}'.format(len(docs)),
+             'bulk_save_raw    : {:6.3f} sec ({:.1f} per second)'.format(t_raw, len(docs)/t_raw)]
+    lines.extend('parallel nprocs={:<2d}: {:6.3f} sec ({:.1f} per second) {:.2f}x'.format(
+        n, t, len(docs)/t, t_raw/t) for n, t in t_par)
+    rr.text = '\n'.join(lines)
+
+    return rr
+
+
+def bench_db_export(path, products, cfg=None, nprocs=None, split=1, read_chunk=1000, zdict=None):
+    """Compare database export as done by `slurpy` (one product at a time,
+    `Dataset` constructed on the client) against `slurpy --fast`
+    (concurrent cursors, json text from the server, parsing on workers).
+
+    Reports throughput and space used by the resulting cache.
+
+    :param path: Where to create temporary cache, it is overwritten for every run
+    :param products: List of product names to export
+    :param cfg: Datacube environment name
+    :param nprocs: Number of compression workers for the fast path
+    :param split: Number of cursors per product for the fast path
+    """
+    import datacube
+    import dscache
+    from . import db_connect, raw_dataset_keyset_stream, mk_raw2ds, parallel_text_stream
+
+    timer = timeit.default_timer
+    dc = datacube.Datacube(env=cfg)
+    all_prods = {p.name: p for p in dc.index.products.get_all()}
+    raw2ds = mk_raw2ds(all_prods)
+
+    def run(save):
+        cache = dscache.create_cache(path, zdict=zdict, truncate=True)
+        cache.add_products([all_prods[p] for p in products])
+        t0 = timer()
+        save(cache)
+        cache.sync()
+        t = timer() - t0
+        env = cache._dbs.main
+        return SimpleNamespace(t=t,
+                               count=cache.count,
+                               nbytes=(env.info()['last_pgno'] + 1)*env.stat()['psize'])
+
+    def save_slow(cache):
+        db = db_connect(cfg)
+        try:
+            for p in products:
+                cache.bulk_save(map(raw2ds, raw_dataset_keyset_stream(p, db)))
+        finally:
+            db.close()
+
+    def save_fast(cache):
+        cache.bulk_save_parallel(parallel_text_stream(products, cfg=cfg, split=split, read_chunk=read_chunk),
+                                 nprocs=nprocs)
+
+    slow = run(save_slow)
+    fast = run(save_fast)
+
+    rr = SimpleNamespace(slow=slow, fast=fast, text='')
+    rr.text = '''
+Count  : {s.count:,d}
+slurpy : {s.t:6.3f} sec ({slow_fps:.1f} per second) {s.nbytes:,d} bytes
+--fast : {f.t:6.3f} sec ({fast_fps:.1f} per second) {f.nbytes:,d} bytes
+Speedup: {speedup:.2f}x
+'''.format(s=slow, f=fast,
+           slow_fps=slow.count/slow.t,
+           fast_fps=fast.count/fast.t,
+           speedup=slow.t/fast.t).strip()
+
+    return rr
+
+
+def bench_codecs(docs, codecs=None, complevel=6, dict_sz=8*1024, repeat=3):
+    """Compare document codecs on a sample of raw documents.
+
+    Reports compressed size (with a dictionary trained per codec) and decode
+    throughput (decompress + parse) for every codec.
+
+    ```
+    docs = [d.doc for d in cache.get_all(raw=True)]
+    print(bench_codecs(docs).text)
+    ```
+
+    :param docs: List of raw documents, see `dscache.doc2bytes`
+    :param codecs: Codec names to try, defaults to all that can be loaded
+    """
+    import zstandard
+    from dscache import train_dictionary
+    from dscache.codecs import available_codecs, get_codec
+
+    docs = list(docs)
+    if codecs is None:
+        codecs = available_codecs()
+
+    results = []
+    for name in codecs:
+        try:
+            codec = get_codec(name)
+        except ValueError:
+            continue
+
+        zdict = zstandard.ZstdCompressionDict(train_dictionary(docs, dict_sz, codec=name))
+        comp = zstandard.ZstdCompressor(level=complevel, dict_data=zdict)
+        decomp = zstandard.ZstdDecompressor(dict_data=zdict)
+
+        raw = [codec.dumps(doc) for doc in docs]
+        packed = [comp.compress(d) for d in raw]
+
+        def decode():
+            for d in packed:
+                codec.loads(decomp.decompress(d))
+
+        t_decode = min(timeit.repeat(decode, number=1, repeat=repeat))
+        results.append(SimpleNamespace(codec=name,
+                                       raw_bytes=sum(map(len, raw)),
+                                       packed_bytes=sum(map(len, packed)),
+                                       t_decode=t_decode))
+
+    lines = ['{:8s} {:>14s} {:>14s} {:>12s}'.format('codec', 'raw bytes', 'stored bytes', 'decode/sec')]
+    lines.extend('{r.codec:8s} {r.raw_bytes:14,d} {r.packed_bytes:14,d} {fps:12.1f}'.format(
+        r=r, fps=len(docs)/r.t_decode) for r in results)
+
+    return SimpleNamespace(count=len(docs),
+                           results=results,
+                           text='\n'.join(lines))
+
+
+_COLD_START_SCRIPT = '''
+import sys, timeit, json
+t0 = timeit.default_timer()
+import dscache
+t1 = timeit.default_timer()
+cache = dscache.open_ro(sys.argv[1])
+t2 = timeit.default_timer()
+ds = cache.get(sys.argv[2])
+t3 = timeit.default_timer()
+assert ds is not None
+print(json.dumps(dict(t_import=t1-t0, t_open=t2-t1, t_get=t3-t2)))
+'''
+
+
+def bench_cold_start(path, uuid, repeat=5):
+    """Time `import dscache; open_ro(path).get(uuid)` in a fresh interpreter.
+
+    :param path: Path to an existing cache
+    :param uuid: Id of a dataset stored in the cache
+    :param repeat: Number of runs to perform, best time is reported for each stage
+    """
+    import json
+    import subprocess
+    import sys
+
+    def run():
+        t0 = timeit.default_timer()
+        out = subprocess.check_output([sys.executable, '-c', _COLD_START_SCRIPT, str(path), str(uuid)])
+        rr = json.loads(out.decode('utf8'))
+        rr['t_total'] = timeit.default_timer() - t0
+        return rr
+
+    runs = [run() for _ in range(repeat)]
+    best = {k: min(r[k] for r in runs) for k in runs[0]}
+
+    rr = SimpleNamespace(text='', **best)
+    rr.text = '''
+import  : {r.t_import:6.3f} sec
+open_ro : {r.t_open:6.3f} sec
+get     : {r.t_get:6.3f} sec
+Process : {r.t_total:6.3f} sec (including interpreter startup)
+'''.format(r=rr).strip()
+
+    return rr
+
+
+def run_s3_stub(get_object, latency=0.0, host='127.0.0.1', port=0):
+    """Serve `GET /{bucket}/{key}` from `get_object(bucket, key) -> bytes|None`
+    on a background thread, enough of S3 for `fetch_bunch` and `s3_fetch` with
+    `endpoint_url` pointing at it. Needs `aiohttp`.
+
+    :param latency: Seconds to wait before every response
+    :returns: (endpoint_url, stop)
+    """
+    import asyncio
+    import threading
+    from aiohttp import web
+
+    async def handle(request):
+        if latency > 0:
+            await asyncio.sleep(latency)
+        data = get_object(request.match_info['bucket'], request.match_info['key'])
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data)
+
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_get('/{bucket}/{key:.*}', handle)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, host, port).start())
+    endpoint_url = 'http://{}:{}'.format(*runner.addresses[0][:2])
+
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+    return endpoint_url, stop
+
+
+_STUB_YAML = '''
+id: {id}
+product_type: L8ARD
+format: {{name: GeoTIFF}}
+extent:
+  center_dt: '2019-01-01T00:00:00'
+  coord:
+    ll: {{lat: -35.0, lon: 149.0}}
+    ur: {{lat: -34.0, lon: 150.0}}
+image:
+  bands:
+{bands}
+'''
+
+
+def bench_s3_harvest(urls=None, n=500, latency=0.02, endpoint_url=None, region_name='us-west-2',
+                     nconnections=64, nprocs=None, tmpdir=None):
+    """Compare `grab_s3_yamls` against the one request at a time loop
+    (`grab_s3_yamls_sequential`).
+
+    By default a local S3 stub serving `n` synthetic documents with
+    `latency` seconds of delay per request is used, supply `urls` and
+    `endpoint_url` (None for AWS) to run against a real service instead.
+    """
+    import os
+    import tempfile
+    import uuid
+    from pathlib import Path
+    from .fetch_s3_to_json import grab_s3_yamls, grab_s3_yamls_sequential
+
+    timer = timeit.default_timer
+    stop = None
+    saved_env = {}
+
+    if urls is None:
+        bands = '\n'.join('    b{0}: {{path: band_{0}.tif, layer: 1}}'.format(i) for i in range(10))
+
+        def get_object(bucket, key):
+            return _STUB_YAML.format(id=uuid.uuid5(uuid.NAMESPACE_URL, key), bands=bands).encode('utf8')
+
+        endpoint_url, stop = run_s3_stub(get_object, latency=latency)
+        urls = ['s3://bench/doc-{:06d}.yaml'.format(i) for i in range(n)]
+
+        # requests are signed, stub doesn't check credentials but they need to exist
+        for k in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+            if k not in os.environ:
+                saved_env[k] = None
+                os.environ[k] = 'stub'
+
+    try:
+        with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+            in_file, out_file = str(Path(tmp)/'urls.txt'), str(Path(tmp)/'out.jsonl')
+            with open(in_file, 'wt') as f:
+                f.write('\n'.join(urls) + '\n')
+
+            t0 = timer()
+            grab_s3_yamls_sequential(in_file, out_file, region_name=region_name, endpoint_url=endpoint_url)
+            t_seq = timer() - t0
+
+            t0 = timer()
+            grab_s3_yamls(in_file, out_file, region_name=region_name, endpoint_url=endpoint_url,
+                          nconnections=nconnections, nprocs=nprocs)
+            t_par = timer() - t0
+    finally:
+        if stop is not None:
+            stop()
+        for k in saved_env:
+            os.environ.pop(k, None)
+
+    rr = SimpleNamespace(count=len(urls), t_sequential=t_seq, t_concurrent=t_par, text='')
+    rr.text = '''
+Count     : {r.count:,d}
+sequential: {r.t_sequential:6.3f} sec ({seq_fps:.1f} per second)
+concurrent: {r.t_concurrent:6.3f} sec ({par_fps:.1f} per second)
+Speedup   : {speedup:.2f}x
+'''.format(r=rr,
+           seq_fps=rr.count/t_seq,
+           par_fps=rr.count/t_par,
+           speedup=t_seq/t_par).strip()
+
+    return rr
@@ -1,15 +1,35 @@
+import json
 import click
 import datacube
 import dscache
-from dscache.tools import db_connect, raw_dataset_stream, mk_raw2ds
+from dscache.tools import db_connect, raw_dataset_keyset_stream, mk_raw2ds, parallel_text_stream, count_datasets
 from dscache.tools import dictionary_from_product_list
+from dscache.tools.tiling import mk_grid_grouper, mk_native_grouper
+from dscache.tools.sync import db_now, set_watermark
+
+# Per product export progress is recorded in the cache under this key
+CHECKPOINT_KEY_FMT = 'slurpy/{}'
 
 
 @click.command('slurpy')
 @click.option('--env', type=str, help='Datacube environment name')
+@click.option('--per-product-dict/--shared-dict', default=True,
+              help='Train compression dictionary per product (default) or one for all products')
+@click.option('--group', type=click.Choice(['albers', 'native']), multiple=True,
+              help='Maintain spatial groups while exporting (same as running dstiler afterwards)')
+@click.option('--fast', is_flag=True,
+              help='Export all products concurrently, skipping Dataset construction on the client')
+@click.option('--jobs', '-j', type=int, default=None,
+              help='Number of compression workers in fast mode, defaults to number of cores')
+@click.option('--split', type=int, default=1,
+              help='Number of concurrent database cursors per product in fast mode')
+@click.option('--fetch-size', type=int, default=1000,
+              help='Number of rows to fetch from the database at a time in fast mode')
+@click.option('--resume', is_flag=True,
+              help='Continue interrupted export into an existing cache')
 @click.argument('output', type=str, nargs=1)
 @click.argument('products', type=str, nargs=-1)
-def cli(env, output, products):
+def cli(env, per_product_dict, group, fast, jobs, split, fetch_size, resume, output, products):
 
     if len(products) == 0:
         click.echo('Have to supply at least one product')
@@ -24,10 +44,11 @@ def cli(env, output, products):
             click.echo('No such product found: %s' % p)
             raise click.Abort()
 
+    if resume and fast:
+        click.echo('--resume is not supported in fast mode')
+        raise click.Abort()
+
     raw2ds = mk_raw2ds(all_prods)
-    click.echo('Training compression dictionary')
-    zdict = dictionary_from_product_list(dc, products, samples_per_product=50)
-    click.echo('..done')
 
     click.echo('Getting dataset counts')
     counts = {p.name: count
@@ -36,21 +57,72 @@ def cli(env, output, products):
     for p, c in counts.items():
         click.echo('..{}: {:8,d}'.format(p, c))
 
-    # TODO: check for overwrite
-    cache = dscache.create_cache(output, zdict=zdict, truncate=True)
+    if resume:
+        cache = dscache.open_rw(output)
+    else:
+        click.echo('Training compression dictionary')
+        zdict = dictionary_from_product_list(dc, products,
+                                             samples_per_product=50,
+                                             per_product=per_product_dict)
+        zdict, zdicts = (None, zdict) if per_product_dict else (zdict, None)
+        click.echo('..done')
+
+        # TODO: check for overwrite
+        cache = dscache.create_cache(output, zdict=zdict, zdicts=zdicts, truncate=True)
+
+        # Changes made after this point can be picked up later with `dscache sync`
+        set_watermark(cache, db_now(db_connect(cfg=env)))
+
+    if 'albers' in group:
+        from .dstiler import GS_ALBERS, ALBERS_KEY_FMT
+        cache.add_grouper(mk_grid_grouper(GS_ALBERS, ALBERS_KEY_FMT))
+    if 'native' in group:
+        from .dstiler import NATIVE_KEY_FMT
+        cache.add_grouper(mk_native_grouper(NATIVE_KEY_FMT))
+
+    if fast:
+        cache.add_products([all_prods[p] for p in products])
+        n_total = sum(counts.get(p, 0) for p in products)
+        dss = parallel_text_stream(products, cfg=env, split=split, read_chunk=fetch_size)
+
+        label = 'Processing {} products ({:8,d})'.format(len(products), n_total)
+        with click.progressbar(dss, label=label, length=n_total) as dss:
+            cache.bulk_save_parallel(dss, nprocs=jobs)
+
+        for p in products:
+            cache.put_udata(CHECKPOINT_KEY_FMT.format(p), json.dumps(dict(done=True)).encode('utf8'))
+
+        cache.sync()
+        return
 
     conn = db_connect(cfg=env)
 
     for p in products:
-        dss = map(raw2ds, raw_dataset_stream(p, conn))
-        dss = cache.tee(dss)
+        progress_key = CHECKPOINT_KEY_FMT.format(p)
+        progress = json.loads(cache.get_udata(progress_key, b'{}').decode('utf8'))
+
+        if progress.get('done', False):
+            click.echo('Skipping {}, already exported'.format(p))
+            continue
+
+        def checkpoint(ds):
+            return progress_key, json.dumps(dict(last_id=str(ds.id))).encode('utf8')
+
+        dss = map(raw2ds, raw_dataset_keyset_stream(p, conn, after=progress.get('last_id')))
+        dss = cache.tee(dss, checkpoint=checkpoint)
 
         n_dss = counts.get(p, None)
         label = 'Processing {} ({:8,d})'.format(p, n_dss)
+        if 'last_id' in progress:
+            n_dss = count_datasets(p, conn, after=progress['last_id'])
+            label = 'Resuming {} after {} ({:8,d} left)'.format(p, progress['last_id'], n_dss)
+
         with click.progressbar(dss, label=label, length=n_dss) as dss:
             for ds in dss:
                 pass
 
+        cache.put_udata(progress_key, json.dumps(dict(done=True)).encode('utf8'))
+
     cache.sync()
 
 
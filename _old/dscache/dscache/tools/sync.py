@@ -0,0 +1,138 @@
+"""
+Incremental refresh of a dataset cache from the datacube database.
+
+Time of the last sync (database server time) is stored in the cache under
+`WATERMARK_KEY`. Next sync only looks at datasets added or archived, and at
+locations added or archived, after that time. Datasets purged from the
+database (rather than archived) are not detected.
+"""
+import random
+from datetime import timedelta
+from types import SimpleNamespace
+from dateutil.parser import parse as parse_time
+import toolz
+from . import db_connect
+
+WATERMARK_KEY = 'sync/watermark'
+
+_DOC_SQL = '''
+jsonb_build_object(
+  'product', _type_.name,
+  'uris', array((select _loc_.uri_scheme ||':'||_loc_.uri_body
+                 from agdc.dataset_location as _loc_
+                 where _loc_.dataset_ref = _ds_.id and _loc_.archived is null
+                 order by _loc_.added desc, _loc_.id desc)),
+  'metadata', _ds_.metadata)
+'''
+
+
+def db_now(db):
+    """ Current time according to the database server """
+    with db.cursor() as cur:
+        cur.execute('select now();')
+        (t,) = cur.fetchone()
+    return t
+
+
+def get_watermark(cache):
+    t = cache.get_udata(WATERMARK_KEY)
+    return None if t is None else parse_time(t.decode('utf8'))
+
+
+def set_watermark(cache, t):
+    cache.put_udata(WATERMARK_KEY, t.isoformat().encode('utf8'))
+
+
+def updated_dataset_stream(db, products, since, read_chunk=1000):
+    """ Raw documents of active datasets added, or with locations changed, after `since`.
+    """
+    query = '''
+select {doc} as dataset
+from agdc.dataset as _ds_
+join agdc.dataset_type as _type_ on _type_.id = _ds_.dataset_type_ref
+where _ds_.archived is null
+and _type_.name = any(%(products)s)
+and (_ds_.added > %(since)s
+     or exists (select 1 from agdc.dataset_location as _loc_
+                where _loc_.dataset_ref = _ds_.id
+                and (_loc_.added > %(since)s or _loc_.archived > %(since)s)));
+'''.format(doc=_DOC_SQL)
+
+    cur = db.cursor(name='c{:04X}'.format(random.randint(0, 0xFFFF)))
+    cur.execute(query, dict(products=list(products), since=since))
+
+    while True:
+        chunk = cur.fetchmany(read_chunk)
+        if not chunk:
+            break
+
+        for (ds,) in chunk:
+            yield ds
+
+    cur.close()
+
+
+def archived_dataset_ids(db, products, since):
+    """ Ids of datasets archived after `since`.
+    """
+    query = '''
+select _ds_.id
+from agdc.dataset as _ds_
+join agdc.dataset_type as _type_ on _type_.id = _ds_.dataset_type_ref
+where _ds_.archived > %(since)s
+and _type_.name = any(%(products)s);
+'''
+    with db.cursor() as cur:
+        cur.execute(query, dict(products=list(products), since=since))
+        return [str(ds_id) for (ds_id,) in cur.fetchall()]
+
+
+def sync_cache(cache, db=None, products=None, since=None,
+               batch_size=10000,
+               overlap=timedelta(minutes=10)):
+    """Bring cache up to date with the datacube database.
+
+    New and changed datasets are saved (overwriting older versions), archived
+    ones are removed, groups and extents are updated as part of the same
+    write transactions. Watermark is only advanced once all changes are
+    saved, so an interrupted sync can simply be repeated.
+
+    :param cache: DatasetCache opened in append mode
+    :param db: Database connection or datacube environment name
+    :param products: Product names to sync, defaults to all products in the cache
+    :param since: Override watermark stored in the cache
+    :param batch_size: Number of datasets per write transaction
+    :param overlap: Re-visit changes this much older than the watermark, to
+                    pick up rows from transactions that committed late
+    :returns: SimpleNamespace(updated, removed, since, watermark)
+    """
+    if isinstance(db, str) or db is None:
+        db = db_connect(db)
+
+    if products is None:
+        products = list(cache.products)
+
+    if since is None:
+        since = get_watermark(cache)
+        if since is None:
+            raise ValueError('Cache has no sync watermark, need to supply `since`')
+    elif isinstance(since, str):
+        since = parse_time(since)
+
+    watermark = db_now(db)
+    t0 = since - overlap
+
+    updated = 0
+    for batch in toolz.partition_all(batch_size, updated_dataset_stream(db, products, t0)):
+        cache.bulk_save_raw(batch)
+        updated += len(batch)
+
+    removed = cache.bulk_delete(archived_dataset_ids(db, products, t0),
+                                max_transaction_size=batch_size)
+
+    set_watermark(cache, watermark)
+
+    return SimpleNamespace(updated=updated,
+                           removed=removed,
+                           since=since,
+                           watermark=watermark)
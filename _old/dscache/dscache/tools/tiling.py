@@ -1,4 +1,7 @@
 from types import SimpleNamespace
+import functools
+import toolz
+import numpy as np
 
 
 def extract_ls_path_row(ds):
@@ -8,6 +11,39 @@ def extract_ls_path_row(ds):
     return tuple(int(s) for s in (full_id[3:6], full_id[6:9]))
 
 
+def mk_grid_grouper(gridspec, key_fmt='albers/{:+03d}{:+03d}'):
+    """Make grouper for `DatasetCache.add_grouper` that assigns datasets to grid tiles.
+
+    :param gridspec: GridSpec
+    :param key_fmt: Group name format, receives tile index (x, y)
+    """
+    geobox_cache = {}
+
+    def grouper(ds):
+        return [key_fmt.format(*tile)
+                for tile, _ in gridspec.tiles_from_geopolygon(ds.extent, geobox_cache=geobox_cache)]
+
+    return grouper
+
+
+def mk_native_grouper(key_fmt='native/{:03d}{:03d}', native_tile_id=None):
+    """Make grouper for `DatasetCache.add_grouper` that assigns datasets to
+    native tiles, like path/row for Landsat.
+
+    :param key_fmt: Group name format, receives native tile id
+    :param native_tile_id: Dataset -> Key, defaults to `extract_ls_path_row`
+    """
+    native_tile_id = native_tile_id or extract_ls_path_row
+
+    def grouper(ds):
+        tile = native_tile_id(ds)
+        if tile is None:
+            raise ValueError('Missing tile id')
+        return [key_fmt.format(*tile)]
+
+    return grouper
+
+
 def bin_dataset_stream(gridspec, dss, persist=None):
     """
 
@@ -40,6 +76,127 @@ def bin_dataset_stream(gridspec, dss, persist=None):
     return cells
 
 
+def tile_ranges(gridspec, bboxes):
+    """Compute range of candidate tiles for every bounding box.
+
+    Same as `GridSpec.tiles(bbox)`, but for many bounding boxes at once.
+
+    :param gridspec: GridSpec
+    :param bboxes: (N, 4) array of (left, bottom, right, top) in `gridspec.crs`
+    :returns: (x0, x1, y0, y1) integer arrays, tiles are x0 <= x < x1, y0 <= y < y1
+    """
+    def grid_range(lower, upper, step, origin):
+        lower, upper = lower - origin, upper - origin
+        if step < 0:
+            lower, upper, step = -upper, -lower, -step
+        return (np.floor(lower/step).astype('int64'),
+                np.ceil(upper/step).astype('int64'))
+
+    bboxes = np.asarray(bboxes, dtype='float64').reshape(-1, 4)
+    tile_size_y, tile_size_x = gridspec.tile_size
+    origin_y, origin_x = gridspec.origin
+
+    x0, x1 = grid_range(bboxes[:, 0], bboxes[:, 2], tile_size_x, origin_x)
+    y0, y1 = grid_range(bboxes[:, 1], bboxes[:, 3], tile_size_y, origin_y)
+
+    return x0, np.maximum(x1, x0), y0, np.maximum(y1, y0)
+
+
+def _is_multipart(geom):
+    """ MultiPolygon or GeometryCollection, ogr and shapely name these differently """
+    name = str(geom.type).upper()
+    return name.startswith('MULTI') or 'COLLECTION' in name
+
+
+def bin_bboxes(gridspec, bboxes, values, polygons=None, geobox_cache=None, cells=None):
+    """Vectorised version of `bin_dataset_stream`.
+
+    Candidate tiles for all bounding boxes are computed with numpy in one
+    pass. When `polygons` are supplied, exact intersection is only checked for
+    footprints spanning at least 2x2 tiles and for multipart footprints: a
+    connected footprint that fits into a single row or column of tiles has to
+    cross every tile of that row or column.
+
+    :param gridspec: GridSpec
+    :param bboxes: (N, 4) array of (left, bottom, right, top) in `gridspec.crs`
+    :param values: Sequence of N things to record, typically dataset ids
+    :param polygons: Optional sequence of N footprints (Geometry) for exact checks
+    :param geobox_cache: Dictionary to cache tile geoboxes in
+    :param cells: Existing bins to add to
+    :returns: {tile: SimpleNamespace(geobox, idx, dss)}, same as `bin_dataset_stream`
+    """
+    from datacube.utils import geometry
+
+    cells = {} if cells is None else cells
+    geobox_cache = {} if geobox_cache is None else geobox_cache
+
+    x0, x1, y0, y1 = tile_ranges(gridspec, bboxes)
+    nx, ny = x1 - x0, y1 - y0
+    n = nx*ny
+
+    # One entry per (dataset, candidate tile) pair
+    ds_idx = np.repeat(np.arange(n.shape[0]), n)
+    offset = np.arange(ds_idx.shape[0]) - np.repeat(np.cumsum(n) - n, n)
+    tx = x0[ds_idx] + offset % np.maximum(nx, 1)[ds_idx]
+    ty = y0[ds_idx] + offset // np.maximum(nx, 1)[ds_idx]
+
+    if polygons is not None:
+        multipart = np.asarray([_is_multipart(p) for p in polygons], dtype='bool').reshape(n.shape)
+        needs_check = (((nx > 1) & (ny > 1)) | multipart)[ds_idx]
+    else:
+        needs_check = np.zeros(ds_idx.shape, dtype='bool')
+
+    def tile_geobox(tile):
+        geobox = geobox_cache.get(tile)
+        if geobox is None:
+            geobox = geobox_cache[tile] = gridspec.tile_geobox(tile)
+        return geobox
+
+    for i, x, y, check in zip(ds_idx.tolist(), tx.tolist(), ty.tolist(), needs_check.tolist()):
+        tile = (x, y)
+        geobox = tile_geobox(tile)
+
+        if check and not geometry.intersects(geobox.extent, polygons[i]):
+            continue
+
+        cell = cells.get(tile)
+        if cell is None:
+            cells[tile] = SimpleNamespace(geobox=geobox, idx=tile, dss=[values[i]])
+        else:
+            cell.dss.append(values[i])
+
+    return cells
+
+
+def bin_dataset_stream_vectorised(gridspec, dss, persist=None, chunk_size=10000, exact=True):
+    """Same as `bin_dataset_stream` but uses vectorised `bin_bboxes`.
+
+    :param gridspec: GridSpec
+    :param dss: Sequence of datasets (can be lazy)
+    :param persist: Dataset -> SomeThing mapping, defaults to keeping dataset id only
+    :param chunk_size: Number of datasets to process at once
+    :param exact: Check exact footprint intersection for datasets spanning
+                  several tiles, otherwise bounding box intersection is used
+    """
+    cells = {}
+    geobox_cache = {}
+
+    def default_persist(ds):
+        return ds.id
+
+    persist = persist or default_persist
+
+    for chunk in toolz.partition_all(chunk_size, dss):
+        extents = [ds.extent.to_crs(gridspec.crs) for ds in chunk]
+        bboxes = [tuple(e.boundingbox) for e in extents]
+        bin_bboxes(gridspec, bboxes, [persist(ds) for ds in chunk],
+                   polygons=extents if exact else None,
+                   geobox_cache=geobox_cache,
+                   cells=cells)
+
+    return cells
+
+
 def bin_by_native_tile(dss, persist=None, native_tile_id=None):
     """Group datasets by native tiling, like path/row for Landsat.
 
@@ -77,3 +234,164 @@ def bin_by_native_tile(dss, persist=None, native_tile_id=None):
             register(tile, ds_val)
 
     return cells
+
+
+def doc_footprint(metadata, grid_spatial_offset=('grid_spatial', 'projection')):
+    """Construct dataset footprint from a metadata document without building a
+    `Dataset` object, same logic as `Dataset.extent`.
+
+    :param metadata: Dataset metadata document
+    :param grid_spatial_offset: Location of the projection section in the document
+    :returns: Geometry or None if document lacks spatial information
+    """
+    import datacube.utils.geometry as geom
+
+    projection = toolz.get_in(list(grid_spatial_offset), metadata)
+    if not projection:
+        return None
+
+    crs = projection.get('spatial_reference')
+    if crs is None:
+        return None
+    crs = geom.CRS(str(crs))
+
+    valid_data = projection.get('valid_data')
+    if valid_data:
+        return geom.Geometry(valid_data, crs=crs)
+
+    pts = projection.get('geo_ref_points')
+    if pts is None:
+        return None
+
+    return geom.polygon([(pts[k]['x'], pts[k]['y']) for k in ('ll', 'ul', 'ur', 'lr', 'll')], crs=crs)
+
+
+def bin_cache_shard(path, key_range, gridspec=None, native_tile_id=None):
+    """Bin datasets from one shard of the cache, to be run on a worker process.
+
+    :param path: Path to the cache file
+    :param key_range: (start, stop) range of dataset ids, see `dscache.key_ranges`
+    :param gridspec: GridSpec to bin by, if not supplied bin by native tile
+    :param native_tile_id: Dataset -> Key, defaults to `extract_ls_path_row`
+    :returns: {tile_index: bytes}, dataset ids concatenated 16 bytes each
+    """
+    import dscache
+
+    cache = dscache.open_ro(path, lock=True)
+    offsets = {name: tuple(toolz.get_in(['dataset', 'grid_spatial'], p.metadata_type.definition,
+                                        default=('grid_spatial', 'projection')))
+               for name, p in cache.products.items()}
+
+    native_tile_id = native_tile_id or extract_ls_path_row
+    geobox_cache = {}
+    cells = {}
+
+    def register(tile, k):
+        cell = cells.get(tile)
+        if cell is None:
+            cells[tile] = cell = bytearray()
+        cell += k
+
+    def footprint(doc):
+        extent = doc_footprint(doc.metadata, offsets.get(doc.product, ('grid_spatial', 'projection')))
+        return None if extent is None else extent.to_crs(gridspec.crs)
+
+    dss = cache.get_range(*key_range, raw=True)
+
+    if gridspec is None:
+        for doc in dss:
+            tile = native_tile_id(doc)
+            if tile is None:
+                raise ValueError('Missing tile id')
+            register(tile, doc.id.bytes)
+    else:
+        for chunk in toolz.partition_all(10000, dss):
+            extents = [(doc.id.bytes, footprint(doc)) for doc in chunk]
+            extents = [(k, e) for k, e in extents if e is not None]
+            bins = bin_bboxes(gridspec,
+                              [tuple(e.boundingbox) for _, e in extents],
+                              [k for k, _ in extents],
+                              polygons=[e for _, e in extents],
+                              geobox_cache=geobox_cache)
+            for tile, cell in bins.items():
+                for k in cell.dss:
+                    register(tile, k)
+
+    return {tile: bytes(ids) for tile, ids in cells.items()}
+
+
+def bin_cache_parallel(path, gridspec=None, native_tile_id=None, nprocs=None, nshards=None):
+    """Bin all datasets in the cache by splitting uuid keyspace across processes.
+
+    Yields partial bins as shards complete, so only a few shards worth of
+    ids are kept in memory at any time, see `save_bins`.
+
+    :param path: Path to the cache file
+    :param gridspec: GridSpec to bin by, if not supplied bin by native tile
+    :param native_tile_id: Dataset -> Key, has to be picklable
+    :param nprocs: Number of worker processes, defaults to number of cores
+    :param nshards: Number of key ranges to split work into, defaults to 16 per worker
+    :returns: Stream of {tile_index: bytes}, one per shard
+    """
+    from dscache import key_ranges
+    from dscache.parallel import pmap_stream, default_nprocs
+
+    nprocs = nprocs or default_nprocs()
+    nshards = nshards or nprocs*16
+
+    proc = functools.partial(bin_cache_shard, str(path),
+                             gridspec=gridspec,
+                             native_tile_id=native_tile_id)
+
+    return pmap_stream(proc, key_ranges(nshards),
+                       nprocs=nprocs,
+                       ordered=False,
+                       mp_context='spawn')
+
+
+def save_bins(cache, partial_bins, key_fmt):
+    """Merge stream of partial bins into groups of the cache.
+
+    Groups seen for the first time are replaced, subsequent partial bins for
+    the same tile are merged into it.
+
+    :param cache: DatasetCache opened in read-write mode
+    :param partial_bins: Stream of {tile_index: bytes}
+    :param key_fmt: Group name format, receives tile index
+    :returns: Set of tile indexes that were saved
+    """
+    seen = set()
+
+    for bins in partial_bins:
+        groups = {key_fmt.format(*tile): ids for tile, ids in bins.items()}
+        cache.merge_groups(groups, replace={key_fmt.format(*tile) for tile in bins if tile not in seen})
+        seen.update(bins)
+
+    return seen
+
+
+def test_bin_vectorised():
+    from datacube.model import GridSpec
+    from datacube.utils import geometry
+
+    crs = geometry.CRS('EPSG:3577')
+    gs = GridSpec(crs=crs, tile_size=(100, 100), resolution=(-10, 10))
+
+    def box(x0, y0, x1, y1):
+        return [(x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0)]
+
+    extents = [geometry.polygon(box(10, 10, 40, 40), crs),        # single tile
+               geometry.polygon(box(10, 10, 240, 40), crs),       # 1x3 row
+               geometry.polygon(box(-50, -250, -20, 20), crs),    # 3x1 column
+               geometry.polygon([(5, 5), (295, 5), (5, 295), (5, 5)], crs),  # triangle, 3x3 bbox
+               # two parts in a 1x3 row of tiles, not touching the middle one
+               geometry.multipolygon([[box(10, 10, 40, 40)], [box(210, 10, 240, 40)]], crs),
+               geometry.multipolygon([[box(10, 10, 40, 40)], [box(10, -190, 40, -160)]], crs)]
+    dss = [SimpleNamespace(id=i, extent=e) for i, e in enumerate(extents)]
+
+    def as_dict(cells):
+        return {tile: sorted(cell.dss) for tile, cell in cells.items()}
+
+    expect = as_dict(bin_dataset_stream(gs, dss))
+    assert expect[(1, 0)] == [1, 3]
+    assert as_dict(bin_dataset_stream_vectorised(gs, dss, chunk_size=4)) == expect
@@ -12,14 +12,18 @@ setup(
     install_requires=['datacube',
                       'zstandard',
                       'lmdb',
+                      'numpy',
                       ],
     tests_require=['pytest'],
-    extras_require=dict(),
+    extras_require=dict(msgpack=['msgpack'],
+                        cbor=['cbor2'],
+                        parquet=['pyarrow']),
     entry_points={
         'console_scripts': [
             'index_from_json = dscache.tools.index_from_json:cli',
             'slurpy = dscache.tools.slurpy:cli',
             'dstiler = dscache.tools.dstiler:cli',
+            'dscache = dscache.tools.app:cli',
         ]
     }
 )